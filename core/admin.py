@@ -1,12 +1,28 @@
 from django.contrib import admin
-from .models import RTORecord, Order, PrintOrder
+from django.db.models import Sum
+from .bundles import bundle_response
+from .duplicates import refresh_flags
+from .models import RTORecord, RecordDocument, DocumentMatch, StorageUsage, Order, PrintOrder, OrderRollup
+from .quotas import reconcile
+
+class RecordDocumentInline(admin.TabularInline):
+    model = RecordDocument
+    extra = 0
+    fields = ['kind', 'storage_key', 'size', 'mime_type', 'sha256', 'link_status', 'link_checked_at']
+    readonly_fields = fields
+    can_delete = False
+    
+    def has_add_permission(self, request, obj=None):
+        return False
 
 @admin.register(RTORecord)
 class RTORecordAdmin(admin.ModelAdmin):
-    list_display = ['name', 'owner', 'record_type', 'status', 'created_at']
-    list_filter = ['status', 'record_type', 'created_at']
+    list_display = ['name', 'owner', 'record_type', 'status', 'duplicate_flag', 'broken_links', 'created_at']
+    list_filter = ['status', 'record_type', 'duplicate_flag', 'broken_links', 'created_at']
     search_fields = ['name', 'contact_no', 'owner__email']
-    readonly_fields = ['id', 'created_at', 'updated_at', 'reviewed_at']
+    readonly_fields = ['id', 'created_at', 'updated_at', 'reviewed_at', 'review_pdf']
+    inlines = [RecordDocumentInline]
+    actions = ['download_documents']
     
     fieldsets = (
         ('Basic Information', {
@@ -16,7 +32,7 @@ class RTORecordAdmin(admin.ModelAdmin):
             'fields': ('rc_photo', 'insurance_doc', 'pu_check_doc', 'driving_license_doc')
         }),
         ('Generated Files', {
-            'fields': ('qr_code_image', 'pdf_card_filepath')
+            'fields': ('qr_code_image', 'pdf_card_filepath', 'review_pdf')
         }),
         ('Review Information', {
             'fields': ('status', 'reviewed_by', 'reviewed_at', 'notes')
@@ -30,6 +46,40 @@ class RTORecordAdmin(admin.ModelAdmin):
         if change and 'status' in form.changed_data:
             obj.reviewed_by = request.user
         super().save_model(request, obj, form, change)
+    
+    @admin.action(description="Download documents of selected records (ZIP)")
+    def download_documents(self, request, queryset):
+        return bundle_response(queryset.order_by('created_at'), 'records.zip')
+
+@admin.register(DocumentMatch)
+class DocumentMatchAdmin(admin.ModelAdmin):
+    list_display = ['document', 'matched_document', 'distance', 'reviewed', 'created_at']
+    list_filter = ['reviewed', 'distance']
+    list_select_related = ['document__record', 'matched_document__record']
+    readonly_fields = ['document', 'matched_document', 'distance', 'reviewed_by', 'created_at']
+    actions = ['mark_reviewed']
+    
+    @admin.action(description="Mark selected matches as reviewed")
+    def mark_reviewed(self, request, queryset):
+        record_ids = set()
+        for document_id, matched_id in queryset.values_list('document__record_id', 'matched_document__record_id'):
+            record_ids.update((document_id, matched_id))
+        updated = queryset.update(reviewed=True, reviewed_by=request.user)
+        refresh_flags(record_ids)
+        self.message_user(request, f"Marked {updated} matches as reviewed")
+
+@admin.register(StorageUsage)
+class StorageUsageAdmin(admin.ModelAdmin):
+    list_display = ['user', 'bytes', 'files', 'quota_bytes', 'reconciled_at', 'updated_at']
+    search_fields = ['user__email']
+    list_select_related = ['user']
+    readonly_fields = ['user', 'bytes', 'files', 'reconciled_at', 'updated_at']
+    actions = ['reconcile_usage']
+    
+    @admin.action(description="Recount usage of selected users from their documents")
+    def reconcile_usage(self, request, queryset):
+        drift = reconcile(list(queryset.values_list('user_id', flat=True)))
+        self.message_user(request, f"Reconciled {queryset.count()} users, {len(drift)} had drifted")
 
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
@@ -37,9 +87,42 @@ class OrderAdmin(admin.ModelAdmin):
     list_filter = ['order_type', 'payment_status', 'payment_provider', 'created_at']
     search_fields = ['order_id', 'user__email', 'rto_record__name']
     readonly_fields = ['order_id', 'total_amount', 'created_at', 'updated_at', 'completed_at']
+    actions = ['refund_orders']
+    
+    @admin.action(description="Refund selected orders")
+    def refund_orders(self, request, queryset):
+        from payments.refunds import queue_refunds
+        queued = queue_refunds(queryset.values_list('pk', flat=True), reason=f"Refunded by {request.user.email}")
+        self.message_user(
+            request,
+            f"Queued {queued} orders for refund. Progress is recorded on their payment transactions.",
+        )
 
 @admin.register(PrintOrder)
 class PrintOrderAdmin(admin.ModelAdmin):
     list_display = ['order', 'status', 'tracking_number', 'shipping_partner', 'created_at']
     list_filter = ['status', 'shipping_partner', 'created_at']
     search_fields = ['order__order_id', 'tracking_number']
+
+@admin.register(OrderRollup)
+class OrderRollupAdmin(admin.ModelAdmin):
+    list_display = ['date', 'order_type', 'payment_provider', 'status', 'order_count', 'total_amount']
+    list_filter = ['order_type', 'payment_provider', 'status', 'date']
+    date_hierarchy = 'date'
+    readonly_fields = ['date', 'order_type', 'payment_provider', 'status', 'order_count', 'total_amount', 'updated_at']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context=extra_context)
+        try:
+            queryset = response.context_data['cl'].queryset
+        except (AttributeError, KeyError):
+            return response
+        totals = queryset.aggregate(orders=Sum('order_count'), revenue=Sum('total_amount'))
+        self.message_user(request, f"Totals for selection: {totals['orders'] or 0} orders, ₹{totals['revenue'] or 0}")
+        return response
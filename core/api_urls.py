@@ -1,12 +1,16 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .api_views import RTORecordViewSet, PaymentViewSet, OrderViewSet
+from .api_views import RTORecordViewSet, PaymentViewSet, OrderViewSet, ReportViewSet, UploadViewSet, DirectUploadViewSet, DocumentMatchViewSet
 
 # Create router and register viewsets
 router = DefaultRouter()
 router.register(r'records', RTORecordViewSet, basename='records')
 router.register(r'payments', PaymentViewSet, basename='payments')
 router.register(r'orders', OrderViewSet, basename='orders')
+router.register(r'reports', ReportViewSet, basename='reports')
+router.register(r'uploads', UploadViewSet, basename='uploads')
+router.register(r'direct-uploads', DirectUploadViewSet, basename='direct-uploads')
+router.register(r'document-matches', DocumentMatchViewSet, basename='document-matches')
 
 urlpatterns = [
     path('', include(router.urls)),
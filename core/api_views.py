@@ -1,20 +1,40 @@
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import MultiPartParser, FormParser
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from django.http import HttpResponse
 from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.db.models import Sum
+from django.utils.dateparse import parse_date
+from django.utils.http import http_date
 import io
+from PIL import Image
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
-import razorpay
 import hmac
 import hashlib
 
-from .models import RTORecord, Order, PrintOrder
-from .serializers import RTORecordSerializer, OrderSerializer, QRGenerationSerializer, PaymentSerializer
+from payments.routing import router as payment_router, GatewayUnavailable
+from .idempotency import idempotent
+from .bundles import bundle_response, record_folder
+from .duplicates import dhash, find_near_duplicates
+from .file_cache import file_cache
+from .media import serve_file
+from .review_pdf import review_pdf
+from .uploads import stream_document_uploads, upload_errors
+from .quotas import quota_errors
+from . import resumable, direct_uploads
+from .resumable import UploadError
+from .models import RTORecord, DocumentMatch, Order, PrintOrder, OrderRollup, UploadSession
+from .serializers import (
+    RTORecordSerializer, OrderSerializer, QRGenerationSerializer, PaymentSerializer,
+    DirectUploadSerializer, DirectUploadCompleteSerializer, DocumentMatchSerializer, MatchedDocumentSerializer,
+)
 
 class RTORecordViewSet(viewsets.ModelViewSet):
     """API for RTO Record Management with full functionality."""
@@ -23,11 +43,55 @@ class RTORecordViewSet(viewsets.ModelViewSet):
     parser_classes = [MultiPartParser, FormParser]
     
     def get_queryset(self):
-        return RTORecord.objects.filter(owner=self.request.user)
+        records = RTORecord.objects.filter(owner=self.request.user).prefetch_related('documents')
+        kind = self.request.query_params.get('document_kind')
+        if kind:
+            records = records.filter(documents__kind=kind)
+        return records
     
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
     
+    def initial(self, request, *args, **kwargs):
+        if request.method in ('POST', 'PUT', 'PATCH'):
+            # Before authentication, whose CSRF check may parse the body
+            stream_document_uploads(request)
+        super().initial(request, *args, **kwargs)
+        if request.method in ('POST', 'PUT', 'PATCH'):
+            # Parse now so files rejected mid-stream are reported instead of silently dropped
+            request.data
+            errors = upload_errors(request)
+            if not errors and any(field in request.FILES for field in RTORecord.DOCUMENT_FIELDS):
+                record = self.get_object() if self.kwargs.get('pk') else None
+                errors = quota_errors(request.user, request.FILES, record)
+            if errors:
+                raise ValidationError(errors)
+    
+    @action(detail=True, methods=['get'])
+    def bundle(self, request, pk=None):
+        """Stream every document of the record as one ZIP."""
+        record = self.get_object()
+        return bundle_response([record], f"{record_folder(record)}.zip")
+    
+    @action(detail=True, methods=['get'])
+    def review_pdf(self, request, pk=None):
+        """Consolidated review PDF (cover page plus every document), cached until the documents change."""
+        record = self.get_object()
+        pdf = review_pdf(record)
+        return serve_file(request, pdf.storage, pdf.name, filename=f"{record_folder(record)}_review.pdf")
+    
+    @action(detail=False, methods=['get'], url_path='bundle')
+    def bundle_many(self, request):
+        """Stream the documents of several records (?ids=a,b or every listed record) as one ZIP."""
+        records = self.filter_queryset(self.get_queryset())
+        ids = [i for i in request.query_params.get('ids', '').split(',') if i]
+        if ids:
+            try:
+                records = records.filter(pk__in=ids)
+            except DjangoValidationError:
+                raise ValidationError({'ids': 'Must be a comma-separated list of record ids'})
+        return bundle_response(records.distinct().order_by('created_at'), 'records.zip')
+    
     @action(detail=True, methods=['post'])
     def generate_qr(self, request, pk=None):
         """Generate QR code after document submission."""
@@ -83,7 +147,7 @@ class RTORecordViewSet(viewsets.ModelViewSet):
             p.drawString(50, height - 170, f"Record Type: {record.get_record_type_display()}")
             
             # Add QR code image to PDF
-            qr_image_path = record.qr_code_image.path
+            qr_image_path = file_cache().local_path(record.qr_code_image)
             p.drawImage(qr_image_path, 50, height - 450, width=300, height=300)
             
             # Add instructions
@@ -118,11 +182,10 @@ class PaymentViewSet(viewsets.ViewSet):
     permission_classes = [IsAuthenticated]
     
     @action(detail=False, methods=['post'])
+    @idempotent
     def create_razorpay_order(self, request):
-        """Create Razorpay order for payment processing."""
+        """Create a gateway order (routed to the healthiest gateway) for payment processing."""
         try:
-            client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
-            
             serializer = PaymentSerializer(data=request.data)
             if not serializer.is_valid():
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -134,28 +197,33 @@ class PaymentViewSet(viewsets.ViewSet):
             # Verify record belongs to user
             record = get_object_or_404(RTORecord, id=record_id, owner=request.user)
             
-            # Create order in Razorpay
-            razorpay_order = client.order.create({
-                'amount': amount,
-                'currency': 'INR',
-                'receipt': f'{order_type}_{record_id}_{request.user.id}',
-                'notes': {
-                    'user_id': request.user.id,
-                    'record_id': str(record_id),
-                    'order_type': order_type
-                }
-            })
+            # Create order on the selected gateway
+            try:
+                provider, gateway_order = payment_router.create_order(
+                    amount,
+                    'INR',
+                    receipt=f'{order_type}_{record_id}_{request.user.id}',
+                    notes={
+                        'user_id': request.user.id,
+                        'record_id': str(record_id),
+                        'order_type': order_type
+                    },
+                    description=f'{order_type.replace("_", " ").title()} for {record.name}',
+                    success_url=request.build_absolute_uri('/orders/{CHECKOUT_SESSION_ID}/success/'),
+                    cancel_url=request.build_absolute_uri(f'/records/{record.id}/'),
+                )
+            except GatewayUnavailable as e:
+                return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
             
             # Create order in our database
             order = Order.objects.create(
                 user=request.user,
                 rto_record=record,
-                order_id=razorpay_order['id'],
+                order_id=gateway_order['id'],
                 order_type=order_type,
                 amount=amount/100,  # Convert paisa to rupees
                 total_amount=amount/100,
-                payment_provider='razorpay',
-                payment_provider_id=razorpay_order['id'],
+                payment_provider=provider,
                 delivery_address=serializer.validated_data.get('delivery_address', ''),
                 delivery_phone=serializer.validated_data.get('delivery_phone', ''),
                 delivery_pincode=serializer.validated_data.get('delivery_pincode', '')
@@ -163,10 +231,12 @@ class PaymentViewSet(viewsets.ViewSet):
             
             return Response({
                 'success': True,
-                'order_id': razorpay_order['id'],
+                'order_id': gateway_order['id'],
+                'provider': provider,
+                'checkout_url': gateway_order.get('checkout_url'),
                 'amount': amount,
                 'currency': 'INR',
-                'key': settings.RAZORPAY_KEY_ID,
+                'key': gateway_order['key'],
                 'name': 'RTO Record Management',
                 'description': f'{order_type.replace("_", " ").title()} for {record.name}',
                 'prefill': {
@@ -205,7 +275,7 @@ class PaymentViewSet(viewsets.ViewSet):
             
             if generated_signature == signature:
                 # Payment successful - update order
-                order = Order.objects.get(payment_provider_id=order_id, user=request.user)
+                order = Order.objects.get(order_id=order_id, user=request.user)
                 order.payment_status = 'completed'
                 order.save()
                 
@@ -247,3 +317,209 @@ class OrderViewSet(viewsets.ReadOnlyModelViewSet):
     
     def get_queryset(self):
         return Order.objects.filter(user=self.request.user)
+
+
+class ReportViewSet(viewsets.ViewSet):
+    """Revenue and order reports served from the pre-aggregated rollup table."""
+    permission_classes = [IsAdminUser]
+    
+    GROUP_FIELDS = ['date', 'order_type', 'payment_provider', 'status']
+    
+    @action(detail=False, methods=['get'])
+    def revenue(self, request):
+        """Order counts and revenue grouped by any of date/order_type/payment_provider/status."""
+        rollups = OrderRollup.objects.all()
+        
+        start = parse_date(request.query_params.get('from', '') or '')
+        end = parse_date(request.query_params.get('to', '') or '')
+        if start:
+            rollups = rollups.filter(date__gte=start)
+        if end:
+            rollups = rollups.filter(date__lte=end)
+        for field in ['order_type', 'payment_provider', 'status']:
+            value = request.query_params.get(field)
+            if value:
+                rollups = rollups.filter(**{field: value})
+        
+        group_by = [
+            field for field in request.query_params.get('group_by', 'date').split(',')
+            if field in self.GROUP_FIELDS
+        ] or ['date']
+        
+        rows = (
+            rollups.order_by(*group_by)
+            .values(*group_by)
+            .annotate(order_count=Sum('order_count'), total_amount=Sum('total_amount'))
+        )
+        totals = rollups.aggregate(order_count=Sum('order_count'), total_amount=Sum('total_amount'))
+        
+        return Response({
+            'group_by': group_by,
+            'results': list(rows),
+            'totals': {
+                'order_count': totals['order_count'] or 0,
+                'total_amount': totals['total_amount'] or 0,
+            },
+        })
+
+
+class DocumentMatchViewSet(viewsets.ReadOnlyModelViewSet):
+    """Near-duplicate documents across owners, for officer review."""
+    serializer_class = DocumentMatchSerializer
+    permission_classes = [IsAdminUser]
+    
+    def get_queryset(self):
+        matches = DocumentMatch.objects.select_related(
+            'document__record__owner', 'matched_document__record__owner',
+        )
+        reviewed = self.request.query_params.get('reviewed')
+        if reviewed in ('true', 'false'):
+            matches = matches.filter(reviewed=reviewed == 'true')
+        return matches
+    
+    @action(detail=False, methods=['get', 'post'], parser_classes=[MultiPartParser, FormParser])
+    def lookup(self, request):
+        """Documents near an image (POST 'image') or a hex dHash (?hash=), closest first."""
+        try:
+            if 'image' in request.FILES:
+                with Image.open(request.FILES['image']) as img:
+                    value = dhash(img)
+            else:
+                value = int(request.query_params.get('hash', ''), 16)
+        except (ValueError, OSError):
+            raise ValidationError({'hash': 'Send an image file or a 16-digit hex hash'})
+        try:
+            max_distance = int(request.query_params.get('max_distance', settings.DOCUMENT_DUPLICATE_MAX_DISTANCE))
+            matches = find_near_duplicates(value, max_distance)
+        except ValueError as e:
+            raise ValidationError({'max_distance': str(e)})
+        return Response({
+            'hash': f"{value:016x}",
+            'results': [
+                {'distance': d, 'document': MatchedDocumentSerializer(document).data}
+                for document, d in matches
+            ],
+        })
+
+
+class UploadViewSet(viewsets.ViewSet):
+    """Resumable document uploads (tus 1.0: creation, checksum, termination, expiration)."""
+    permission_classes = [IsAuthenticated]
+    
+    def _sessions(self, request):
+        return UploadSession.objects.filter(owner=request.user)
+    
+    def _tus_response(self, status_code=status.HTTP_204_NO_CONTENT, session=None, data=None, **headers):
+        response = Response(data, status=status_code)
+        response['Tus-Resumable'] = resumable.TUS_VERSION
+        response['Cache-Control'] = 'no-store'
+        if session is not None:
+            response['Upload-Offset'] = str(session.offset)
+            response['Upload-Length'] = str(session.length)
+            response['Upload-Expires'] = http_date(session.expires_at.timestamp())
+        for name, value in headers.items():
+            response[name.replace('_', '-')] = value
+        return response
+    
+    def _error(self, error):
+        return self._tus_response(error.status, data={'error': str(error)})
+    
+    def options(self, request, *args, **kwargs):
+        """tus capability discovery."""
+        return self._tus_response(
+            Tus_Version=resumable.TUS_VERSION,
+            Tus_Extension=resumable.TUS_EXTENSIONS,
+            Tus_Checksum_Algorithm=resumable.CHECKSUM_ALGORITHMS,
+            Tus_Max_Size=str(settings.MAX_DOCUMENT_SIZE),
+        )
+    
+    def create(self, request):
+        """Start an upload. Metadata: record, field, filename and optionally checksum (hex SHA-256)."""
+        try:
+            metadata = resumable.parse_metadata(request.headers.get('Upload-Metadata'))
+            session = resumable.start_upload(request.user, request.headers.get('Upload-Length'), metadata)
+        except UploadError as e:
+            return self._error(e)
+        return self._tus_response(
+            status.HTTP_201_CREATED,
+            session,
+            data={'id': str(session.id)},
+            Location=request.build_absolute_uri(reverse('uploads-detail', kwargs={'pk': session.id})),
+        )
+    
+    def retrieve(self, request, pk=None):
+        """Upload progress; also answers HEAD, which clients use to find where to resume."""
+        session = get_object_or_404(self._sessions(request), pk=pk)
+        if request.method == 'HEAD':
+            return self._tus_response(status.HTTP_200_OK, session)
+        return self._tus_response(status.HTTP_200_OK, session, data={
+            'id': str(session.id),
+            'record': str(session.record_id),
+            'field': session.field,
+            'offset': session.offset,
+            'length': session.length,
+            'status': session.status,
+            'sha256': session.sha256,
+        })
+    
+    def partial_update(self, request, pk=None):
+        """Append a chunk (Content-Type: application/offset+octet-stream) at Upload-Offset."""
+        session = get_object_or_404(self._sessions(request), pk=pk)
+        if request.content_type != 'application/offset+octet-stream':
+            return self._error(UploadError("Content-Type must be application/offset+octet-stream", status=415))
+        try:
+            resumable.append_chunk(
+                session,
+                request.headers.get('Upload-Offset'),
+                request._request,
+                request.headers.get('Upload-Checksum'),
+            )
+        except UploadError as e:
+            return self._error(e)
+        return self._tus_response(session=session)
+    
+    def destroy(self, request, pk=None):
+        """Abandon an upload and delete its received bytes."""
+        session = get_object_or_404(self._sessions(request), pk=pk, status=UploadSession.Status.UPLOADING)
+        try:
+            with resumable.upload_lock(session):
+                resumable.discard_upload(session)
+        except UploadError as e:
+            return self._error(e)
+        return self._tus_response()
+
+
+class DirectUploadViewSet(viewsets.ViewSet):
+    """Presigned uploads straight to the document bucket; workers never see the bytes."""
+    permission_classes = [IsAuthenticated]
+    
+    def create(self, request):
+        """Issue a presigned POST (or PUT) for one record document field."""
+        serializer = DirectUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        try:
+            upload = direct_uploads.issue_upload(
+                request.user,
+                data['record_id'],
+                data['field'],
+                data['filename'],
+                data['content_type'],
+                data['size'],
+                data['sha256'].lower(),
+                method=data['method'],
+            )
+        except UploadError as e:
+            return Response({'error': str(e)}, status=e.status)
+        return Response(upload, status=status.HTTP_201_CREATED)
+    
+    @action(detail=False, methods=['post'])
+    def complete(self, request):
+        """Validate the uploaded object and attach it to the record."""
+        serializer = DirectUploadCompleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            record = direct_uploads.complete_upload(request.user, serializer.validated_data['token'])
+        except UploadError as e:
+            return Response({'error': str(e)}, status=e.status)
+        return Response(RTORecordSerializer(record, context={'request': request}).data)
@@ -0,0 +1,18 @@
+"""System checks for core settings."""
+from django.conf import settings
+from django.core.checks import Warning, register
+
+from .signed_urls import is_absolute_base
+
+
+@register()
+def check_signed_url_base(app_configs, **kwargs):
+    """Published galleries should link back to a fixed, absolute app URL."""
+    if is_absolute_base(settings.SIGNED_URL_BASE):
+        return []
+    return [Warning(
+        "SIGNED_URL_BASE is not an absolute URL.",
+        hint="Set it to the app's public URL (e.g. https://app.example.com). Until then published galleries "
+             "link to the host of the request that published them.",
+        id='core.W001',
+    )]
@@ -0,0 +1,91 @@
+"""
+Responsive delivery URLs for documents hosted on Cloudinary.
+
+Records created through the upload widget store the ``secure_url`` of the
+original asset, so a gallery would send phones the full-size file. Cloudinary
+resizes and re-encodes on the fly when a transformation component is added
+after the delivery type:
+
+    https://res.cloudinary.com/<cloud>/image/upload/v1712/folder/id.jpg
+    https://res.cloudinary.com/<cloud>/image/upload/f_auto,q_auto,c_limit,w_640/v1712/folder/id.jpg
+
+``f_auto`` picks WebP/AVIF per browser and ``q_auto`` the quality, so one
+``srcset`` over CLOUDINARY_SRCSET_WIDTHS replaces the WebP/JPEG pair used for
+locally rendered variants. PDFs get page 1 as an image (``pg_1``). Raw and
+video assets, signed URLs and non-Cloudinary URLs are left alone.
+"""
+import re
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+DELIVERY_HOSTS = {'res.cloudinary.com'}
+# Delivery types whose URLs can carry transformations without a signature
+TRANSFORMABLE_TYPES = {'upload', 'fetch'}
+TRANSFORMATION = re.compile(r'^([a-z]{1,3}_[^,/]+)(,[a-z]{1,3}_[^,/]+)*$')
+VERSION = re.compile(r'^v\d+$')
+
+
+@dataclass
+class CloudinaryAsset:
+    prefix: str  # scheme://host/<cloud>/<resource_type>/<type>
+    transformations: list
+    path: str  # [v<version>/]<public_id>.<ext>
+
+    @property
+    def is_pdf(self):
+        return self.path.lower().endswith('.pdf')
+
+
+def parse(url):
+    """A CloudinaryAsset for a transformable image delivery URL, or None."""
+    parts = urlsplit(url)
+    if parts.hostname not in DELIVERY_HOSTS or parts.query:
+        return None
+    segments = parts.path.lstrip('/').split('/')
+    if len(segments) < 4:
+        return None
+    cloud, resource_type, delivery_type, *rest = segments
+    if resource_type != 'image' or delivery_type not in TRANSFORMABLE_TYPES:
+        return None
+    transformations = []
+    while len(rest) > 1 and TRANSFORMATION.match(rest[0]) and not VERSION.match(rest[0]):
+        transformations.append(rest.pop(0))
+    if rest[0].startswith('s--'):
+        return None
+    return CloudinaryAsset(
+        prefix=f"{parts.scheme}://{parts.netloc}/{cloud}/{resource_type}/{delivery_type}",
+        transformations=transformations,
+        path='/'.join(rest),
+    )
+
+
+def transformed_url(url, width=None):
+    """``url`` resized to ``width`` (never upscaled) in the best format for the browser, or None if not possible."""
+    asset = parse(url)
+    if asset is None:
+        return None
+    params = ['f_auto', 'q_auto']
+    path = asset.path
+    if asset.is_pdf:
+        params.insert(0, 'pg_1')
+        path = path[:-len('.pdf')] + '.jpg'
+    if width:
+        params += ['c_limit', f"w_{width}"]
+    return '/'.join([asset.prefix, *asset.transformations, ','.join(params), path])
+
+
+def cloudinary_srcset(url, widths=None):
+    """``srcset`` attribute value of transformed widths of ``url``, or '' if it is not a Cloudinary image."""
+    if parse(url) is None:
+        return ''
+    widths = widths or settings.CLOUDINARY_SRCSET_WIDTHS
+    return ", ".join(f"{transformed_url(url, width)} {width}w" for width in widths)
+
+
+def cloudinary_sources(url, fallback_width=640):
+    """``src``/``srcset`` entries for sources_for(), or {} if ``url`` cannot be transformed."""
+    if parse(url) is None:
+        return {}
+    return {'src': transformed_url(url, fallback_width), 'srcset': cloudinary_srcset(url)}
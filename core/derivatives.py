@@ -0,0 +1,409 @@
+"""
+Resized WebP/JPEG variants and PDF previews of uploaded documents.
+
+Camera photos are stored at full resolution, but galleries and record pages
+only show them in small cards. After a record's documents change,
+``schedule_record_derivatives`` renders each image at DOCUMENT_DERIVATIVE_WIDTHS
+in a process pool (decoding is CPU-bound and holds the GIL) and stores the
+variant URLs on the document's ``RecordDocument.derivatives``; templates build
+``srcset`` attributes from them with the ``documents`` template tags.
+
+PDFs get the same treatment for a raster of page 1 (with PyMuPDF, falling
+back to poppler's ``pdftoppm`` if it is missing), so galleries can show a
+lightweight preview and fetch the full PDF only on demand; the entry also
+records the page count, page size and file size.
+
+JPEGs are opened with ``Image.draft()`` so the decoder scales down by a power
+of two while decoding, keeping memory bounded to roughly the largest variant
+rather than the full camera frame.
+
+Variants of content-addressed documents live under
+``derivatives/<aa>/<sha256>/`` and are shared by every record referencing
+the same file, like the document itself. With a remote document storage (S3)
+the source is read through ``file_cache()`` and the variants are rendered
+into a staging directory, then uploaded through the storage API.
+"""
+import hashlib
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from PIL import Image, ImageOps
+
+from .cloudinary_urls import cloudinary_sources
+from .duplicates import dhash
+from .storage import digest_from_name
+
+DERIVATIVE_PREFIX = 'derivatives/'
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+FORMATS = (('webp', 'WEBP'), ('jpeg', 'JPEG'))
+
+# Seconds allowed for rasterizing one PDF page with poppler
+PDF_RENDER_TIMEOUT = 60
+
+# EXIF orientations that swap width and height
+_TRANSPOSED = {5, 6, 7, 8}
+
+
+def _flatten(img):
+    """Drop alpha/palette onto a white background so the image can be saved as JPEG."""
+    if img.mode in ('RGB', 'L'):
+        return img
+    background = Image.new('RGB', img.size, 'white')
+    background.paste(img, mask=img.convert('RGBA').getchannel('A'))
+    return background
+
+
+def _write_variants(img, targets, output_dir, quality):
+    os.makedirs(output_dir, exist_ok=True)
+    variants = []
+    for target in targets:
+        size = (target, max(1, round(img.height * target / img.width)))
+        resized = img if size == img.size else img.resize(size, Image.LANCZOS)
+        for key, pil_format in FORMATS:
+            path = os.path.join(output_dir, f"{target}.{key}")
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            resized.save(temp_path, pil_format, quality=quality, optimize=True)
+            os.replace(temp_path, path)
+        variants.append({'width': size[0], 'height': size[1]})
+    return variants
+
+
+def render_variants(source_path, output_dir, widths, quality):
+    """Write WebP and JPEG variants of an image at each width. Runs in a worker process."""
+    with Image.open(source_path) as img:
+        swapped = img.getexif().get(0x0112) in _TRANSPOSED
+        width, height = (img.height, img.width) if swapped else img.size
+        targets = sorted({w for w in widths if w < width})
+        if width < max(widths):
+            # Smaller than the largest variant: keep a copy at native width instead of upscaling
+            targets.append(width)
+        if img.format == 'JPEG':
+            # Let the decoder downscale by 1/2, 1/4 or 1/8 to no smaller than the largest variant
+            largest = targets[-1]
+            request = (largest, max(1, round(height * largest / width)))
+            img.draft('RGB', request[::-1] if swapped else request)
+        img = _flatten(ImageOps.exif_transpose(img))
+        variants = _write_variants(img, targets, output_dir, quality)
+        # Perceptual hash for duplicate detection, from the already decoded image
+        image_hash = dhash(img)
+    return {'width': width, 'height': height, 'variants': variants, 'dhash': f"{image_hash:016x}"}
+
+
+class PreviewUnavailable(Exception):
+    """Raised when no PDF rasterizer (PyMuPDF or poppler's pdftoppm) is installed."""
+
+
+def _rasterize_with_pdftoppm(source_path, width):
+    """Render page 1 with poppler-utils. Returns (image, page_count, page_size_in_points)."""
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            prefix = os.path.join(tmp, 'page')
+            subprocess.run(
+                ['pdftoppm', '-f', '1', '-l', '1', '-singlefile', '-png',
+                 '-scale-to-x', str(width), '-scale-to-y', '-1', source_path, prefix],
+                check=True, capture_output=True, timeout=PDF_RENDER_TIMEOUT,
+            )
+            with Image.open(f"{prefix}.png") as rendered:
+                img = rendered.convert('RGB')
+            info = subprocess.run(
+                ['pdfinfo', source_path],
+                check=True, capture_output=True, text=True, timeout=PDF_RENDER_TIMEOUT,
+            ).stdout
+    except FileNotFoundError:
+        raise PreviewUnavailable("Install PyMuPDF or poppler-utils to render PDF previews")
+    pages, page_size = None, None
+    for line in info.splitlines():
+        key, _, value = line.partition(':')
+        if key == 'Pages':
+            pages = int(value)
+        elif key == 'Page size':
+            dims = value.split()
+            page_size = [float(dims[0]), float(dims[2])]
+    return img, pages, page_size
+
+
+def render_pdf_preview(source_path, output_dir, widths, quality):
+    """Rasterize page 1 of a PDF and write WebP and JPEG variants. Runs in a worker process."""
+    largest = max(widths)
+    try:
+        import pymupdf
+    except ImportError:  # PyMuPDF is in requirements.txt; pdftoppm covers bare installs
+        pymupdf = None
+    if pymupdf is not None:
+        with pymupdf.open(source_path) as doc:
+            page = doc[0]
+            zoom = largest / page.rect.width
+            pixmap = page.get_pixmap(matrix=pymupdf.Matrix(zoom, zoom), alpha=False)
+            img = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+            pages, page_size = doc.page_count, [page.rect.width, page.rect.height]
+    else:
+        img, pages, page_size = _rasterize_with_pdftoppm(source_path, largest)
+    variants = _write_variants(img, sorted({w for w in widths if w <= img.width}), output_dir, quality)
+    return {
+        'width': img.width,
+        'height': img.height,
+        'variants': variants,
+        'pages': pages,
+        'page_size': page_size,
+        'size': os.path.getsize(source_path),
+    }
+
+
+def derivative_dir(name):
+    """Storage-relative directory holding the variants of a document."""
+    digest = digest_from_name(name) or hashlib.sha256(name.encode()).hexdigest()
+    return f"{DERIVATIVE_PREFIX}{digest[:2]}/{digest}"
+
+
+def remove_derivatives(name):
+    """Delete every variant of a document."""
+    from .storage import document_storage, local_path
+    storage = document_storage()
+    base = derivative_dir(name)
+    path = local_path(storage, base)
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    try:
+        _, files = storage.listdir(base)
+    except FileNotFoundError:
+        return
+    for filename in files:
+        storage.delete(f"{base}/{filename}")
+
+
+def is_image(name):
+    return os.path.splitext(name or '')[1].lower() in IMAGE_EXTENSIONS
+
+
+def is_pdf(name):
+    return os.path.splitext(name or '')[1].lower() == '.pdf'
+
+
+def srcset(entry, key):
+    """``srcset`` attribute value for one format of a derivatives entry."""
+    return ", ".join(f"{variant[key]} {variant['width']}w" for variant in entry['variants'])
+
+
+def sources_for(document, fallback_width=640, signed=None, variant_url=None):
+    """URLs for rendering a RecordDocument responsively.
+
+    Returns a dict with ``url`` (the original), ``src`` (a mid-sized JPEG for
+    browsers ignoring srcset) and ``webp_srcset``/``jpeg_srcset``; the srcset
+    values are empty until the variants have been rendered. For PDFs the
+    variants are a preview of page 1, and ``pages``/``size`` describe the file.
+    Cloudinary documents get a single format-negotiated ``srcset`` instead.
+    ``signed`` is a (url, download_url) pair from core.signed_urls to use
+    instead of the document's own URLs, and ``variant_url(width, format)``
+    replaces the stored variant URLs.
+    """
+    url, download_url = signed or (document.url, document.download_url)
+    sources = {
+        'url': url, 'src': url, 'webp_srcset': '', 'jpeg_srcset': '', 'srcset': '',
+        'download_url': download_url,
+        'is_pdf': document.is_pdf or is_pdf(document.storage_key.split('?')[0]),
+        'pages': None, 'size': document.size,
+        'kind': document.kind, 'label': document.get_kind_display(),
+    }
+    if document.is_external:
+        sources.update(cloudinary_sources(url, fallback_width))
+        return sources
+    entry = document.derivatives
+    if not entry or entry.get('source') != document.storage_key:
+        return sources
+    if variant_url:
+        entry = {**entry, 'variants': [
+            {**variant, **{key: variant_url(variant['width'], key) for key, _ in FORMATS}}
+            for variant in entry['variants']
+        ]}
+    fitting = [v for v in entry['variants'] if v['width'] <= fallback_width] or entry['variants'][:1]
+    sources.update(
+        src=fitting[-1]['jpeg'],
+        webp_srcset=srcset(entry, 'webp'),
+        jpeg_srcset=srcset(entry, 'jpeg'),
+        pages=entry.get('pages'),
+        size=entry.get('size') or document.size,
+    )
+    return sources
+
+
+def document_sources(record, kind):
+    """sources_for() the record's document of a kind (uses prefetched documents when available)."""
+    document = next((d for d in record.documents.all() if d.kind == kind), None)
+    if document is None:
+        return {'url': '', 'src': '', 'webp_srcset': '', 'jpeg_srcset': '', 'srcset': '', 'download_url': '', 'is_pdf': False,
+                'pages': None, 'size': None, 'kind': kind, 'label': ''}
+    return sources_for(document)
+
+
+_pool = None
+_writer = None
+_pool_lock = threading.Lock()
+
+
+def _executors():
+    """Process pool for rendering and a single thread that feeds it and writes results."""
+    global _pool, _writer
+    from django.conf import settings
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: forking a threaded server process can deadlock the child
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.DOCUMENT_DERIVATIVE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+            _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='derivatives')
+    return _pool, _writer
+
+
+def pending_jobs(record, force=False):
+    """Stored image and PDF documents of a record whose variants are missing or stale, as {kind: name}."""
+    jobs = {}
+    for document in record.documents.all():
+        name = document.storage_key
+        if document.is_external or not (is_image(name) or is_pdf(name)):
+            continue
+        if not force and document.derivatives.get('source') == name:
+            continue
+        jobs[document.kind] = name
+    return jobs
+
+
+def _job(name):
+    """(render function, args) for a stored document, or None if its file is missing.
+
+    Remote documents are fetched through the file cache and rendered into a
+    staging directory for ``_publish``.
+    """
+    from django.conf import settings
+    from .file_cache import file_cache
+    from .storage import document_storage, local_path
+    storage = document_storage()
+    try:
+        source_path = file_cache().local_path(storage, name)
+    except (FileNotFoundError, OSError) as e:
+        print(f"❌ Can't read {name} for derivatives: {e}")
+        return None
+    if not os.path.exists(source_path):
+        return None
+    if is_pdf(name):
+        render, widths = render_pdf_preview, settings.DOCUMENT_PREVIEW_WIDTHS
+    else:
+        render, widths = render_variants, settings.DOCUMENT_DERIVATIVE_WIDTHS
+    output_dir = local_path(storage, derivative_dir(name)) or tempfile.mkdtemp(prefix='derivatives-')
+    return render, (source_path, output_dir, widths, settings.DOCUMENT_DERIVATIVE_QUALITY)
+
+
+def _publish(name, output_dir, upload=True):
+    """Upload variants rendered into a staging directory to a remote document storage and remove the directory.
+
+    Local storages were written in place, so there is nothing to do for them.
+    """
+    from django.core.files import File
+    from .storage import document_storage, local_path
+    storage = document_storage()
+    base = derivative_dir(name)
+    if local_path(storage, base) is not None:
+        return
+    try:
+        for filename in os.listdir(output_dir) if upload else ():
+            with open(os.path.join(output_dir, filename), 'rb') as f:
+                storage.save_exact(f"{base}/{filename}", File(f))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def _entry(name, result):
+    from .storage import document_storage
+    storage = document_storage()
+    base = derivative_dir(name)
+    return {
+        'source': name,
+        **{key: value for key, value in result.items() if key not in ('variants', 'dhash')},
+        'variants': [
+            {**variant, **{key: storage.url(f"{base}/{variant['width']}.{key}") for key, _ in FORMATS}}
+            for variant in result['variants']
+        ],
+    }
+
+
+def save_derivatives(record_id, results):
+    """Store rendered variants (and image hashes) on their documents, skipping documents replaced meanwhile."""
+    from .duplicates import flag_duplicates, hash_fields
+    from .models import RecordDocument
+    for kind, (name, result) in results.items():
+        documents = RecordDocument.objects.filter(record_id=record_id, kind=kind, storage_key=name)
+        fields = hash_fields(int(result['dhash'], 16)) if result.get('dhash') else {}
+        documents.update(derivatives=_entry(name, result), **fields)
+        if fields:
+            for document in documents.select_related('record'):
+                flag_duplicates(document)
+
+
+def build_record_derivatives(record, force=False):
+    """Render a record's missing variants in this process and save them."""
+    results = {}
+    for kind, name in pending_jobs(record, force).items():
+        job = _job(name)
+        if job is None:
+            continue
+        render, args = job
+        try:
+            result = render(*args)
+            _publish(name, args[1])
+            results[kind] = (name, result)
+        except Exception as e:
+            _publish(name, args[1], upload=False)
+            print(f"❌ Derivatives failed for {record.id} {kind}: {e}")
+    if results:
+        save_derivatives(record.id, results)
+    return results
+
+
+def _render_and_save(record_id, jobs):
+    """Fetch sources, render them in the process pool, upload and save the variants. Runs on the writer thread."""
+    from django.db import connection
+    pool, _ = _executors()
+    try:
+        futures = {}
+        for kind, name in jobs.items():
+            job = _job(name)
+            if job is not None:
+                render, args = job
+                futures[kind] = (name, args[1], pool.submit(render, *args))
+        wait([future for _, _, future in futures.values()])
+        results = {}
+        for kind, (name, output_dir, future) in futures.items():
+            try:
+                result = future.result()
+                _publish(name, output_dir)
+                results[kind] = (name, result)
+            except Exception as e:
+                _publish(name, output_dir, upload=False)
+                print(f"❌ Derivatives failed for {record_id} {kind}: {e}")
+        if results:
+            save_derivatives(record_id, results)
+    finally:
+        connection.close()
+
+
+def schedule_record_derivatives(record_id):
+    """Render a record's missing variants in the background (inline if workers are disabled)."""
+    from django.conf import settings
+    from .models import RTORecord
+    record = RTORecord.objects.prefetch_related('documents').filter(pk=record_id).first()
+    if record is None:
+        return
+    if settings.DOCUMENT_DERIVATIVE_WORKERS <= 0:
+        build_record_derivatives(record)
+        return
+    jobs = pending_jobs(record)
+    if not jobs:
+        return
+    _, writer = _executors()
+    writer.submit(_render_and_save, record_id, jobs)
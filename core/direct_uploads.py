@@ -0,0 +1,211 @@
+"""
+Presigned direct-to-bucket uploads for record documents.
+
+Instead of streaming document bytes through a web worker, a client asks
+``POST /api/direct-uploads/`` for a short-lived presigned POST (or PUT)
+scoped to one record field, a size limit and a content type, uploads the
+file straight to the S3-compatible bucket, then calls
+``POST /api/direct-uploads/complete/`` with the returned token.
+
+The client declares the file's SHA-256 up front and it is signed into the
+upload, so the bucket verifies the bytes as they arrive. Completion checks the
+object's size, type and stored checksum from its metadata (plus a 16-byte
+ranged read to sniff the magic number), then server-side copies it to its
+content-addressed key and attaches it to the record. Workers only ever
+handle small JSON requests.
+
+Requires ``DOCUMENT_STORAGE_BACKEND = 's3'``.
+"""
+import base64
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.template.defaultfilters import filesizeformat
+
+from .models import RTORecord, StoredBlob
+from .quotas import QuotaExceeded, check_quota, replaced_bytes
+from .resumable import UploadError
+from .storage import cas_name, document_storage, storage_key
+from .uploads import IMAGE_FIELDS, field_rules, sniff_type
+
+SIGNING_SALT = 'core.direct_uploads'
+
+CONTENT_TYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'pdf': 'application/pdf',
+}
+
+_client = None
+
+
+def s3_client():
+    """boto3 S3 client for the document bucket (created once per process)."""
+    global _client
+    if _client is None:
+        import boto3
+        _client = boto3.client(
+            's3',
+            region_name=settings.AWS_S3_REGION_NAME,
+            endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+        )
+    return _client
+
+
+def direct_uploads_enabled():
+    return settings.DOCUMENT_STORAGE_BACKEND == 's3' and bool(settings.AWS_STORAGE_BUCKET_NAME)
+
+
+def _allowed_content_types(field):
+    _, allowed_types = field_rules(field)
+    return {CONTENT_TYPES[kind] for kind in allowed_types}
+
+
+def _owned_record(user, record_id):
+    try:
+        record = RTORecord.objects.filter(pk=record_id, owner=user).first()
+    except (ValueError, ValidationError):
+        record = None
+    if record is None:
+        raise UploadError("Record not found", status=404)
+    return record
+
+
+def issue_upload(user, record_id, field, filename, content_type, size, sha256, method='post'):
+    """Presign an upload of one document. Returns the URL/fields/headers to use and a completion token."""
+    if not direct_uploads_enabled():
+        raise UploadError("Direct uploads need DOCUMENT_STORAGE_BACKEND = 's3'", status=503)
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256 or ''):
+        raise UploadError("sha256 must be the hex SHA-256 of the file")
+    if field not in RTORecord.DOCUMENT_FIELDS:
+        raise UploadError(f"field must be one of: {', '.join(RTORecord.DOCUMENT_FIELDS)}")
+    record = _owned_record(user, record_id)
+    ext = os.path.splitext(filename)[1].lower()
+    allowed_extensions = settings.ALLOWED_IMAGE_EXTENSIONS if field in IMAGE_FIELDS else settings.ALLOWED_DOCUMENT_EXTENSIONS
+    if ext.lstrip('.') not in allowed_extensions:
+        raise UploadError(f"File extension '{ext}' is not allowed for {field}")
+    if content_type not in _allowed_content_types(field):
+        raise UploadError(f"Content type '{content_type}' is not allowed for {field}", status=415)
+    max_size, _ = field_rules(field)
+    if not 0 < size <= max_size:
+        raise UploadError(f"File too large (limit {filesizeformat(max_size)}).", status=413)
+    try:
+        check_quota(user, size, released=replaced_bytes(record, [field]))
+    except QuotaExceeded as e:
+        raise UploadError(str(e), status=413)
+
+    key = f"{settings.DIRECT_UPLOAD_PREFIX}{user.id}/{uuid.uuid4().hex}{ext}"
+    checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+    client = s3_client()
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    expires = settings.DIRECT_UPLOAD_EXPIRY_SECONDS
+
+    if method == 'put':
+        params = {
+            'Bucket': bucket, 'Key': key, 'ContentType': content_type, 'ContentLength': size,
+            'ChecksumSHA256': checksum,
+        }
+        headers = {'Content-Type': content_type, 'x-amz-checksum-sha256': checksum}
+        upload = {
+            'method': 'PUT',
+            'url': client.generate_presigned_url('put_object', Params=params, ExpiresIn=expires),
+            'headers': headers,
+        }
+    else:
+        fields = {'Content-Type': content_type, 'x-amz-checksum-sha256': checksum}
+        conditions = [
+            {'Content-Type': content_type},
+            {'x-amz-checksum-sha256': checksum},
+            ['content-length-range', 1, max_size],
+        ]
+        post = client.generate_presigned_post(
+            bucket, key, Fields=fields, Conditions=conditions, ExpiresIn=expires,
+        )
+        upload = {'method': 'POST', 'url': post['url'], 'fields': post['fields']}
+
+    upload['expires_in'] = expires
+    upload['token'] = signing.dumps({
+        'user': user.pk,
+        'record': str(record.id),
+        'field': field,
+        'key': key,
+        'size': size,
+        'content_type': content_type,
+        'sha256': sha256,
+    }, salt=SIGNING_SALT)
+    return upload
+
+
+def _object_sha256(head):
+    """Hex SHA-256 the bucket stored for a whole object, or None (no checksum, or a multipart one)."""
+    checksum = head.get('ChecksumSHA256')
+    if not checksum or '-' in checksum:
+        return None
+    return base64.b64decode(checksum).hex()
+
+
+def complete_upload(user, token):
+    """Validate an uploaded object against its token and attach it to the record field."""
+    from botocore.exceptions import ClientError
+
+    try:
+        upload = signing.loads(token, salt=SIGNING_SALT, max_age=settings.DIRECT_UPLOAD_COMPLETE_WINDOW)
+    except signing.BadSignature:
+        raise UploadError("Invalid or expired upload token", status=403)
+    if upload['user'] != user.pk:
+        raise UploadError("Invalid or expired upload token", status=403)
+
+    client = s3_client()
+    bucket = settings.AWS_STORAGE_BUCKET_NAME
+    key = upload['key']
+    try:
+        head = client.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED')
+    except ClientError:
+        raise UploadError("Upload not found; upload the file before completing", status=404)
+
+    def reject(message, status=400):
+        client.delete_object(Bucket=bucket, Key=key)
+        raise UploadError(message, status=status)
+
+    field = upload['field']
+    _, allowed_types = field_rules(field)
+    if head['ContentLength'] != upload['size']:
+        reject(f"Uploaded size {head['ContentLength']} does not match the declared {upload['size']} bytes")
+    if head.get('ContentType') != upload['content_type']:
+        reject("Uploaded content type does not match the declared one", status=415)
+    head_bytes = client.get_object(Bucket=bucket, Key=key, Range='bytes=0-15')['Body'].read()
+    kind = sniff_type(head_bytes)
+    if kind not in allowed_types or CONTENT_TYPES[kind] != upload['content_type']:
+        reject("File content does not match its content type", status=415)
+
+    sha256 = upload['sha256']
+    if _object_sha256(head) != sha256:
+        reject("Checksum of the uploaded file does not match", status=460)
+
+    storage = document_storage()
+    name = cas_name(sha256, os.path.splitext(key)[1])
+    # Hold a reference to an existing copy so it isn't deleted before the record is saved
+    StoredBlob.reserve(name)
+    if not storage.exists(name):
+        client.copy_object(
+            Bucket=bucket,
+            Key=storage_key(storage, name),
+            CopySource={'Bucket': bucket, 'Key': key},
+            ContentType=upload['content_type'],
+            MetadataDirective='REPLACE',
+        )
+    client.delete_object(Bucket=bucket, Key=key)
+
+    with transaction.atomic():
+        record = _owned_record(user, upload['record'])
+        record = RTORecord.objects.select_for_update().get(pk=record.pk)
+        setattr(record, field, name)
+        record.save()
+    return record
@@ -0,0 +1,331 @@
+"""
+Order status events for the server-sent events endpoint.
+
+Fulfillment code publishes status transitions (paid, gallery published, QR
+ready, PDF ready) on a per-order channel; ``order_events_view`` streams them
+to the browser. Three interchangeable buses are provided, selected with
+``ORDER_EVENTS_BACKEND``:
+
+* ``memory`` - in-process, for development and tests (a single process only)
+* ``cache``  - the shared Django cache (polled), works across processes
+* ``redis``  - Redis lists + pub/sub, pushes without polling (the default)
+
+Each channel keeps a short history so a client connecting (or reconnecting
+with ``Last-Event-ID``) after an event was published still receives it.
+
+A stream follows its order through ``bus.subscribe(channel)``, held for the
+stream's lifetime: the Redis bus subscribes once per stream, on one async
+client per process, instead of reconnecting on every heartbeat.
+"""
+import asyncio
+import json
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+PAID = 'paid'
+GALLERY_PUBLISHED = 'gallery_published'
+QR_READY = 'qr_ready'
+PDF_READY = 'pdf_ready'
+FAILED = 'failed'
+
+# Events after which nothing further is published for an order
+TERMINAL_EVENTS = {PDF_READY, FAILED}
+
+
+def _event(seq, event_type, data):
+    return {'id': seq, 'type': event_type, 'data': data or {}, 'ts': time.time()}
+
+
+class ChannelSubscription:
+    """A stream's subscription to one channel, for buses that keep no per-stream state."""
+
+    def __init__(self, bus, channel):
+        self.bus = bus
+        self.channel = channel
+
+    async def wait(self, after, timeout):
+        return await self.bus.wait(self.channel, after, timeout)
+
+
+class EventBus:
+    """Base for event buses: publish(), history() and wait() on per-order channels."""
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        """Follow a channel for the lifetime of one stream; yields an object with wait(after, timeout)."""
+        yield ChannelSubscription(self, channel)
+
+
+class InMemoryEventBus(EventBus):
+    """Per-process event bus; subscribers are woken directly by publishers.
+
+    Channels idle for longer than ``ttl`` are dropped, and at most
+    ``max_channels`` are kept (least recently published dropped first).
+    """
+
+    def __init__(self, history_size=50, max_channels=None, ttl=None):
+        self.history_size = history_size
+        self.max_channels = max_channels or settings.ORDER_EVENTS_MAX_CHANNELS
+        self.ttl = ttl or settings.ORDER_EVENTS_TTL
+        # channel -> (monotonic time of last publish, events), least recently published first
+        self.channels = OrderedDict()
+        self.waiters = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self.channels:
+            channel, (published, _) = next(iter(self.channels.items()))
+            if len(self.channels) <= self.max_channels and now - published < self.ttl:
+                break
+            del self.channels[channel]
+
+    def publish(self, channel, event_type, data=None):
+        now = time.monotonic()
+        with self._lock:
+            _, history = self.channels.pop(channel, (now, []))
+            seq = history[-1]['id'] + 1 if history else 1
+            history.append(_event(seq, event_type, data))
+            del history[:-self.history_size]
+            self.channels[channel] = (now, history)
+            self._evict(now)
+            waiters = self.waiters.pop(channel, [])
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(waiter.set)
+
+    def history(self, channel, after=0):
+        with self._lock:
+            self._evict(time.monotonic())
+            _, events = self.channels.get(channel, (0, []))
+            return [event for event in events if event['id'] > after]
+
+    async def wait(self, channel, after, timeout):
+        waiter = asyncio.Event()
+        with self._lock:
+            self.waiters.setdefault(channel, []).append((asyncio.get_running_loop(), waiter))
+        try:
+            pending = self.history(channel, after)
+            if not pending:
+                try:
+                    await asyncio.wait_for(waiter.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                pending = self.history(channel, after)
+            return pending
+        finally:
+            with self._lock:
+                waiters = self.waiters.get(channel, [])
+                self.waiters[channel] = [w for w in waiters if w[1] is not waiter]
+                if not self.waiters[channel]:
+                    del self.waiters[channel]
+
+
+class CacheEventBus(EventBus):
+    """Event bus on the shared Django cache; subscribers poll a sequence counter."""
+
+    def __init__(self, ttl=None, poll_interval=None):
+        self.ttl = ttl or settings.ORDER_EVENTS_TTL
+        self.poll_interval = poll_interval or settings.ORDER_EVENTS_POLL_INTERVAL
+
+    @property
+    def cache(self):
+        return caches['shared']
+
+    def _key(self, channel, suffix):
+        return f'order_events:{channel}:{suffix}'
+
+    def publish(self, channel, event_type, data=None):
+        seq_key = self._key(channel, 'seq')
+        self.cache.add(seq_key, 0, self.ttl)
+        seq = self.cache.incr(seq_key)
+        self.cache.touch(seq_key, self.ttl)
+        self.cache.set(self._key(channel, seq), _event(seq, event_type, data), self.ttl)
+
+    def history(self, channel, after=0):
+        seq = self.cache.get(self._key(channel, 'seq')) or 0
+        if seq <= after:
+            return []
+        events = self.cache.get_many([self._key(channel, n) for n in range(after + 1, seq + 1)])
+        return sorted(events.values(), key=lambda event: event['id'])
+
+    async def wait(self, channel, after, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            seq = await self.cache.aget(self._key(channel, 'seq')) or 0
+            if seq > after:
+                events = await self.cache.aget_many([self._key(channel, n) for n in range(after + 1, seq + 1)])
+                return sorted(events.values(), key=lambda event: event['id'])
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+
+class RedisSubscription:
+    """One stream's pub/sub subscription to a channel, kept across heartbeats."""
+
+    def __init__(self, bus, client, pubsub, channel):
+        self.bus = bus
+        self.client = client
+        self.pubsub = pubsub
+        self.key = bus._key(channel)
+        self.caught_up = False
+
+    async def wait(self, after, timeout):
+        if not self.caught_up:
+            # Read history once, after subscribing, so nothing published before or in between is lost
+            self.caught_up = True
+            events = [json.loads(raw) for raw in await self.client.lrange(self.key, 0, -1)]
+            pending = [event for event in events if event['id'] > after]
+            if pending:
+                return pending
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+            if message:
+                event = json.loads(message['data'])
+                if event['id'] > after:
+                    return [event]
+        return []
+
+
+class RedisEventBus(EventBus):
+    """Event bus on Redis: a capped list per channel for history plus pub/sub for wakeups."""
+
+    def __init__(self, url=None, ttl=None):
+        self.url = url or settings.ORDER_EVENTS_REDIS_URL
+        self.ttl = ttl or settings.ORDER_EVENTS_TTL
+        self._client = None
+        # Async clients are bound to the event loop they connect on: one per loop, so one per ASGI process
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def _key(self, channel):
+        return f'order_events:{channel}'
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def async_client(self):
+        """redis.asyncio client (and connection pool) shared by every stream on the running loop."""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            import redis.asyncio as aioredis
+            client = self._async_clients[loop] = aioredis.Redis.from_url(self.url)
+        return client
+
+    def publish(self, channel, event_type, data=None):
+        key = self._key(channel)
+        seq = self.client.incr(f'{key}:seq')
+        payload = json.dumps(_event(seq, event_type, data))
+        pipe = self.client.pipeline()
+        pipe.rpush(key, payload)
+        pipe.ltrim(key, -50, -1)
+        pipe.expire(key, self.ttl)
+        pipe.expire(f'{key}:seq', self.ttl)
+        pipe.publish(key, payload)
+        pipe.execute()
+
+    def history(self, channel, after=0):
+        events = [json.loads(raw) for raw in self.client.lrange(self._key(channel), 0, -1)]
+        return [event for event in events if event['id'] > after]
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        client = self.async_client()
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(self._key(channel))
+            yield RedisSubscription(self, client, pubsub, channel)
+        finally:
+            # Returns the connection to the shared pool
+            await pubsub.aclose()
+
+    async def wait(self, channel, after, timeout):
+        async with self.subscribe(channel) as subscription:
+            return await subscription.wait(after, timeout)
+
+
+BACKENDS = {
+    'memory': 'core.events.InMemoryEventBus',
+    'cache': 'core.events.CacheEventBus',
+    'redis': 'core.events.RedisEventBus',
+}
+
+_bus = None
+
+
+def get_event_bus():
+    """Return the configured event bus (created once per process)."""
+    global _bus
+    if _bus is None:
+        backend = settings.ORDER_EVENTS_BACKEND
+        _bus = import_string(BACKENDS.get(backend, backend))()
+    return _bus
+
+
+def publish_order_event(order, event_type, **data):
+    """Publish a status transition for an order. Never raises into the caller."""
+    try:
+        get_event_bus().publish(order.order_id, event_type, data)
+    except Exception as e:
+        print(f"❌ Failed to publish {event_type} for order {order.order_id}: {e}")
+
+
+def snapshot_events(order):
+    """Events implied by the order's current DB state, for clients arriving after history expired."""
+    record = order.rto_record
+    events = []
+    if order.payment_status == order.Status.COMPLETED:
+        events.append(PAID)
+        if record.gallery_html_url:
+            events.append(GALLERY_PUBLISHED)
+        if record.qr_code_image:
+            events.extend([QR_READY, PDF_READY])
+    elif order.payment_status == order.Status.FAILED:
+        events.append(FAILED)
+    return events
+
+
+def _format(event_type, data, event_id=None):
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event_type}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_order_events(order, last_event_id=0):
+    """Async generator of SSE frames for an order, ending after a terminal event."""
+    bus = get_event_bus()
+    channel = order.order_id
+    yield f"retry: {settings.ORDER_EVENTS_RETRY_MS}\n\n"
+
+    if not last_event_id and not await sync_to_async(bus.history)(channel):
+        snapshot = snapshot_events(order)
+        for event_type in snapshot:
+            yield _format(event_type, {'order_id': channel, 'snapshot': True})
+        if TERMINAL_EVENTS.intersection(snapshot):
+            return
+
+    deadline = time.monotonic() + settings.ORDER_EVENTS_MAX_STREAM_SECONDS
+    async with bus.subscribe(channel) as subscription:
+        while time.monotonic() < deadline:
+            events = await subscription.wait(last_event_id, settings.ORDER_EVENTS_HEARTBEAT_SECONDS)
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            for event in events:
+                last_event_id = event['id']
+                yield _format(event['type'], {'order_id': channel, **event['data']}, event['id'])
+                if event['type'] in TERMINAL_EVENTS:
+                    return
@@ -0,0 +1,100 @@
+"""
+Expiry sweeper for abandoned pending orders.
+
+Every checkout page view creates a pending Order; orders still pending after
+ORDER_VALIDITY_DAYS are marked failed (or deleted) here. Work is done in
+small keyset-paginated chunks driven by the (payment_status, created_at)
+index, each in its own short transaction. Rows are re-checked as pending in
+the UPDATE itself and locked with SKIP LOCKED where supported, so an order
+being paid concurrently is never overwritten.
+
+The sweeper runs as a management command, so the last run's counters go to
+the cross-process ORDER_SWEEP_CACHE_ALIAS cache where web workers can read
+them (see ``last_sweep``).
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Order, OrderRollup
+
+logger = logging.getLogger(__name__)
+
+LAST_RUN_CACHE_KEY = 'core:order_sweeper:last_run'
+
+
+def sweep_expired_orders(mode='fail', chunk_size=None, max_chunks=None, pause=0, now=None):
+    """Expire pending orders older than ORDER_VALIDITY_DAYS.
+
+    ``mode`` is ``'fail'`` to mark them failed or ``'delete'`` to remove them.
+    Returns counters of what was done; the last run's counters are also kept
+    in the shared cache under LAST_RUN_CACHE_KEY.
+    """
+    if mode not in ('fail', 'delete'):
+        raise ValueError(f"Unknown sweep mode: {mode}")
+
+    chunk_size = chunk_size or settings.ORDER_SWEEP_CHUNK_SIZE
+    now = now or timezone.now()
+    cutoff = now - timedelta(days=settings.ORDER_VALIDITY_DAYS)
+    stats = {'mode': mode, 'chunks': 0, 'scanned': 0, 'failed': 0, 'deleted': 0, 'skipped': 0}
+
+    expired = Order.objects.filter(payment_status=Order.Status.PENDING, created_at__lt=cutoff)
+    last = None
+    while max_chunks is None or stats['chunks'] < max_chunks:
+        page = expired
+        if last is not None:
+            # Keyset pagination on the index so skipped rows are never rescanned
+            page = page.filter(Q(created_at__gt=last[0]) | Q(created_at=last[0], pk__gt=last[1]))
+        keys = list(page.order_by('created_at', 'pk').values_list('created_at', 'pk')[:chunk_size])
+        if not keys:
+            break
+        last = keys[-1]
+
+        done = _expire_chunk([pk for _, pk in keys], mode, now)
+        stats['chunks'] += 1
+        stats['scanned'] += len(keys)
+        stats['failed' if mode == 'fail' else 'deleted'] += done
+        stats['skipped'] += len(keys) - done
+
+        if len(keys) < chunk_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    stats['finished_at'] = timezone.now().isoformat()
+    caches[settings.ORDER_SWEEP_CACHE_ALIAS].set(LAST_RUN_CACHE_KEY, stats, timeout=None)
+    logger.info("Order sweep finished: %s", stats)
+    return stats
+
+
+def last_sweep():
+    """Counters of the most recent sweep in any process, or None if none has run."""
+    return caches[settings.ORDER_SWEEP_CACHE_ALIAS].get(LAST_RUN_CACHE_KEY)
+
+
+def _expire_chunk(pks, mode, now):
+    """Expire one chunk in a short transaction. Returns the number of orders changed."""
+    with transaction.atomic():
+        pending = Order.objects.filter(pk__in=pks, payment_status=Order.Status.PENDING)
+        if connection.features.has_select_for_update_skip_locked:
+            # Orders locked by a live checkout are left for the next run
+            pending = pending.select_for_update(skip_locked=True)
+        rows = list(pending.values('pk', *OrderRollup.SOURCE_FIELDS))
+        if not rows:
+            return 0
+        locked = Order.objects.filter(pk__in=[row['pk'] for row in rows], payment_status=Order.Status.PENDING)
+
+        if mode == 'delete':
+            # delete() sends post_delete, which keeps rollups and related rows consistent
+            _, per_model = locked.delete()
+            return per_model.get(Order._meta.label, 0)
+
+        changed = locked.update(payment_status=Order.Status.FAILED, updated_at=now)
+        OrderRollup.record_status_change(rows, Order.Status.FAILED)
+        return changed
@@ -0,0 +1,206 @@
+"""
+Local disk read-through cache for stored documents and QR images.
+
+QR PDFs, print sheets, previews and ZIP bundles need the bytes of stored
+files. With a remote storage (S3, Cloudinary) each of them would download
+the same objects again, so they go through ``file_cache()`` instead:
+
+    with file_cache().open(record.qr_code_image) as f: ...
+    path = file_cache().local_path(record.qr_code_image)
+
+Files on a local FileSystemStorage are used in place. Remote objects are
+fetched once into DOCUMENT_CACHE_DIR, keyed by content hash for
+content-addressed names (so identical documents share an entry) and by
+storage + name otherwise; stored names are never overwritten, so an entry
+never goes stale. Writes go to a temporary file and are renamed into place,
+and a striped file lock makes concurrent requests for the same object (in
+any worker process) wait for one download instead of each fetching it.
+Once the directory grows past DOCUMENT_CACHE_MAX_BYTES the least recently
+used entries are removed.
+"""
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .storage import digest_from_name, local_path
+
+STATS = ('hits', 'misses', 'local', 'evictions', 'bytes_fetched')
+STATS_PREFIX = 'file_cache:'
+
+# Entries used this recently are never evicted, so a path handed out stays valid while it is read
+EVICTION_GRACE_SECONDS = 60
+
+
+class FileCache:
+    """Size-bounded LRU of remote storage objects on local disk."""
+
+    def __init__(self, root, max_bytes):
+        self.root = str(root)
+        self.max_bytes = max_bytes
+        self._size = None
+
+    def _entry_path(self, storage, name, sha256=None):
+        digest = sha256 or digest_from_name(name)
+        if not digest:
+            origin = f"{type(storage).__module__}.{type(storage).__qualname__}:{name}"
+            digest = hashlib.sha256(origin.encode()).hexdigest()
+        ext = os.path.splitext(name)[1].lower()
+        return os.path.join(self.root, digest[:2], f"{digest}{ext}")
+
+    @contextmanager
+    def _lock(self, entry):
+        # 256 lock stripes, never deleted, so a waiter can't end up holding a removed lock file
+        stripe = os.path.basename(entry)[:2]
+        locks = os.path.join(self.root, '.locks')
+        os.makedirs(locks, exist_ok=True)
+        with open(os.path.join(locks, f"{stripe}.lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def local_path(self, file, name=None, sha256=None):
+        """Local filesystem path of a stored file (a FieldFile, or a storage plus ``name``)."""
+        storage, name = (file.storage, file.name) if name is None else (file, name)
+        path = local_path(storage, name)
+        if path is not None:
+            _count('local')
+            return path
+
+        entry = self._entry_path(storage, name, sha256)
+        if self._touch(entry):
+            _count('hits')
+            return entry
+        with self._lock(entry):
+            # Another request may have fetched it while we waited
+            if self._touch(entry):
+                _count('hits')
+                return entry
+            size = self._fetch(storage, name, entry)
+        _count('misses')
+        _count('bytes_fetched', size)
+        self._grow(size)
+        return entry
+
+    def open(self, file, name=None, sha256=None):
+        """Open a stored file for reading through the cache."""
+        return open(self.local_path(file, name, sha256), 'rb')
+
+    def _touch(self, entry):
+        try:
+            os.utime(entry)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _fetch(self, storage, name, entry):
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry), prefix='.fetch-')
+        try:
+            with os.fdopen(fd, 'wb') as out, storage.open(name, 'rb') as source:
+                shutil.copyfileobj(source, out, 1024 * 1024)
+                out.flush()
+                os.fsync(out.fileno())
+                size = out.tell()
+            os.replace(tmp, entry)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return size
+
+    def _grow(self, size):
+        if self._size is None:
+            self._size = self.usage()[1]
+        else:
+            self._size += size
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        for bucket in os.scandir(self.root):
+            if not bucket.is_dir() or bucket.name.startswith('.'):
+                continue
+            for entry in os.scandir(bucket.path):
+                if entry.is_file() and not entry.name.startswith('.'):
+                    yield entry
+
+    def usage(self):
+        """(entries, bytes) currently on disk."""
+        if not os.path.isdir(self.root):
+            return 0, 0
+        sizes = [entry.stat().st_size for entry in self._entries()]
+        return len(sizes), sum(sizes)
+
+    def evict(self, target=None):
+        """Remove least recently used entries until the cache is below ``target`` bytes (90% of the limit)."""
+        if target is None:
+            target = int(self.max_bytes * 0.9)
+        entries = sorted(
+            ((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in self._entries()),
+        )
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - EVICTION_GRACE_SECONDS
+        evicted = 0
+        for used_at, size, path in entries:
+            if total <= target or used_at > cutoff:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        self._size = total
+        if evicted:
+            _count('evictions', evicted)
+        return evicted
+
+    def clear(self):
+        """Remove every cached entry and reset the stats."""
+        removed = 0
+        if os.path.isdir(self.root):
+            for entry in list(self._entries()):
+                os.remove(entry.path)
+                removed += 1
+        self._size = 0
+        cache.delete_many([f"{STATS_PREFIX}{stat}" for stat in STATS])
+        return removed
+
+    def stats(self):
+        """Hit/miss counters (shared through the Django cache) plus current disk usage."""
+        values = cache.get_many([f"{STATS_PREFIX}{stat}" for stat in STATS])
+        stats = {stat: values.get(f"{STATS_PREFIX}{stat}", 0) for stat in STATS}
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else None
+        stats['entries'], stats['bytes'] = self.usage()
+        stats['max_bytes'] = self.max_bytes
+        return stats
+
+
+def _count(stat, amount=1):
+    key = f"{STATS_PREFIX}{stat}"
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # Evicted between add and incr
+        cache.set(key, amount, None)
+
+
+_file_cache = None
+
+
+def file_cache():
+    """Process-wide FileCache configured by DOCUMENT_CACHE_DIR / DOCUMENT_CACHE_MAX_BYTES."""
+    global _file_cache
+    if _file_cache is None:
+        _file_cache = FileCache(settings.DOCUMENT_CACHE_DIR, settings.DOCUMENT_CACHE_MAX_BYTES)
+    return _file_cache
@@ -0,0 +1,120 @@
+"""
+Idempotency-Key support for mutating endpoints.
+
+A client may send an ``Idempotency-Key`` header with a POST. The first
+request with a given key runs normally while holding a short lock; its
+response is stored (with a fingerprint of the request) in the shared cache.
+Retries with the same key get the stored response back instead of redoing
+the work, a retry arriving while the first request is still running waits
+briefly for it, and reusing a key for a different request is rejected.
+"""
+import functools
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpRequest, HttpResponse, JsonResponse
+
+HEADER = 'Idempotency-Key'
+
+
+def _cache():
+    return caches[settings.IDEMPOTENCY_CACHE_ALIAS]
+
+
+def _find_request(args):
+    for arg in args:
+        if isinstance(arg, HttpRequest) or hasattr(arg, '_request'):
+            return arg
+    raise TypeError("idempotent() could not find the request argument")
+
+
+def _fingerprint(request):
+    raw = request._request if hasattr(request, '_request') else request
+    digest = hashlib.sha256()
+    digest.update(f"{raw.method} {raw.path}\n".encode())
+    digest.update(raw.body)
+    return digest.hexdigest()
+
+
+def _serialize(response):
+    """Return a cacheable form of the response, or None if it must not be replayed."""
+    if response.status_code >= 500 or getattr(response, 'streaming', False):
+        return None
+    if hasattr(response, 'data') and not getattr(response, 'is_rendered', True):
+        # DRF Response: rendering happens later in finalize_response
+        return {'kind': 'drf', 'status': response.status_code, 'data': response.data}
+    return {
+        'kind': 'django',
+        'status': response.status_code,
+        'content': response.content,
+        'content_type': response.get('Content-Type'),
+        'headers': {name: response[name] for name in ('Location',) if response.has_header(name)},
+    }
+
+
+def _replay(stored):
+    if stored['kind'] == 'drf':
+        from rest_framework.response import Response
+        response = Response(stored['data'], status=stored['status'])
+    else:
+        response = HttpResponse(stored['content'], status=stored['status'], content_type=stored['content_type'])
+        for name, value in stored['headers'].items():
+            response[name] = value
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _error(request, message, status):
+    if hasattr(request, '_request'):
+        from rest_framework.response import Response
+        return Response({'error': message}, status=status)
+    return JsonResponse({'error': message}, status=status)
+
+
+def idempotent(view_func):
+    """Make a view (or DRF action) replay its response for repeated Idempotency-Keys."""
+
+    @functools.wraps(view_func)
+    def wrapper(*args, **kwargs):
+        request = _find_request(args)
+        key = request.headers.get(HEADER)
+        if not key:
+            return view_func(*args, **kwargs)
+        if len(key) > 255:
+            return _error(request, f"{HEADER} must be at most 255 characters", 400)
+
+        user_id = request.user.pk if request.user.is_authenticated else 'anon'
+        cache_key = f"idempotency:{user_id}:{hashlib.sha256(key.encode()).hexdigest()}"
+        lock_key = f"{cache_key}:lock"
+        fingerprint = _fingerprint(request)
+        store = _cache()
+
+        deadline = time.monotonic() + settings.IDEMPOTENCY_LOCK_WAIT
+        while True:
+            stored = store.get(cache_key)
+            if stored is not None:
+                if stored['fingerprint'] != fingerprint:
+                    return _error(request, f"{HEADER} was already used for a different request", 422)
+                return _replay(stored['response'])
+            if store.add(lock_key, fingerprint, settings.IDEMPOTENCY_LOCK_TTL):
+                break
+            if time.monotonic() >= deadline:
+                return _error(request, f"A request with this {HEADER} is still in progress", 409)
+            time.sleep(0.1)
+
+        try:
+            response = view_func(*args, **kwargs)
+            serialized = _serialize(response)
+            if serialized is not None:
+                store.set(
+                    cache_key,
+                    {'fingerprint': fingerprint, 'response': serialized},
+                    settings.IDEMPOTENCY_KEY_TTL,
+                )
+            return response
+        finally:
+            store.delete(lock_key)
+
+    return wrapper
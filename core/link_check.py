@@ -0,0 +1,263 @@
+"""
+Health checks of externally hosted (Cloudinary) document URLs.
+
+Records created through ``ajax_create_record`` only point at external URLs,
+and a published gallery breaks silently when one of those assets is
+removed. ``check_links`` HEADs every external document concurrently on one
+asyncio event loop:
+
+- a global semaphore bounds the requests in flight (LINK_CHECK_CONCURRENCY);
+- each host gets a small pool of keep-alive HTTP/1.1 connections
+  (LINK_CHECK_PER_HOST_CONNECTIONS) that requests reuse, and a pacer that
+  spaces requests to at most LINK_CHECK_PER_HOST_RATE per second;
+- redirects are followed, and servers refusing HEAD are retried with a
+  one-byte ranged GET.
+
+The client is plain ``asyncio.open_connection`` so no HTTP library is
+needed. 2xx answers mark a document ``ok``, 404/410 and other client errors
+``broken``, and timeouts, connection failures, 5xx and 429 ``error`` (retried
+next run). Records with a broken document get ``RTORecord.broken_links`` so
+their gallery can be republished.
+"""
+import asyncio
+import ssl
+from dataclasses import dataclass
+from datetime import timedelta
+from urllib.parse import urljoin, urlsplit
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+MAX_REDIRECTS = 5
+USER_AGENT = 'rto-link-check/1.0'
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+# Client errors that say nothing about the asset itself
+TRANSIENT_STATUSES = {408, 425, 429}
+
+
+@dataclass
+class LinkResult:
+    status: str
+    status_code: int = None
+    error: str = ''
+
+
+def classify(status_code):
+    if 200 <= status_code < 300:
+        return 'ok'
+    if 400 <= status_code < 500 and status_code not in TRANSIENT_STATUSES:
+        return 'broken'
+    return 'error'
+
+
+class _Pacer:
+    """Spaces calls to at most ``rate`` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = 0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        delay = self.next_slot - now
+        self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class _Host:
+    """Keep-alive connections to one scheme://host:port."""
+
+    def __init__(self, scheme, host, port, connections, rate):
+        self.scheme, self.host, self.port = scheme, host, port
+        self.idle = []
+        self.slots = asyncio.Semaphore(connections)
+        self.pacer = _Pacer(rate)
+        self.opened = 0
+
+    async def _connect(self, timeout):
+        tls = ssl.create_default_context() if self.scheme == 'https' else None
+        connection = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=tls, server_hostname=self.host if tls else None),
+            timeout,
+        )
+        self.opened += 1
+        return connection
+
+    async def _exchange(self, reader, writer, method, target):
+        host = self.host if self.port in (80, 443) else f"{self.host}:{self.port}"
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host}", f"User-Agent: {USER_AGENT}", "Accept: */*"]
+        if method == 'GET':
+            lines += ["Range: bytes=0-0", "Connection: close"]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed before a response")
+        version, status_code = status_line.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        reusable = (
+            method == 'HEAD' and version == 'HTTP/1.1'
+            and headers.get('connection', '').lower() != 'close'
+        )
+        return int(status_code), headers, reusable
+
+    async def request(self, method, target, timeout):
+        await self.pacer.wait()
+        async with self.slots:
+            while True:
+                reused = bool(self.idle)
+                reader, writer = self.idle.pop() if reused else await self._connect(timeout)
+                try:
+                    status_code, headers, reusable = await asyncio.wait_for(
+                        self._exchange(reader, writer, method, target), timeout,
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        # The server closed an idle keep-alive connection; retry on a fresh one
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if reusable:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status_code, headers
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+
+class LinkChecker:
+    """Concurrent HEAD checks of many URLs with bounded concurrency and per-host limits."""
+
+    def __init__(self, concurrency=None, per_host_connections=None, per_host_rate=None, timeout=None):
+        self.concurrency = concurrency or settings.LINK_CHECK_CONCURRENCY
+        self.per_host_connections = per_host_connections or settings.LINK_CHECK_PER_HOST_CONNECTIONS
+        self.per_host_rate = settings.LINK_CHECK_PER_HOST_RATE if per_host_rate is None else per_host_rate
+        self.timeout = timeout or settings.LINK_CHECK_TIMEOUT
+        self.hosts = {}
+
+    def _host(self, parts):
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        if key not in self.hosts:
+            self.hosts[key] = _Host(*key, self.per_host_connections, self.per_host_rate)
+        return self.hosts[key]
+
+    async def check(self, url):
+        """Check one URL, following redirects."""
+        method = 'HEAD'
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                parts = urlsplit(url)
+                if parts.scheme not in ('http', 'https') or not parts.hostname:
+                    return LinkResult('broken', error=f"Not an HTTP URL: {url}")
+                target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+                status_code, headers = await self._host(parts).request(method, target, self.timeout)
+                if status_code in (405, 501) and method == 'HEAD':
+                    method = 'GET'
+                    continue
+                if status_code in REDIRECT_STATUSES and headers.get('location'):
+                    url = urljoin(url, headers['location'])
+                    continue
+                return LinkResult(classify(status_code), status_code)
+            return LinkResult('error', status_code, "Too many redirects")
+        except asyncio.TimeoutError:
+            return LinkResult('error', error="Timed out")
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            return LinkResult('error', error=str(e) or type(e).__name__)
+
+    async def check_all(self, urls):
+        """Results for ``urls``, in order."""
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(url):
+            async with limit:
+                return await self.check(url)
+
+        try:
+            return await asyncio.gather(*(bounded(url) for url in urls))
+        finally:
+            for host in self.hosts.values():
+                host.close()
+
+    @property
+    def connections_opened(self):
+        return sum(host.opened for host in self.hosts.values())
+
+
+def external_documents(recheck_hours=None):
+    """External documents not checked within ``recheck_hours`` (default LINK_CHECK_INTERVAL_HOURS)."""
+    from .models import RecordDocument
+    if recheck_hours is None:
+        recheck_hours = settings.LINK_CHECK_INTERVAL_HOURS
+    documents = RecordDocument.objects.filter(
+        Q(storage_key__startswith='http://') | Q(storage_key__startswith='https://')
+    )
+    if recheck_hours:
+        cutoff = timezone.now() - timedelta(hours=recheck_hours)
+        documents = documents.filter(Q(link_checked_at__isnull=True) | Q(link_checked_at__lt=cutoff))
+    return documents
+
+
+def check_links(documents=None, checker=None, batch_size=1000):
+    """Check external documents, store each one's status and flag records with broken links.
+
+    Returns a dict of counts by status.
+    """
+    from .models import RecordDocument
+    if documents is None:
+        documents = external_documents()
+    rows = list(documents.values_list('id', 'record_id', 'storage_key'))
+    checker = checker or LinkChecker()
+    results = asyncio.run(checker.check_all([url for _, _, url in rows]))
+
+    now = timezone.now()
+    checked = [
+        RecordDocument(id=document_id, link_status=result.status, link_status_code=result.status_code,
+                       link_checked_at=now)
+        for (document_id, _, _), result in zip(rows, results)
+    ]
+    RecordDocument.objects.bulk_update(
+        checked, ['link_status', 'link_status_code', 'link_checked_at'], batch_size=batch_size,
+    )
+    record_ids = list({record_id for _, record_id, _ in rows})
+    refresh_link_flags(record_ids)
+
+    counts = {'ok': 0, 'broken': 0, 'error': 0}
+    for (document_id, record_id, url), result in zip(rows, results):
+        counts[result.status] += 1
+        if result.status == 'broken':
+            print(f"🔗 Broken link on record {record_id}: {url} ({result.status_code or result.error})")
+    counts['connections'] = checker.connections_opened
+    return counts
+
+
+def refresh_link_flags(record_ids):
+    """Set ``broken_links`` on records with a broken external document and clear it on the others."""
+    from .models import RecordDocument, RTORecord
+    for start in range(0, len(record_ids), 1000):
+        batch = record_ids[start:start + 1000]
+        broken = set(
+            RecordDocument.objects.filter(record_id__in=batch, link_status='broken')
+            .filter(Q(storage_key__startswith='http://') | Q(storage_key__startswith='https://'))
+            .values_list('record_id', flat=True)
+        )
+        RTORecord.objects.filter(pk__in=broken).update(broken_links=True)
+        RTORecord.objects.filter(pk__in=batch).exclude(pk__in=broken).update(broken_links=False)
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from core.derivatives import build_record_derivatives
+from core.models import RTORecord
+
+
+class Command(BaseCommand):
+    help = "Render missing WebP/JPEG variants and PDF previews for documents of existing records."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Re-render variants that already exist')
+
+    def handle(self, *args, **options):
+        records = rendered = 0
+        for record in RTORecord.objects.prefetch_related('documents').order_by('created_at').iterator(chunk_size=200):
+            results = build_record_derivatives(record, force=options['force'])
+            records += 1
+            rendered += len(results)
+        self.stdout.write(self.style.SUCCESS(f"Rendered variants for {rendered} documents across {records} records"))
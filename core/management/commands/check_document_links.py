@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from core.link_check import LinkChecker, check_links, external_documents
+
+
+class Command(BaseCommand):
+    help = "HEAD-check external document URLs concurrently and flag records whose galleries have broken links."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Re-check documents checked within LINK_CHECK_INTERVAL_HOURS too")
+        parser.add_argument('--record', action='append', dest='records', help="Only this record id (repeatable)")
+        parser.add_argument('--concurrency', type=int, default=None, help="Requests in flight (default LINK_CHECK_CONCURRENCY)")
+        parser.add_argument('--per-host-rate', type=float, default=None, help="Requests per second per host (default LINK_CHECK_PER_HOST_RATE)")
+        parser.add_argument('--timeout', type=float, default=None, help="Seconds per request (default LINK_CHECK_TIMEOUT)")
+
+    def handle(self, *args, **options):
+        documents = external_documents(recheck_hours=0 if options['all'] or options['records'] else None)
+        if options['records']:
+            documents = documents.filter(record_id__in=options['records'])
+        checker = LinkChecker(
+            concurrency=options['concurrency'],
+            per_host_rate=options['per_host_rate'],
+            timeout=options['timeout'],
+        )
+        counts = check_links(documents, checker=checker)
+        style = self.style.WARNING if counts['broken'] else self.style.SUCCESS
+        self.stdout.write(style(
+            f"Checked {counts['ok'] + counts['broken'] + counts['error']} links over {counts['connections']} connections: "
+            f"{counts['ok']} ok, {counts['broken']} broken, {counts['error']} unreachable"
+        ))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from core.media_gc import collect_orphans
+
+
+class Command(BaseCommand):
+    help = "Find media files no record points at (regenerated QR codes, replaced uploads, ...) and delete or quarantine them."
+
+    def add_arguments(self, parser):
+        mode = parser.add_mutually_exclusive_group()
+        mode.add_argument('--delete', action='store_true', help="Delete orphans (default is a dry run)")
+        mode.add_argument('--quarantine', action='store_true', help="Move orphans under MEDIA_GC_QUARANTINE_PREFIX")
+        parser.add_argument('--grace-hours', type=float, default=None, help="Skip files younger than this (default MEDIA_GC_GRACE_HOURS)")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--workers', type=int, default=8, help="Threads listing and removing files")
+
+    def handle(self, *args, **options):
+        dry_run = not (options['delete'] or options['quarantine'])
+        report = collect_orphans(
+            dry_run=dry_run,
+            quarantine=options['quarantine'],
+            grace_hours=options['grace_hours'],
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+        )
+        self.stdout.write(
+            f"Scanned {report.scanned} files, {len(report.orphans)} orphaned ({filesizeformat(report.orphan_bytes)})"
+        )
+        if dry_run:
+            shown = report.orphans if options['verbosity'] > 1 else report.orphans[:20]
+            for orphan in shown:
+                self.stdout.write(f"  {orphan.name} ({filesizeformat(orphan.size)})")
+            if len(shown) < len(report.orphans):
+                self.stdout.write(f"  ... and {len(report.orphans) - len(shown)} more (-v 2 lists all)")
+            self.stdout.write(self.style.WARNING("Dry run: nothing removed. Use --delete or --quarantine."))
+            return
+        action = 'Quarantined' if options['quarantine'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f"{action} {report.removed} files ({filesizeformat(report.removed_bytes)}), "
+            f"kept {report.kept} referenced since the scan"
+        ))
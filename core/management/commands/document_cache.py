@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from core.file_cache import file_cache
+
+
+class Command(BaseCommand):
+    help = "Show hit-rate stats of the local document cache, or evict/clear it."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--evict', action='store_true', help="Trim least recently used entries to below the size limit")
+        parser.add_argument('--clear', action='store_true', help="Remove every cached entry and reset the stats")
+
+    def handle(self, *args, **options):
+        cache = file_cache()
+        if options['clear']:
+            removed = cache.clear()
+            self.stdout.write(self.style.SUCCESS(f"Removed {removed} cached files"))
+            return
+        if options['evict']:
+            evicted = cache.evict()
+            self.stdout.write(self.style.SUCCESS(f"Evicted {evicted} cached files"))
+
+        stats = cache.stats()
+        hit_rate = f"{stats['hit_rate']:.1%}" if stats['hit_rate'] is not None else 'n/a'
+        self.stdout.write(
+            f"{stats['entries']} files, {filesizeformat(stats['bytes'])} of {filesizeformat(stats['max_bytes'])} in {cache.root}\n"
+            f"hit rate {hit_rate} ({stats['hits']} hits, {stats['misses']} misses, {stats['local']} local reads)\n"
+            f"{filesizeformat(stats['bytes_fetched'])} fetched, {stats['evictions']} evictions"
+        )
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.expiry import sweep_expired_orders
+
+
+class Command(BaseCommand):
+    help = "Mark (or delete) pending orders older than ORDER_VALIDITY_DAYS. Run from cron or with --every."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help='Delete expired orders instead of marking them failed')
+        parser.add_argument('--chunk-size', type=int, help='Orders per transaction')
+        parser.add_argument('--max-chunks', type=int, help='Stop after this many chunks')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between chunks')
+        parser.add_argument('--every', type=int, help='Keep running, sweeping every N seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            stats = sweep_expired_orders(
+                mode='delete' if options['delete'] else 'fail',
+                chunk_size=options['chunk_size'],
+                max_chunks=options['max_chunks'],
+                pause=options['pause'],
+            )
+            self.stdout.write(self.style.SUCCESS(
+                "Scanned {scanned} in {chunks} chunks: {failed} failed, {deleted} deleted, {skipped} skipped".format(**stats)
+            ))
+            if not options['every']:
+                break
+            time.sleep(options['every'])
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from core.derivatives import is_image
+from core.duplicates import dhash_file, flag_duplicates, hash_fields
+from core.file_cache import file_cache
+from core.models import RecordDocument
+from core.storage import document_storage
+
+
+class Command(BaseCommand):
+    help = "Compute perceptual hashes of image documents missing one and flag near-duplicates."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rescan', action='store_true', help="Re-check every hashed document for duplicates")
+
+    def handle(self, *args, **options):
+        storage = document_storage()
+        missing = RecordDocument.objects.filter(dhash__isnull=True).select_related('record')
+        hashed = flagged = 0
+        for document in missing.iterator(chunk_size=500):
+            if document.is_external or not is_image(document.storage_key):
+                continue
+            try:
+                path = file_cache().local_path(storage, document.storage_key, document.sha256 or None)
+                fields = hash_fields(dhash_file(path))
+            except Exception as e:
+                self.stderr.write(f"Skipped document {document.id}: {e}")
+                continue
+            RecordDocument.objects.filter(pk=document.pk).update(**fields)
+            document.dhash = fields['dhash']
+            hashed += 1
+            if not options['rescan'] and flag_duplicates(document):
+                flagged += 1
+
+        if options['rescan']:
+            for document in RecordDocument.objects.filter(dhash__isnull=False).select_related('record').iterator(chunk_size=500):
+                if flag_duplicates(document):
+                    flagged += 1
+        self.stdout.write(self.style.SUCCESS(f"Hashed {hashed} documents, {flagged} with near-duplicates"))
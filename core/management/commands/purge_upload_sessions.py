@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core.models import UploadSession
+from core.resumable import discard_upload
+
+
+class Command(BaseCommand):
+    help = "Delete expired unfinished resumable uploads and their staged bytes."
+
+    def handle(self, *args, **options):
+        expired = UploadSession.objects.exclude(status=UploadSession.Status.COMPLETED).filter(
+            expires_at__lte=timezone.now()
+        )
+        purged = 0
+        for session in expired.iterator():
+            discard_upload(session)
+            purged += 1
+        self.stdout.write(self.style.SUCCESS(f"Purged {purged} expired uploads"))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from core.quotas import reconcile
+
+
+class Command(BaseCommand):
+    help = "Recompute per-owner storage usage from the documents table and report counters that had drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users', help="Only this user id (repeatable)")
+
+    def handle(self, *args, **options):
+        drift = reconcile(options['users'])
+        for user_id, bytes_drift, files_drift in drift:
+            sign = '+' if bytes_drift >= 0 else '-'
+            self.stdout.write(
+                f"  user {user_id}: counted {sign}{filesizeformat(abs(bytes_drift))}, {files_drift:+d} files off"
+            )
+        style = self.style.WARNING if drift else self.style.SUCCESS
+        self.stdout.write(style(f"Reconciled storage usage, {len(drift)} users had drifted"))
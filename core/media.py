@@ -0,0 +1,128 @@
+"""
+Serving protected media (record documents) after the view has checked access.
+
+With PROTECTED_MEDIA_SENDFILE set, the response carries no body: the
+front-end server is told which file to send (``X-Accel-Redirect`` for
+nginx, ``X-Sendfile`` for Apache mod_xsendfile / lighttpd) and handles
+Range and caching itself. Otherwise the file is streamed with FileResponse,
+answering ``If-None-Match`` with 304 and single ``Range`` requests with 206
+so large PDFs can resume. Files on a remote storage are redirected to the
+storage URL.
+
+nginx example (PROTECTED_MEDIA_SENDFILE = 'nginx')::
+
+    location /protected-media/ {
+        internal;
+        alias /path/to/media/;
+    }
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseRedirect
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from .storage import digest_from_name, local_path
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileRange:
+    """Read at most ``length`` bytes of an open file from ``start``."""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        file.seek(start)
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """(start, end) of a single ``bytes=`` range, None to send the whole file, or False if unsatisfiable."""
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        # Absent, malformed or multi-range: a full 200 response is always allowed
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def file_etag(name, stat):
+    """Strong ETag: the content hash for content-addressed names, else size and mtime."""
+    return quote_etag(digest_from_name(name) or f"{stat.st_size:x}-{int(stat.st_mtime * 1000):x}")
+
+
+def serve_file(request, storage, name, filename=None, content_type=None, attachment=False):
+    """Response delivering a stored file the caller has already authorised."""
+    path = local_path(storage, name)
+    if path is None:
+        return HttpResponseRedirect(storage.url(name))
+    stat = os.stat(path)
+    etag = file_etag(name, stat)
+    content_type = content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    filename = filename or os.path.basename(name)
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if not_modified is not None:
+        patch_cache_control(not_modified, private=True, no_cache=True)
+        return not_modified
+
+    mode = settings.PROTECTED_MEDIA_SENDFILE
+    if mode:
+        response = HttpResponse(content_type=content_type)
+        if mode == 'nginx':
+            relative = os.path.relpath(path, storage.location)
+            response['X-Accel-Redirect'] = quote(settings.PROTECTED_MEDIA_INTERNAL_URL + relative.replace(os.sep, '/'))
+        else:
+            response['X-Sendfile'] = path
+    else:
+        response = _file_response(request, path, stat.st_size, etag, content_type)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    disposition = 'attachment' if attachment else 'inline'
+    response['Content-Disposition'] = f"{disposition}; filename*=UTF-8''{quote(filename)}"
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _file_response(request, path, size, etag, content_type):
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if not if_range or if_range == etag:
+        byte_range = parse_range(request.headers.get('Range'), size)
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+        return response
+
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    else:
+        start, end = byte_range
+        response = FileResponse(FileRange(open(path, 'rb'), start, end - start + 1), status=206, content_type=content_type)
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+    response['Accept-Ranges'] = 'bytes'
+    return response
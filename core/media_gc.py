@@ -0,0 +1,283 @@
+"""
+Garbage collection of media files no database row points at.
+
+Regenerated QR codes (``qr_<id>_<suffix>.png``), replaced uploads under
+``user_uploads/<owner_id>/``, stale review PDFs and variants of deleted
+documents are never removed when they are superseded. ``collect_orphans``
+finds them:
+
+1. The referenced set is built from every RTORecord file column,
+   RecordDocument storage key and live StoredBlob, streamed with
+   ``values_list().iterator()``; variants count as referenced when their
+   source document is.
+2. The GC roots are split into shards (per owner folder, per hash prefix)
+   and listed concurrently in a thread pool, with ``os.scandir`` on local
+   storage or paginated object listing on S3.
+3. Unreferenced files older than the grace period are re-checked against
+   the database in batches (a new upload may have started referencing an
+   existing content-addressed file since the scan), then deleted or moved
+   into MEDIA_GC_QUARANTINE_PREFIX. Dry runs only report.
+
+Abandoned uploads are collected too: presigned objects under
+DIRECT_UPLOAD_PREFIX that were never completed, and tus staging files and
+interrupted multipart temporaries under UPLOAD_STAGING_DIR. Nothing points
+at these (except the staging file of a live resumable upload), so they use a
+longer age cutoff instead: the completion window of a presigned upload, the
+expiry of a resumable one.
+"""
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db.models import Q
+from django.utils import timezone
+
+from .derivatives import DERIVATIVE_PREFIX, derivative_dir
+from .models import RecordDocument, RTORecord, StoredBlob, UploadSession
+from .storage import CAS_PREFIX, document_storage, local_path, storage_key
+
+# Every FileField of RTORecord
+FILE_COLUMNS = RTORecord.DOCUMENT_FIELDS + ('qr_code_image', 'review_pdf')
+
+HEX = '0123456789abcdef'
+
+# Staging files of resumable uploads, under UPLOAD_STAGING_DIR (see core.resumable.staging_path)
+RESUMABLE_PREFIX = 'resumable/'
+
+
+@dataclass
+class Orphan:
+    storage: object
+    name: str
+    size: int
+
+
+@dataclass
+class GCReport:
+    scanned: int = 0
+    orphans: list = field(default_factory=list)
+    removed: int = 0
+    removed_bytes: int = 0
+    kept: int = 0
+
+    @property
+    def orphan_bytes(self):
+        return sum(orphan.size for orphan in self.orphans)
+
+
+def staging_storage():
+    return FileSystemStorage(location=settings.UPLOAD_STAGING_DIR)
+
+
+def gc_roots():
+    """(storage, prefix, min_age) triples that hold generated or uploaded media.
+
+    ``min_age`` (None for the grace period alone) keeps unfinished uploads
+    until they can no longer be completed.
+    """
+    direct_window = timedelta(seconds=settings.DIRECT_UPLOAD_COMPLETE_WINDOW)
+    resumable_window = timedelta(hours=settings.RESUMABLE_UPLOAD_EXPIRY_HOURS)
+    return [
+        (default_storage, 'qr_codes/', None),
+        (default_storage, 'review_pdfs/', None),
+        (document_storage(), 'user_uploads/', None),
+        (document_storage(), CAS_PREFIX, None),
+        (document_storage(), DERIVATIVE_PREFIX, None),
+        (document_storage(), settings.DIRECT_UPLOAD_PREFIX, direct_window),
+        (staging_storage(), RESUMABLE_PREFIX, resumable_window),
+        (staging_storage(), '', resumable_window),
+    ]
+
+
+def _staging_name(session_id):
+    return f"{RESUMABLE_PREFIX}{session_id}.part"
+
+
+def _live_uploads():
+    """Resumable uploads whose staging file may still be appended to."""
+    return UploadSession.objects.filter(status=UploadSession.Status.UPLOADING, expires_at__gt=timezone.now())
+
+
+def referenced_names():
+    """Every storage name a row points at, plus the variant directories of referenced documents."""
+    names = set()
+    for row in RTORecord.objects.values_list(*FILE_COLUMNS).iterator(chunk_size=2000):
+        names.update(name for name in row if name)
+    documents = RecordDocument.objects.exclude(storage_key__startswith='http').values_list('storage_key', flat=True)
+    names.update(documents.iterator(chunk_size=2000))
+    names.update(StoredBlob.objects.filter(ref_count__gt=0).values_list('name', flat=True).iterator(chunk_size=2000))
+    names.update({derivative_dir(name) for name in names if name.startswith((CAS_PREFIX, 'user_uploads/'))})
+    names.update(_staging_name(pk) for pk in _live_uploads().values_list('pk', flat=True).iterator(chunk_size=2000))
+    return names
+
+
+def _is_referenced(name, referenced):
+    if name.startswith(DERIVATIVE_PREFIX):
+        return os.path.dirname(name) in referenced
+    return name in referenced
+
+
+def _shards(storage, prefix):
+    """Split a root into (prefix, recursive) shards that can be listed independently."""
+    if prefix in (CAS_PREFIX, DERIVATIVE_PREFIX):
+        return [(f"{prefix}{a}{b}/", True) for a in HEX for b in HEX]
+    if prefix == 'user_uploads/':
+        try:
+            folders, _ = storage.listdir(prefix)
+        except FileNotFoundError:
+            return []
+        # One shard per owner, plus one for loose files directly under the root
+        return [(f"{prefix}{folder}/", True) for folder in folders] + [(prefix, False)]
+    if prefix == '':
+        # Loose multipart temporaries in the staging directory; its subdirectories are roots of their own
+        return [(prefix, False)]
+    return [(prefix, True)]
+
+
+def _list_local(root, prefix, recursive):
+    """Yield (name, mtime, size) under a local directory."""
+    stack = [os.path.join(root, prefix)]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat()
+                yield os.path.relpath(entry.path, root).replace(os.sep, '/'), stat.st_mtime, stat.st_size
+
+
+def _list_s3(storage, prefix, recursive):
+    """Yield (name, mtime, size) under a bucket prefix, one page of up to 1000 keys at a time."""
+    location = storage_key(storage, '')
+    for obj in storage.bucket.objects.filter(Prefix=storage_key(storage, prefix)):
+        name = obj.key[len(location):]
+        if recursive or '/' not in name[len(prefix):]:
+            yield name, obj.last_modified.timestamp(), obj.size
+
+
+def _scan_shard(storage, prefix, recursive, cutoff, referenced):
+    root = local_path(storage, '')
+    if root is not None:
+        listing = _list_local(root, prefix, recursive)
+    else:
+        listing = _list_s3(storage, prefix, recursive)
+    scanned, orphans = 0, []
+    for name, mtime, size in listing:
+        scanned += 1
+        if mtime < cutoff and not _is_referenced(name, referenced):
+            orphans.append(Orphan(storage, name, size))
+    return scanned, orphans
+
+
+def find_orphans(grace, workers):
+    """Scan every GC root in parallel and return a GCReport listing the orphans."""
+    referenced = referenced_names()
+    now = timezone.now()
+    report = GCReport()
+    tasks = []
+    for storage, prefix, min_age in gc_roots():
+        cutoff = (now - max(grace, min_age or grace)).timestamp()
+        tasks.extend((storage, *shard, cutoff) for shard in _shards(storage, prefix))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media-gc') as pool:
+        for scanned, orphans in pool.map(lambda task: _scan_shard(*task, referenced), tasks):
+            report.scanned += scanned
+            report.orphans.extend(orphans)
+    report.orphans.sort(key=lambda orphan: orphan.name)
+    return report
+
+
+def _still_referenced(names):
+    """Names of a batch that a row started pointing at since the scan."""
+    names = list(names)
+    query = Q()
+    for column in FILE_COLUMNS:
+        query |= Q(**{f"{column}__in": names})
+    referenced = set()
+    for row in RTORecord.objects.filter(query).values_list(*FILE_COLUMNS):
+        referenced.update(row)
+    referenced.update(RecordDocument.objects.filter(storage_key__in=names).values_list('storage_key', flat=True))
+    referenced.update(StoredBlob.objects.filter(name__in=names, ref_count__gt=0).values_list('name', flat=True))
+    # Variants of content-addressed documents live under their digest; a document taking
+    # a reference to that content since the scan keeps them (other sources are never re-referenced)
+    variants = {}
+    for name in names:
+        if name.startswith(DERIVATIVE_PREFIX):
+            variants.setdefault(os.path.basename(os.path.dirname(name)), []).append(name)
+    if variants:
+        digests = set(StoredBlob.objects.filter(sha256__in=variants, ref_count__gt=0).values_list('sha256', flat=True))
+        digests.update(RecordDocument.objects.filter(sha256__in=variants).values_list('sha256', flat=True))
+        for digest in digests:
+            referenced.update(variants[digest])
+    staged = []
+    for name in names:
+        if name.startswith(RESUMABLE_PREFIX) and name.endswith('.part'):
+            try:
+                staged.append(uuid.UUID(name[len(RESUMABLE_PREFIX):-len('.part')]))
+            except ValueError:
+                continue
+    if staged:
+        live = _live_uploads().filter(pk__in=staged).values_list('pk', flat=True)
+        referenced.update(_staging_name(pk) for pk in live)
+    return referenced
+
+
+def _remove(orphan, quarantine):
+    """Delete an orphan, or move it under the ``quarantine`` prefix. False if it was already gone."""
+    storage = orphan.storage
+    path = local_path(storage, orphan.name)
+    try:
+        if quarantine and path is not None:
+            destination = storage.path(f"{quarantine}{orphan.name}")
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.move(path, destination)
+            return True
+        if quarantine:
+            source = {'Bucket': storage.bucket.name, 'Key': storage_key(storage, orphan.name)}
+            storage.bucket.copy(source, storage_key(storage, f"{quarantine}{orphan.name}"))
+        if path is not None:
+            os.remove(path)
+        else:
+            storage.delete(orphan.name)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def remove_orphans(report, quarantine=False, batch_size=500, workers=8):
+    """Delete (or quarantine) the orphans of a report in batches, skipping ones referenced meanwhile."""
+    prefix = None
+    if quarantine:
+        stamp = datetime.now(dt_timezone.utc).strftime('%Y%m%dT%H%M%S')
+        prefix = f"{settings.MEDIA_GC_QUARANTINE_PREFIX}{stamp}/"
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='media-gc') as pool:
+        for start in range(0, len(report.orphans), batch_size):
+            batch = report.orphans[start:start + batch_size]
+            referenced = _still_referenced(orphan.name for orphan in batch)
+            unreferenced = [orphan for orphan in batch if orphan.name not in referenced]
+            report.kept += len(batch) - len(unreferenced)
+            batch = unreferenced
+            for orphan, removed in zip(batch, pool.map(lambda orphan: _remove(orphan, prefix), batch)):
+                if removed:
+                    report.removed += 1
+                    report.removed_bytes += orphan.size
+    return report
+
+
+def collect_orphans(dry_run=True, quarantine=False, grace_hours=None, batch_size=500, workers=8):
+    """Find orphaned media and, unless ``dry_run``, delete or quarantine it."""
+    if grace_hours is None:
+        grace_hours = settings.MEDIA_GC_GRACE_HOURS
+    report = find_orphans(timedelta(hours=grace_hours), workers)
+    if not dry_run:
+        remove_orphans(report, quarantine=quarantine, batch_size=batch_size, workers=workers)
+    return report
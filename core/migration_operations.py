@@ -0,0 +1,35 @@
+"""
+Migration operations shared by the apps' migrations.
+
+``AddIndexConcurrently`` builds an index with ``CREATE INDEX CONCURRENTLY``
+on PostgreSQL, so adding an index to a busy table (orders, records,
+webhooks) doesn't hold a write lock for the whole build; on other databases
+(SQLite in development and tests) it is a plain AddIndex. Unlike
+``django.contrib.postgres.operations.AddIndexConcurrently`` it runs on every
+backend. Migrations using it must set ``atomic = False``.
+"""
+from django.db.migrations.operations import AddIndex
+
+
+class AddIndexConcurrently(AddIndex):
+    """AddIndex that doesn't block writes on PostgreSQL."""
+
+    def _concurrently(self, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return {}
+        if schema_editor.connection.in_atomic_block:
+            raise ValueError("AddIndexConcurrently needs a migration with atomic = False")
+        return {'concurrently': True}
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, **self._concurrently(schema_editor))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, **self._concurrently(schema_editor))
+
+    def describe(self):
+        return super().describe() + " concurrently"
@@ -0,0 +1,61 @@
+# Generated by Django 5.0.7 on 2026-10-18 22:20
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def build_rollups(apps, schema_editor):
+    Order = apps.get_model('core', 'Order')
+    OrderRollup = apps.get_model('core', 'OrderRollup')
+    rows = (
+        Order.objects.annotate(date=TruncDate('created_at'))
+        .order_by()
+        .values('date', 'order_type', 'payment_provider', 'payment_status')
+        .annotate(order_count=Count('id'), total=Sum('total_amount'))
+    )
+    OrderRollup.objects.bulk_create([
+        OrderRollup(
+            date=row['date'],
+            order_type=row['order_type'],
+            payment_provider=row['payment_provider'],
+            status=row['payment_status'],
+            order_count=row['order_count'],
+            total_amount=row['total'] or 0,
+        )
+        for row in rows
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_rename_payment_provider_id_order_payment_provider_payment_id_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('order_type', models.CharField(choices=[('qr_download', 'QR Download'), ('pvc_card', 'PVC Card'), ('nfc_card', 'NFC Card')], max_length=20)),
+                ('payment_provider', models.CharField(choices=[('razorpay', 'Razorpay'), ('stripe', 'Stripe')], max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed'), ('refunded', 'Refunded')], max_length=20)),
+                ('order_count', models.IntegerField(default=0)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Order Rollup',
+                'verbose_name_plural': 'Order Rollups',
+                'db_table': 'order_rollup',
+                'ordering': ['-date', 'order_type', 'payment_provider', 'status'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='orderrollup',
+            constraint=models.UniqueConstraint(fields=('date', 'order_type', 'payment_provider', 'status'), name='order_rollup_unique_key'),
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.0.7 on 2026-10-18 22:29
+
+import core.models
+import core.storage
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_order_status_created_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('sha256', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('name', models.CharField(help_text='Storage name of the file', max_length=255)),
+                ('size', models.BigIntegerField(default=0)),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Stored Blob',
+                'verbose_name_plural': 'Stored Blobs',
+                'db_table': 'stored_blob',
+            },
+        ),
+        migrations.AlterField(
+            model_name='rtorecord',
+            name='driving_license_doc',
+            field=models.FileField(blank=True, help_text='Driving license document', null=True, storage=core.storage.document_storage, upload_to=core.models.upload_to_user_folder, validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['pdf', 'jpg', 'jpeg', 'png'])]),
+        ),
+        migrations.AlterField(
+            model_name='rtorecord',
+            name='insurance_doc',
+            field=models.FileField(blank=True, help_text='Insurance document', null=True, storage=core.storage.document_storage, upload_to=core.models.upload_to_user_folder, validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['pdf', 'jpg', 'jpeg', 'png'])]),
+        ),
+        migrations.AlterField(
+            model_name='rtorecord',
+            name='pu_check_doc',
+            field=models.FileField(blank=True, help_text='PU check document', null=True, storage=core.storage.document_storage, upload_to=core.models.upload_to_user_folder, validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['pdf', 'jpg', 'jpeg', 'png'])]),
+        ),
+        migrations.AlterField(
+            model_name='rtorecord',
+            name='rc_photo',
+            field=models.ImageField(blank=True, help_text='RC registration certificate photo', null=True, storage=core.storage.document_storage, upload_to=core.models.upload_to_user_folder, validators=[django.core.validators.FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png'])]),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 22:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_content_addressed_documents'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rtorecord',
+            name='document_derivatives',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text='Resized WebP/JPEG variants of image documents, keyed by field'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.0.7 on 2026-10-18 22:37
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_document_derivatives'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('field', models.CharField(choices=[('rc_photo', 'rc_photo'), ('insurance_doc', 'insurance_doc'), ('pu_check_doc', 'pu_check_doc'), ('driving_license_doc', 'driving_license_doc')], max_length=30)),
+                ('filename', models.CharField(max_length=255)),
+                ('length', models.BigIntegerField(help_text='Total size in bytes declared by the client')),
+                ('offset', models.BigIntegerField(default=0, help_text='Bytes received and stored so far')),
+                ('checksum', models.CharField(blank=True, help_text='Expected SHA-256 of the whole file, if given', max_length=64)),
+                ('sha256', models.CharField(blank=True, help_text='SHA-256 of the completed file', max_length=64)),
+                ('status', models.CharField(choices=[('uploading', 'Uploading'), ('completed', 'Completed'), ('failed', 'Failed')], default='uploading', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('expires_at', models.DateTimeField()),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+                ('record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='core.rtorecord')),
+            ],
+            options={
+                'verbose_name': 'Upload Session',
+                'verbose_name_plural': 'Upload Sessions',
+                'db_table': 'upload_session',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
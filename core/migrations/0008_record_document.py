@@ -0,0 +1,104 @@
+# Generated by Django 5.0.7 on 2026-10-18 22:43
+
+import mimetypes
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from core.storage import document_storage
+
+DOCUMENT_FIELDS = ('rc_photo', 'insurance_doc', 'pu_check_doc', 'driving_license_doc')
+KINDS_BY_RECORD_TYPE = {
+    'rc': ['rc_photo', 'insurance_doc', 'pu_check_doc', 'driving_license_doc'],
+    'school': ['marks_card', 'photo', 'convocation', 'migration'],
+}
+
+
+def stored_size(storage, name):
+    """Size of a stored file, or None when it can't be read (missing file, storage unreachable)."""
+    try:
+        return storage.size(name)
+    except Exception:
+        return None
+
+
+def copy_documents(apps, schema_editor):
+    """Create RecordDocument rows from the file columns, or from cloudinary_urls when those are empty."""
+    RTORecord = apps.get_model('core', 'RTORecord')
+    RecordDocument = apps.get_model('core', 'RecordDocument')
+    StoredBlob = apps.get_model('core', 'StoredBlob')
+    sizes = dict(StoredBlob.objects.values_list('name', 'size'))
+    storage = document_storage()
+    batch = []
+    records = RTORecord.objects.only('id', 'record_type', 'cloudinary_urls', 'document_derivatives', *DOCUMENT_FIELDS)
+    for record in records.iterator(chunk_size=500):
+        names = [(field, getattr(record, field).name) for field in DOCUMENT_FIELDS if getattr(record, field)]
+        if names:
+            for field, name in names:
+                digest = name.rsplit('/', 1)[-1].split('.')[0] if name.startswith('cas/') else ''
+                batch.append(RecordDocument(
+                    record_id=record.id,
+                    kind=field,
+                    position=DOCUMENT_FIELDS.index(field),
+                    storage_key=name,
+                    sha256=digest,
+                    # Files saved before content addressing have no blob row
+                    size=sizes[name] if name in sizes else stored_size(storage, name),
+                    mime_type=mimetypes.guess_type(name)[0] or '',
+                    derivatives=(record.document_derivatives or {}).get(field, {}),
+                ))
+        else:
+            kinds = KINDS_BY_RECORD_TYPE.get(record.record_type, [])
+            for position, url in enumerate(record.cloudinary_urls or []):
+                batch.append(RecordDocument(
+                    record_id=record.id,
+                    kind=kinds[position] if position < len(kinds) else 'other',
+                    position=position,
+                    storage_key=url,
+                    mime_type=mimetypes.guess_type(url.split('?')[0])[0] or '',
+                ))
+        if len(batch) >= 500:
+            RecordDocument.objects.bulk_create(batch)
+            batch = []
+    RecordDocument.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_upload_session'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecordDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('rc_photo', 'RC Photo'), ('insurance_doc', 'Insurance Document'), ('pu_check_doc', 'PU Check Document'), ('driving_license_doc', 'Driving License'), ('marks_card', 'Marks Card'), ('photo', 'Photo'), ('convocation', 'Convocation Certificate'), ('migration', 'Migration Certificate'), ('other', 'Other Document')], db_index=True, max_length=30)),
+                ('position', models.PositiveSmallIntegerField(default=0)),
+                ('storage_key', models.CharField(help_text='Storage name, or URL for external documents', max_length=500)),
+                ('sha256', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('size', models.BigIntegerField(blank=True, null=True)),
+                ('mime_type', models.CharField(blank=True, max_length=100)),
+                ('derivatives', models.JSONField(blank=True, default=dict, help_text='Resized variants or PDF preview')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('record', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='documents', to='core.rtorecord')),
+            ],
+            options={
+                'verbose_name': 'Record Document',
+                'verbose_name_plural': 'Record Documents',
+                'db_table': 'record_document',
+                'ordering': ['position', 'id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='recorddocument',
+            constraint=models.UniqueConstraint(condition=models.Q(('kind', 'other'), _negated=True), fields=('record', 'kind'), name='record_document_unique_kind'),
+        ),
+        migrations.RunPython(copy_documents, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='rtorecord',
+            name='document_derivatives',
+        ),
+    ]
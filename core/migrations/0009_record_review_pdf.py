@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 22:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_record_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rtorecord',
+            name='review_pdf',
+            field=models.FileField(blank=True, help_text='Cached consolidated review PDF (rebuilt when documents change)', null=True, upload_to='review_pdfs/'),
+        ),
+    ]
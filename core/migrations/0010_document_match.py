@@ -0,0 +1,68 @@
+# Generated by Django 5.0.7 on 2026-10-18 22:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_record_review_pdf'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recorddocument',
+            name='dhash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='recorddocument',
+            name='dhash_band0',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='recorddocument',
+            name='dhash_band1',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='recorddocument',
+            name='dhash_band2',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='recorddocument',
+            name='dhash_band3',
+            field=models.PositiveIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='rtorecord',
+            name='duplicate_flag',
+            field=models.BooleanField(db_index=True, default=False, help_text="A document nearly matches another owner's document (see DocumentMatch)"),
+        ),
+        migrations.CreateModel(
+            name='DocumentMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('distance', models.PositiveSmallIntegerField(help_text='Hamming distance between the perceptual hashes')),
+                ('reviewed', models.BooleanField(db_index=True, default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matches', to='core.recorddocument')),
+                ('matched_document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='matched_by', to='core.recorddocument')),
+                ('reviewed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Document Match',
+                'verbose_name_plural': 'Document Matches',
+                'db_table': 'document_match',
+                'ordering': ['reviewed', 'distance', '-created_at'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='documentmatch',
+            constraint=models.UniqueConstraint(fields=('document', 'matched_document'), name='document_match_unique_pair'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.0.7 on 2026-10-18 23:04
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0001_initial'),
+        ('core', '0010_document_match'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='storage_usage', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('files', models.IntegerField(default=0)),
+                ('quota_bytes', models.BigIntegerField(blank=True, help_text="Overrides the role's STORAGE_QUOTA_BYTES; empty uses the default", null=True)),
+                ('reconciled_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Storage Usage',
+                'verbose_name_plural': 'Storage Usage',
+                'db_table': 'storage_usage',
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.7 on 2026-10-18 23:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_storage_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recorddocument',
+            name='link_checked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='recorddocument',
+            name='link_status',
+            field=models.CharField(blank=True, choices=[('ok', 'OK'), ('broken', 'Broken'), ('error', 'Unreachable')], max_length=10),
+        ),
+        migrations.AddField(
+            model_name='recorddocument',
+            name='link_status_code',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='rtorecord',
+            name='broken_links',
+            field=models.BooleanField(db_index=True, default=False, help_text='An external document URL no longer resolves; the gallery needs republishing (see core.link_check)'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.7 on 2026-10-18 23:17
+
+from django.conf import settings
+from django.db import migrations, models
+
+from core.migration_operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('core', '0012_document_link_status'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['user', '-created_at'], name='order_user_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['payment_provider', 'payment_provider_payment_id'], name='order_provider_payment_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='printorder',
+            index=models.Index(fields=['status', '-created_at'], name='print_order_status_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='rtorecord',
+            index=models.Index(fields=['owner', '-created_at'], name='record_owner_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='rtorecord',
+            index=models.Index(fields=['owner', 'status', '-created_at'], name='record_owner_status_idx'),
+        ),
+    ]
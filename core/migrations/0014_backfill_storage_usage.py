@@ -0,0 +1,38 @@
+# Generated by Django 5.0.7 on 2026-10-18 23:40
+
+from django.db import migrations
+from django.db.models import Count, Sum
+
+from core.storage import document_storage
+
+
+def backfill_storage_usage(apps, schema_editor):
+    """Size documents copied without one, then count every owner's existing documents."""
+    RecordDocument = apps.get_model('core', 'RecordDocument')
+    StorageUsage = apps.get_model('core', 'StorageUsage')
+    documents = RecordDocument.objects.exclude(storage_key__startswith='http')
+    storage = document_storage()
+    for document in documents.filter(size__isnull=True).iterator(chunk_size=500):
+        try:
+            size = storage.size(document.storage_key)
+        except Exception:
+            continue  # missing file or storage unreachable: counted as 0 bytes
+        RecordDocument.objects.filter(pk=document.pk).update(size=size)
+
+    totals = documents.values('record__owner_id').annotate(bytes=Sum('size'), files=Count('id')).order_by()
+    for row in totals:
+        StorageUsage.objects.update_or_create(
+            user_id=row['record__owner_id'],
+            defaults={'bytes': row['bytes'] or 0, 'files': row['files']},
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_storage_usage, migrations.RunPython.noop),
+    ]
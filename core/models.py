@@ -1,6 +1,11 @@
+import mimetypes
 import os
+import threading
 import uuid
-from django.db import models
+from collections import Counter
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Count, Sum
 from django.contrib.auth import get_user_model
 from django.core.validators import FileExtensionValidator
 from django.utils import timezone
@@ -11,6 +16,10 @@ from django.core.files import File
 from PIL import Image
 import json
 
+from .storage import document_storage, digest_from_name
+from .derivatives import remove_derivatives
+from .duplicates import refresh_flags
+
 User = get_user_model()
 
 def upload_to_user_folder(instance, filename):
@@ -49,24 +58,28 @@ class RTORecord(models.Model):
     # File Uploads (these can store both local files and Cloudinary URLs)
     rc_photo = models.ImageField(
         upload_to=upload_to_user_folder,
+        storage=document_storage,
         validators=[FileExtensionValidator(allowed_extensions=['jpg', 'jpeg', 'png'])],
         blank=True, null=True,
         help_text="RC registration certificate photo"
     )
     insurance_doc = models.FileField(
         upload_to=upload_to_user_folder,
+        storage=document_storage,
         validators=[FileExtensionValidator(allowed_extensions=['pdf', 'jpg', 'jpeg', 'png'])],
         blank=True, null=True,
         help_text="Insurance document"
     )
     pu_check_doc = models.FileField(
         upload_to=upload_to_user_folder,
+        storage=document_storage,
         validators=[FileExtensionValidator(allowed_extensions=['pdf', 'jpg', 'jpeg', 'png'])],
         blank=True, null=True,
         help_text="PU check document"
     )
     driving_license_doc = models.FileField(  # FIXED: was "FileFiel"
         upload_to=upload_to_user_folder,
+        storage=document_storage,
         validators=[FileExtensionValidator(allowed_extensions=['pdf', 'jpg', 'jpeg', 'png'])],
         blank=True, null=True,
         help_text="Driving license document"
@@ -81,6 +94,10 @@ class RTORecord(models.Model):
         max_length=500, blank=True,
         help_text="Path to generated PDF card"
     )
+    review_pdf = models.FileField(
+        upload_to='review_pdfs/', blank=True, null=True,
+        help_text="Cached consolidated review PDF (rebuilt when documents change)"
+    )
     
     # Metadata
     created_at = models.DateTimeField(auto_now_add=True)
@@ -91,12 +108,29 @@ class RTORecord(models.Model):
     )
     reviewed_at = models.DateTimeField(null=True, blank=True)
     notes = models.TextField(blank=True, help_text="Internal notes for review")
+    duplicate_flag = models.BooleanField(
+        default=False, db_index=True,
+        help_text="A document nearly matches another owner's document (see DocumentMatch)"
+    )
+    broken_links = models.BooleanField(
+        default=False, db_index=True,
+        help_text="An external document URL no longer resolves; the gallery needs republishing (see core.link_check)"
+    )
+
+    # Document upload fields, in display order
+    DOCUMENT_FIELDS = ('rc_photo', 'insurance_doc', 'pu_check_doc', 'driving_license_doc')
 
     class Meta:
         db_table = 'rto_record'
         verbose_name = 'RTO Record'
         verbose_name_plural = 'RTO Records'
         ordering = ['-created_at']
+        indexes = [
+            # Dashboard and API record lists, newest first
+            models.Index(fields=['owner', '-created_at'], name='record_owner_created_idx'),
+            # Dashboard per-status counts and status-filtered lists
+            models.Index(fields=['owner', 'status', '-created_at'], name='record_owner_status_idx'),
+        ]
     
     def __str__(self):
         return f"{self.name} - {self.get_record_type_display()} ({self.get_status_display()})"
@@ -109,12 +143,7 @@ class RTORecord(models.Model):
             'name': self.name,
             'contact_no': self.contact_no,
             'record_type': self.record_type,
-            'documents': {
-                'rc_photo': self.rc_photo.url if self.rc_photo else None,
-                'insurance_doc': self.insurance_doc.url if self.insurance_doc else None,
-                'pu_check_doc': self.pu_check_doc.url if self.pu_check_doc else None,
-                'driving_license_doc': self.driving_license_doc.url if self.driving_license_doc else None,
-            },
+            'documents': {document.kind: document.url for document in self.documents.all()},
             'verification_url': f'/verify-record/{self.id}/',
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
@@ -147,13 +176,8 @@ class RTORecord(models.Model):
         return self.qr_code_image.url
 
     def get_document_count(self):
-        """Get count of uploaded documents."""
-        count = 0
-        if self.rc_photo: count += 1
-        if self.insurance_doc: count += 1
-        if self.pu_check_doc: count += 1
-        if self.driving_license_doc: count += 1
-        return count
+        """Get count of uploaded documents (uses prefetched documents when available)."""
+        return len(self.documents.all())
 
     def has_documents(self):
         """Check if record has any documents uploaded."""
@@ -169,6 +193,166 @@ class RTORecord(models.Model):
                 self.reviewed_at = timezone.now()
         super().save(*args, **kwargs)
 
+class RecordDocument(models.Model):
+    """One document attached to a record: a stored file or an external (Cloudinary) URL."""
+    
+    class Kind(models.TextChoices):
+        RC_PHOTO = 'rc_photo', 'RC Photo'
+        INSURANCE = 'insurance_doc', 'Insurance Document'
+        PU_CHECK = 'pu_check_doc', 'PU Check Document'
+        DRIVING_LICENSE = 'driving_license_doc', 'Driving License'
+        MARKS_CARD = 'marks_card', 'Marks Card'
+        PHOTO = 'photo', 'Photo'
+        CONVOCATION = 'convocation', 'Convocation Certificate'
+        MIGRATION = 'migration', 'Migration Certificate'
+        OTHER = 'other', 'Other Document'
+    
+    class LinkStatus(models.TextChoices):
+        OK = 'ok', 'OK'
+        BROKEN = 'broken', 'Broken'
+        ERROR = 'error', 'Unreachable'
+    
+    # Document kinds in upload order, per record type
+    KINDS_BY_RECORD_TYPE = {
+        'rc': [Kind.RC_PHOTO, Kind.INSURANCE, Kind.PU_CHECK, Kind.DRIVING_LICENSE],
+        'school': [Kind.MARKS_CARD, Kind.PHOTO, Kind.CONVOCATION, Kind.MIGRATION],
+    }
+    
+    record = models.ForeignKey(RTORecord, on_delete=models.CASCADE, related_name='documents')
+    kind = models.CharField(max_length=30, choices=Kind.choices, db_index=True)
+    position = models.PositiveSmallIntegerField(default=0)
+    storage_key = models.CharField(max_length=500, help_text="Storage name, or URL for external documents")
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    mime_type = models.CharField(max_length=100, blank=True)
+    derivatives = models.JSONField(default=dict, blank=True, help_text="Resized variants or PDF preview")
+    # Perceptual hash of image documents, plus its four 16-bit bands as a lookup index (see core.duplicates)
+    dhash = models.BigIntegerField(null=True, blank=True)
+    dhash_band0 = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    dhash_band1 = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    dhash_band2 = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    dhash_band3 = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    # Last health check of an external URL (see core.link_check)
+    link_status = models.CharField(max_length=10, choices=LinkStatus.choices, blank=True)
+    link_status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    link_checked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'record_document'
+        verbose_name = 'Record Document'
+        verbose_name_plural = 'Record Documents'
+        ordering = ['position', 'id']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['record', 'kind'], condition=~models.Q(kind='other'),
+                name='record_document_unique_kind',
+            ),
+        ]
+    
+    def __str__(self):
+        return f"{self.get_kind_display()} for {self.record_id}"
+    
+    @property
+    def is_external(self):
+        return self.storage_key.startswith(('http://', 'https://'))
+    
+    @property
+    def url(self):
+        if self.is_external:
+            return self.storage_key
+        return document_storage().url(self.storage_key)
+    
+    @property
+    def download_url(self):
+        """Owner-only download link (see core.media)."""
+        if self.is_external:
+            return self.storage_key
+        return reverse('core:document_download', args=[self.record_id, self.id])
+    
+    @property
+    def is_pdf(self):
+        return self.mime_type == 'application/pdf'
+    
+    @classmethod
+    def sync_field(cls, record, field):
+        """Mirror one of the record's file columns into its document row."""
+        file = getattr(record, field)
+        if not file:
+            cls.objects.filter(record=record, kind=field).delete()
+            return
+        mime_type, _ = mimetypes.guess_type(file.name)
+        try:
+            size = file.size
+        except (OSError, NotImplementedError):
+            size = None
+        document, created = cls.objects.update_or_create(
+            record=record, kind=field,
+            defaults={
+                'position': RTORecord.DOCUMENT_FIELDS.index(field),
+                'storage_key': file.name,
+                'sha256': digest_from_name(file.name) or '',
+                'size': size,
+                'mime_type': mime_type or '',
+                'derivatives': {},
+                'dhash': None,
+                'dhash_band0': None,
+                'dhash_band1': None,
+                'dhash_band2': None,
+                'dhash_band3': None,
+                'link_status': '',
+                'link_status_code': None,
+                'link_checked_at': None,
+            },
+        )
+        if not created:
+            stale = DocumentMatch.objects.filter(models.Q(document=document) | models.Q(matched_document=document))
+            record_ids = set()
+            for pair in stale.values_list('document__record_id', 'matched_document__record_id'):
+                record_ids.update(pair)
+            if record_ids:
+                stale.delete()
+                refresh_flags(record_ids)
+    
+    @classmethod
+    def attach_urls(cls, record, urls):
+        """Store external document URLs in the kind order of the record's type."""
+        kinds = cls.KINDS_BY_RECORD_TYPE.get(record.record_type, [])
+        for position, url in enumerate(urls):
+            mime_type, _ = mimetypes.guess_type(url.split('?')[0])
+            cls.objects.create(
+                record=record,
+                kind=kinds[position] if position < len(kinds) else cls.Kind.OTHER,
+                position=position,
+                storage_key=url,
+                mime_type=mime_type or '',
+            )
+
+
+class DocumentMatch(models.Model):
+    """A document that nearly matches another owner's document, awaiting officer review."""
+    
+    document = models.ForeignKey(RecordDocument, on_delete=models.CASCADE, related_name='matches')
+    matched_document = models.ForeignKey(RecordDocument, on_delete=models.CASCADE, related_name='matched_by')
+    distance = models.PositiveSmallIntegerField(help_text="Hamming distance between the perceptual hashes")
+    reviewed = models.BooleanField(default=False, db_index=True)
+    reviewed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        db_table = 'document_match'
+        verbose_name = 'Document Match'
+        verbose_name_plural = 'Document Matches'
+        ordering = ['reviewed', 'distance', '-created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['document', 'matched_document'], name='document_match_unique_pair'),
+        ]
+    
+    def __str__(self):
+        return f"{self.document} ~ {self.matched_document} ({self.distance})"
+
+
 class Order(models.Model):
     """Order model for handling payments and delivery."""
     
@@ -216,6 +400,13 @@ class Order(models.Model):
         verbose_name = 'Order'
         verbose_name_plural = 'Orders'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['payment_status', 'created_at'], name='order_status_created_idx'),
+            # Order history pages and OrderViewSet, newest first
+            models.Index(fields=['user', '-created_at'], name='order_user_created_idx'),
+            # Gateway callbacks identify orders by the provider's payment id
+            models.Index(fields=['payment_provider', 'payment_provider_payment_id'], name='order_provider_payment_idx'),
+        ]
     
     def __str__(self):
         return f"Order {self.order_id} - {self.user.email} - ₹{self.total_amount}"
@@ -272,6 +463,333 @@ class PrintOrder(models.Model):
         verbose_name = 'Print Order'
         verbose_name_plural = 'Print Orders'
         ordering = ['-created_at']
+        indexes = [
+            # Production queue and cancelled-order refunds filter by status
+            models.Index(fields=['status', '-created_at'], name='print_order_status_idx'),
+        ]
     
     def __str__(self):
         return f"Print Order {self.order.order_id} - {self.get_status_display()}"
+
+
+class StoredBlob(models.Model):
+    """Reference-counted content-addressed file shared by record documents."""
+    
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    name = models.CharField(max_length=255, help_text="Storage name of the file")
+    size = models.BigIntegerField(default=0)
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'stored_blob'
+        verbose_name = 'Stored Blob'
+        verbose_name_plural = 'Stored Blobs'
+    
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+    
+    # References taken by reserve() that the next acquire() of the same name takes over
+    _reserved = Counter()
+    _reserved_lock = threading.Lock()
+    
+    @classmethod
+    def reserve(cls, name):
+        """Take a reference to a stored file before an upload skips writing it again.
+        
+        Without it the last reference could be released, and the file deleted,
+        between the upload finding the file and its record being saved. Returns
+        False if there is no live blob row (never stored, or being deleted): the
+        caller must write the content itself. The reference is handed to the
+        next acquire() of the name in this process, or dropped by unreserve().
+        """
+        digest = digest_from_name(name)
+        if not digest:
+            return False
+        # The UPDATE waits on a concurrent delete_if_unreferenced() holding the row
+        reserved = cls.objects.filter(sha256=digest).update(
+            ref_count=F('ref_count') + 1, updated_at=timezone.now()
+        )
+        if reserved:
+            with cls._reserved_lock:
+                cls._reserved[name] += 1
+        return bool(reserved)
+    
+    @classmethod
+    def _take_reservation(cls, name):
+        with cls._reserved_lock:
+            if cls._reserved[name] <= 0:
+                return False
+            cls._reserved[name] -= 1
+            if not cls._reserved[name]:
+                del cls._reserved[name]
+            return True
+    
+    @classmethod
+    def unreserve(cls, name):
+        """Drop a reference taken by reserve() for a save that didn't change the document."""
+        digest = digest_from_name(name)
+        if digest and cls._take_reservation(name):
+            cls.objects.filter(sha256=digest).update(ref_count=F('ref_count') - 1, updated_at=timezone.now())
+    
+    @classmethod
+    def acquire(cls, name, size=0):
+        """Add a reference to a content-addressed file."""
+        digest = digest_from_name(name)
+        if not digest or cls._take_reservation(name):
+            return
+        with transaction.atomic():
+            updated = cls.objects.filter(sha256=digest).update(
+                ref_count=F('ref_count') + 1, updated_at=timezone.now()
+            )
+            if not updated:
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(sha256=digest, name=name, size=size, ref_count=1)
+                except IntegrityError:
+                    cls.objects.filter(sha256=digest).update(
+                        ref_count=F('ref_count') + 1, updated_at=timezone.now()
+                    )
+    
+    @classmethod
+    def release(cls, name):
+        """Drop a reference; the file is deleted once nothing references it."""
+        digest = digest_from_name(name)
+        if not digest:
+            return
+        cls.objects.filter(sha256=digest).update(ref_count=F('ref_count') - 1, updated_at=timezone.now())
+        
+        def delete_if_unreferenced():
+            # Re-check and delete under the row lock, so a concurrent reserve() either
+            # keeps the file alive or only finds the row gone once the file is too
+            with transaction.atomic():
+                blob = cls.objects.select_for_update().filter(sha256=digest, ref_count__lte=0).first()
+                if blob is None:
+                    return
+                blob.delete()
+                document_storage().delete(name)
+                remove_derivatives(name)
+        
+        transaction.on_commit(delete_if_unreferenced)
+
+
+class StorageUsage(models.Model):
+    """Bytes and files an owner stores in record documents, kept current incrementally by core.signals."""
+    
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='storage_usage')
+    bytes = models.BigIntegerField(default=0)
+    files = models.IntegerField(default=0)
+    quota_bytes = models.BigIntegerField(
+        null=True, blank=True,
+        help_text="Overrides the role's STORAGE_QUOTA_BYTES; empty uses the default"
+    )
+    reconciled_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'storage_usage'
+        verbose_name = 'Storage Usage'
+        verbose_name_plural = 'Storage Usage'
+    
+    def __str__(self):
+        return f"{self.user_id}: {self.bytes} bytes in {self.files} files"
+    
+    @classmethod
+    def adjust(cls, user_id, bytes_delta, files_delta):
+        """Add to an owner's counters (negative to subtract)."""
+        if not bytes_delta and not files_delta:
+            return
+        changes = {'bytes': F('bytes') + bytes_delta, 'files': F('files') + files_delta, 'updated_at': timezone.now()}
+        with transaction.atomic():
+            updated = cls.objects.filter(user_id=user_id).update(**changes)
+            # Nothing to subtract from without a row (e.g. while the owner is being deleted); reconcile fixes drift
+            if not updated and (bytes_delta > 0 or files_delta > 0):
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(user_id=user_id, bytes=bytes_delta, files=files_delta)
+                except IntegrityError:
+                    cls.objects.filter(user_id=user_id).update(**changes)
+    
+    @classmethod
+    def for_user(cls, user):
+        usage, _ = cls.objects.get_or_create(user=user)
+        return usage
+    
+    def quota(self):
+        """Byte limit for this owner, or None when unlimited."""
+        if self.quota_bytes is not None:
+            return self.quota_bytes
+        return settings.STORAGE_QUOTA_BYTES.get(self.user.role)
+
+
+class UploadSession(models.Model):
+    """A resumable (tus-style) upload of one document for a record."""
+    
+    class Status(models.TextChoices):
+        UPLOADING = 'uploading', 'Uploading'
+        COMPLETED = 'completed', 'Completed'
+        FAILED = 'failed', 'Failed'
+    
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    record = models.ForeignKey(RTORecord, on_delete=models.CASCADE, related_name='upload_sessions')
+    field = models.CharField(max_length=30, choices=[(f, f) for f in RTORecord.DOCUMENT_FIELDS])
+    filename = models.CharField(max_length=255)
+    length = models.BigIntegerField(help_text="Total size in bytes declared by the client")
+    offset = models.BigIntegerField(default=0, help_text="Bytes received and stored so far")
+    checksum = models.CharField(max_length=64, blank=True, help_text="Expected SHA-256 of the whole file, if given")
+    sha256 = models.CharField(max_length=64, blank=True, help_text="SHA-256 of the completed file")
+    status = models.CharField(max_length=20, choices=Status.choices, default=Status.UPLOADING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    expires_at = models.DateTimeField()
+    
+    class Meta:
+        db_table = 'upload_session'
+        verbose_name = 'Upload Session'
+        verbose_name_plural = 'Upload Sessions'
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"{self.filename} -> {self.record_id}.{self.field} ({self.offset}/{self.length})"
+
+
+class OrderRollup(models.Model):
+    """Pre-aggregated order counts and revenue per day, type, provider and status."""
+    
+    date = models.DateField()
+    order_type = models.CharField(max_length=20, choices=Order.OrderType.choices)
+    payment_provider = models.CharField(max_length=20, choices=[('razorpay', 'Razorpay'), ('stripe', 'Stripe')])
+    status = models.CharField(max_length=20, choices=Order.Status.choices)
+    
+    # Aggregates
+    order_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        db_table = 'order_rollup'
+        verbose_name = 'Order Rollup'
+        verbose_name_plural = 'Order Rollups'
+        ordering = ['-date', 'order_type', 'payment_provider', 'status']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['date', 'order_type', 'payment_provider', 'status'],
+                name='order_rollup_unique_key',
+            ),
+        ]
+    
+    # Order fields that determine which rollup row an order counts towards
+    SOURCE_FIELDS = ('created_at', 'order_type', 'payment_provider', 'payment_status', 'total_amount')
+    
+    def __str__(self):
+        return f"{self.date} {self.order_type}/{self.payment_provider}/{self.status}: {self.order_count} (₹{self.total_amount})"
+    
+    @staticmethod
+    def key_for(order):
+        """Return the rollup key tuple for an order (or a values() dict of one)."""
+        get = order.get if isinstance(order, dict) else lambda name: getattr(order, name)
+        return (
+            timezone.localdate(get('created_at')),
+            get('order_type'),
+            get('payment_provider'),
+            get('payment_status'),
+        )
+    
+    @classmethod
+    def apply_delta(cls, key, count, amount):
+        """Add count/amount to the rollup row for key, creating it if needed."""
+        date, order_type, payment_provider, status = key
+        lookup = dict(date=date, order_type=order_type, payment_provider=payment_provider, status=status)
+        with transaction.atomic():
+            updated = cls.objects.filter(**lookup).update(
+                order_count=F('order_count') + count,
+                total_amount=F('total_amount') + amount,
+                updated_at=timezone.now(),
+            )
+            if updated:
+                return
+            try:
+                with transaction.atomic():
+                    cls.objects.create(order_count=count, total_amount=amount, **lookup)
+            except IntegrityError:
+                # Another writer created the row between our update and insert
+                cls.objects.filter(**lookup).update(
+                    order_count=F('order_count') + count,
+                    total_amount=F('total_amount') + amount,
+                    updated_at=timezone.now(),
+                )
+    
+    @classmethod
+    def record_transition(cls, previous, order):
+        """Move an order's contribution from its previous rollup key to its current one.
+        
+        ``previous`` is a values() dict of the order before the save (None for
+        new orders); ``order`` is None when the order was deleted.
+        """
+        old_key = cls.key_for(previous) if previous else None
+        new_key = cls.key_for(order) if order is not None else None
+        old_amount = previous['total_amount'] if previous else 0
+        new_amount = order.total_amount if order is not None else 0
+        
+        if old_key == new_key and old_amount == new_amount:
+            return
+        if old_key is not None:
+            cls.apply_delta(old_key, -1, -old_amount)
+        if new_key is not None:
+            cls.apply_delta(new_key, 1, new_amount)
+    
+    @classmethod
+    def record_status_change(cls, previous_rows, new_status):
+        """Apply rollup deltas for orders moved to new_status by a queryset update().
+
+        ``previous_rows`` are values() dicts of the orders before the update.
+        """
+        deltas = {}
+        for row in previous_rows:
+            old_key = cls.key_for(row)
+            new_key = old_key[:3] + (new_status,)
+            if old_key == new_key:
+                continue
+            for key, sign in ((old_key, -1), (new_key, 1)):
+                count, amount = deltas.get(key, (0, 0))
+                deltas[key] = (count + sign, amount + sign * row['total_amount'])
+        for key, (count, amount) in deltas.items():
+            if count or amount:
+                cls.apply_delta(key, count, amount)
+
+    @classmethod
+    def rebuild(cls, start=None, end=None):
+        """Recompute rollups from the order table, optionally for a date range only."""
+        from django.db.models.functions import TruncDate
+        
+        orders = Order.objects.annotate(date=TruncDate('created_at'))
+        rollups = cls.objects.all()
+        if start:
+            orders = orders.filter(date__gte=start)
+            rollups = rollups.filter(date__gte=start)
+        if end:
+            orders = orders.filter(date__lte=end)
+            rollups = rollups.filter(date__lte=end)
+        
+        rows = (
+            orders.order_by()
+            .values('date', 'order_type', 'payment_provider', 'payment_status')
+            .annotate(order_count=Count('id'), total=Sum('total_amount'))
+        )
+        with transaction.atomic():
+            rollups.delete()
+            created = cls.objects.bulk_create([
+                cls(
+                    date=row['date'],
+                    order_type=row['order_type'],
+                    payment_provider=row['payment_provider'],
+                    status=row['payment_status'],
+                    order_count=row['order_count'],
+                    total_amount=row['total'] or 0,
+                )
+                for row in rows
+            ], batch_size=500)
+        return len(created)
@@ -0,0 +1,91 @@
+"""
+Concurrent offload of a record's uploaded files to document storage.
+
+Model.save() writes each uncommitted FileField in turn (FileField.pre_save),
+so a form carrying four documents makes four sequential uploads to a remote
+bucket inside the request. ``save_files`` pushes them to their storage on a
+bounded thread pool first (UPLOAD_OFFLOAD_WORKERS) and marks each FieldFile
+committed, so the model save that follows only writes the row.
+
+Storage names are generated on the calling thread (``upload_to`` may touch
+the database); the worker threads only stream bytes. django-storages keeps
+one boto3 connection per thread, and content-addressed saves of identical
+files racing each other are already resolved by ContentAddressedMixin.
+Each file's size and upload time is returned for logging and the
+``Server-Timing`` header.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import FileField
+from django.template.defaultfilters import filesizeformat
+
+
+@dataclass
+class OffloadTiming:
+    field: str
+    name: str
+    size: int
+    seconds: float
+
+
+def pending_files(instance):
+    """Names of the FileFields of ``instance`` holding a file not yet written to storage."""
+    pending = []
+    for field in instance._meta.fields:
+        if isinstance(field, FileField):
+            file = getattr(instance, field.attname)
+            if file and not file._committed:
+                pending.append(field.attname)
+    return pending
+
+
+def _push(file, name):
+    start = time.monotonic()
+    file.name = file.storage.save(name, file.file, max_length=file.field.max_length)
+    file._committed = True
+    return time.monotonic() - start
+
+
+def _pooled_push(file, name):
+    # Content-addressed saves reserve their blob in the database from the worker thread
+    try:
+        return _push(file, name)
+    finally:
+        connection.close()
+
+
+def save_files(instance, workers=None):
+    """Write every pending file of ``instance`` to its storage concurrently. Returns [OffloadTiming]."""
+    fields = pending_files(instance)
+    if not fields:
+        return []
+    if workers is None:
+        workers = settings.UPLOAD_OFFLOAD_WORKERS
+    files = [getattr(instance, field) for field in fields]
+    names = [file.field.generate_filename(instance, file.name) for file in files]
+    # From the upload itself; once committed, FieldFile.size asks the storage (a HEAD per file on S3)
+    sizes = [file.size for file in files]
+    if workers < 2 or len(files) == 1:
+        durations = [_push(file, name) for file, name in zip(files, names)]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(files)), thread_name_prefix='offload') as pool:
+            durations = list(pool.map(_pooled_push, files, names))
+    timings = [
+        OffloadTiming(field, file.name, size, seconds)
+        for field, file, size, seconds in zip(fields, files, sizes, durations)
+    ]
+    for timing in timings:
+        print(f"☁️ Stored {timing.field} ({filesizeformat(timing.size)}) in {timing.seconds * 1000:.0f} ms")
+    return timings
+
+
+def server_timing(timings):
+    """``Server-Timing`` header value for offload timings."""
+    return ', '.join(
+        f'offload-{timing.field};dur={timing.seconds * 1000:.1f};desc="{timing.size} bytes"'
+        for timing in timings
+    )
@@ -0,0 +1,85 @@
+"""
+Per-owner storage quotas for record documents.
+
+StorageUsage holds each owner's byte and file counters; core.signals keeps
+them current as RecordDocument rows are created, replaced and deleted, so
+checking a quota at upload time is one primary-key read instead of a walk
+over ``user_uploads/<owner_id>/``. Limits come from STORAGE_QUOTA_BYTES by
+role, or a per-user ``quota_bytes`` override. ``reconcile_storage_usage``
+recomputes the counters from the documents table to correct any drift.
+"""
+from django.db.models import Count, Sum
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+
+from .models import RecordDocument, RTORecord, StorageUsage
+
+
+class QuotaExceeded(Exception):
+    """An upload would take its owner past their storage quota."""
+
+
+def check_quota(user, incoming, released=0):
+    """Raise QuotaExceeded unless ``user`` can store ``incoming`` more bytes (after freeing ``released``)."""
+    usage = StorageUsage.for_user(user)
+    quota = usage.quota()
+    if quota is None:
+        return
+    if usage.bytes - released + incoming > quota:
+        available = max(quota - usage.bytes + released, 0)
+        raise QuotaExceeded(
+            f"Storage quota exceeded: {filesizeformat(available)} of your "
+            f"{filesizeformat(quota)} left."
+        )
+
+
+def replaced_bytes(record, kinds):
+    """Bytes of a record's documents that uploading new files for ``kinds`` would replace."""
+    if record is None or record._state.adding:
+        return 0
+    documents = RecordDocument.objects.filter(record=record, kind__in=kinds).exclude(storage_key__startswith='http')
+    return documents.aggregate(total=Sum('size'))['total'] or 0
+
+
+def quota_errors(user, files, record=None):
+    """Errors for uploaded document files (field -> UploadedFile) that don't fit the owner's quota."""
+    fields = [field for field in RTORecord.DOCUMENT_FIELDS if field in files]
+    if not fields or not user.is_authenticated:
+        return {}
+    incoming = 0
+    errors = {}
+    for field in fields:
+        incoming += files[field].size
+        try:
+            check_quota(user, incoming, released=replaced_bytes(record, fields[:fields.index(field) + 1]))
+        except QuotaExceeded as e:
+            errors[field] = str(e)
+            incoming -= files[field].size
+    return errors
+
+
+def reconcile(user_ids=None):
+    """Recompute storage counters from the documents table. Returns [(user_id, bytes_drift, files_drift)]."""
+    documents = RecordDocument.objects.exclude(storage_key__startswith='http')
+    usages = StorageUsage.objects.all()
+    if user_ids is not None:
+        documents = documents.filter(record__owner_id__in=user_ids)
+        usages = usages.filter(user_id__in=user_ids)
+    totals = {
+        row['record__owner_id']: (row['bytes'] or 0, row['files'])
+        for row in documents.values('record__owner_id').annotate(bytes=Sum('size'), files=Count('id')).order_by()
+    }
+    drift = []
+    now = timezone.now()
+    stored = {usage.user_id: usage for usage in usages}
+    for user_id in set(totals) | set(stored):
+        actual_bytes, actual_files = totals.get(user_id, (0, 0))
+        usage = stored.get(user_id)
+        counted = (usage.bytes, usage.files) if usage else (0, 0)
+        if counted != (actual_bytes, actual_files):
+            drift.append((user_id, counted[0] - actual_bytes, counted[1] - actual_files))
+        StorageUsage.objects.update_or_create(
+            user_id=user_id,
+            defaults={'bytes': actual_bytes, 'files': actual_files, 'reconciled_at': now},
+        )
+    return drift
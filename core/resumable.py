@@ -0,0 +1,267 @@
+"""
+Resumable document uploads following the tus 1.0 protocol.
+
+A client creates an upload with ``POST /api/uploads/`` (``Upload-Length`` and
+``Upload-Metadata`` naming the record and document field), then sends the
+bytes with one or more ``PATCH`` requests carrying ``Upload-Offset``. After a
+dropped connection it asks ``HEAD`` for the stored offset and resumes from
+there, so a retry only re-sends the missing bytes.
+
+Chunks are appended to a staging file under UPLOAD_STAGING_DIR; bytes that
+arrived before a connection dropped are kept. A chunk may carry a tus
+``Upload-Checksum`` (sha256) and the whole file may declare one in its
+metadata. Once the last byte arrives the file is verified, type-checked and
+moved into the record's document field through the content-addressed
+storage.
+"""
+import base64
+import binascii
+import hashlib
+import os
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import transaction
+from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
+
+from .models import RTORecord, UploadSession
+from .quotas import QuotaExceeded, check_quota, replaced_bytes
+from .uploads import IMAGE_FIELDS, field_rules, sniff_type
+
+TUS_VERSION = '1.0.0'
+TUS_EXTENSIONS = 'creation,checksum,termination,expiration'
+CHECKSUM_ALGORITHMS = 'sha256'
+
+# HTTP status tus uses for a failed checksum
+CHECKSUM_MISMATCH = 460
+
+
+class UploadError(Exception):
+    """A protocol or validation error, reported with an HTTP status."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class StagedFile(File):
+    """A completed staging file; FileSystemStorage moves it into place instead of copying."""
+
+    def __init__(self, file, name, sha256):
+        super().__init__(file, name)
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def parse_metadata(header):
+    """Decode an Upload-Metadata header ("key base64value,key2 base64value2")."""
+    metadata = {}
+    for pair in filter(None, (part.strip() for part in (header or '').split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value).decode() if value else ''
+        except (binascii.Error, UnicodeDecodeError):
+            raise UploadError(f"Invalid Upload-Metadata value for '{key}'")
+    return metadata
+
+
+def staging_path(session):
+    return os.path.join(settings.UPLOAD_STAGING_DIR, 'resumable', f"{session.id}.part")
+
+
+def _allowed_extensions(field):
+    if field in IMAGE_FIELDS:
+        return settings.ALLOWED_IMAGE_EXTENSIONS
+    return settings.ALLOWED_DOCUMENT_EXTENSIONS
+
+
+def start_upload(user, length, metadata):
+    """Validate a creation request and open an UploadSession with an empty staging file."""
+    try:
+        length = int(length)
+    except (TypeError, ValueError):
+        raise UploadError("Upload-Length header is required")
+    field = metadata.get('field', '')
+    if field not in RTORecord.DOCUMENT_FIELDS:
+        raise UploadError(f"metadata 'field' must be one of: {', '.join(RTORecord.DOCUMENT_FIELDS)}")
+    try:
+        record = RTORecord.objects.filter(pk=metadata.get('record'), owner=user).first()
+    except (ValueError, ValidationError):
+        record = None
+    if record is None:
+        raise UploadError("metadata 'record' must be the id of one of your records", status=404)
+    filename = os.path.basename(metadata.get('filename', '')) or f"{field}.bin"
+    ext = os.path.splitext(filename)[1].lstrip('.').lower()
+    if ext not in _allowed_extensions(field):
+        raise UploadError(f"File extension '{ext}' is not allowed for {field}")
+    max_size, _ = field_rules(field)
+    if not 0 < length <= max_size:
+        raise UploadError(f"File too large (limit {filesizeformat(max_size)}).", status=413)
+    try:
+        check_quota(user, length, released=replaced_bytes(record, [field]))
+    except QuotaExceeded as e:
+        raise UploadError(str(e), status=413)
+    checksum = metadata.get('checksum', '').lower()
+    if checksum and len(checksum) != 64:
+        raise UploadError("metadata 'checksum' must be a hex SHA-256 digest")
+
+    session = UploadSession.objects.create(
+        owner=user,
+        record=record,
+        field=field,
+        filename=filename,
+        length=length,
+        checksum=checksum,
+        expires_at=timezone.now() + timedelta(hours=settings.RESUMABLE_UPLOAD_EXPIRY_HOURS),
+    )
+    path = staging_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return session
+
+
+@contextmanager
+def upload_lock(session):
+    """Hold an unfinished upload exclusively across every worker, or fail with 423."""
+    store = caches[settings.RESUMABLE_UPLOAD_CACHE_ALIAS]
+    lock_key = f"upload_session:{session.id}:lock"
+    if not store.add(lock_key, 1, settings.RESUMABLE_UPLOAD_LOCK_TTL):
+        raise UploadError("Another request is writing to this upload", status=423)
+    try:
+        session.refresh_from_db(fields=['offset', 'status'])
+        if session.status != UploadSession.Status.UPLOADING:
+            raise UploadError("Upload is already finished", status=403)
+        yield session
+    finally:
+        store.delete(lock_key)
+
+
+def _parse_chunk_checksum(header):
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm != 'sha256':
+        raise UploadError(f"Unsupported checksum algorithm '{algorithm}'")
+    try:
+        return base64.b64decode(value)
+    except binascii.Error:
+        raise UploadError("Invalid Upload-Checksum value")
+
+
+def append_chunk(session, offset, stream, checksum_header=None):
+    """Append the request body at ``offset``; returns the new offset.
+
+    Without a chunk checksum, bytes received before a dropped connection are
+    kept so the client can resume after them. With one, the chunk is kept
+    only if it arrived whole and matches.
+    """
+    if session.status != UploadSession.Status.UPLOADING:
+        raise UploadError("Upload is already finished", status=403)
+    if session.expires_at <= timezone.now():
+        raise UploadError("Upload has expired", status=410)
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        raise UploadError("Upload-Offset header is required")
+    expected_digest = _parse_chunk_checksum(checksum_header)
+
+    with upload_lock(session):
+        if offset != session.offset:
+            raise UploadError(f"Upload-Offset {offset} does not match stored offset {session.offset}", status=409)
+
+        path = staging_path(session)
+        remaining = session.length - offset
+        digest = hashlib.sha256()
+        written = 0
+        interrupted = None
+        # Drop anything past the recorded offset left by a write that never got recorded
+        os.truncate(path, offset)
+        with open(path, 'ab') as staged:
+            try:
+                while written < remaining:
+                    chunk = stream.read(min(settings.RESUMABLE_UPLOAD_READ_SIZE, remaining - written))
+                    if not chunk:
+                        break
+                    if offset == 0 and written == 0:
+                        _check_type(session, chunk)
+                    staged.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+                if stream.read(1):
+                    interrupted = UploadError("Chunk extends past Upload-Length", status=413)
+            except OSError as e:
+                # Client went away mid-chunk; keep what arrived unless it has to be verified
+                interrupted = e
+            staged.flush()
+            os.fsync(staged.fileno())
+
+        if expected_digest is not None and (interrupted or digest.digest() != expected_digest):
+            os.truncate(path, offset)
+            if interrupted:
+                raise interrupted
+            raise UploadError("Chunk checksum mismatch", status=CHECKSUM_MISMATCH)
+
+        session.offset = offset + written
+        UploadSession.objects.filter(pk=session.pk).update(offset=session.offset, updated_at=timezone.now())
+        if isinstance(interrupted, UploadError):
+            raise interrupted
+
+        if session.offset == session.length:
+            complete_upload(session)
+    return session.offset
+
+
+def _check_type(session, head):
+    _, allowed_types = field_rules(session.field)
+    if sniff_type(head[:16]) not in allowed_types:
+        allowed = ', '.join(sorted(allowed_types)).upper()
+        raise UploadError(f"Unsupported file type. Allowed: {allowed}.", status=415)
+
+
+def complete_upload(session):
+    """Verify a fully received upload and attach it to its record field. Call under upload_lock."""
+    path = staging_path(session)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as staged:
+        head = staged.read(16)
+        staged.seek(0)
+        for chunk in iter(lambda: staged.read(1024 * 1024), b''):
+            digest.update(chunk)
+    sha256 = digest.hexdigest()
+    if session.checksum and sha256 != session.checksum:
+        discard_upload(session, status=UploadSession.Status.FAILED)
+        raise UploadError("Checksum of the completed upload does not match", status=CHECKSUM_MISMATCH)
+    _check_type(session, head)
+
+    with transaction.atomic():
+        record = RTORecord.objects.select_for_update().get(pk=session.record_id)
+        with open(path, 'rb') as staged:
+            getattr(record, session.field).save(session.filename, StagedFile(staged, session.filename, sha256), save=False)
+        record.save()
+        session.sha256 = sha256
+        session.status = UploadSession.Status.COMPLETED
+        session.save(update_fields=['sha256', 'status', 'updated_at'])
+    if os.path.exists(path):
+        # Content was already stored, so the staging file was not moved
+        os.remove(path)
+    return record
+
+
+def discard_upload(session, status=None):
+    """Remove an upload's staging file, and the session unless a final status is given."""
+    try:
+        os.remove(staging_path(session))
+    except FileNotFoundError:
+        pass
+    if status:
+        session.status = status
+        session.save(update_fields=['status', 'updated_at'])
+    else:
+        session.delete()
@@ -0,0 +1,211 @@
+"""
+Consolidated review PDF of a record.
+
+Reviewers get one file instead of opening up to four documents: a cover
+page (name, contact, type, status, document list) followed by every image
+document and every page of every PDF document, each downscaled to
+REVIEW_PDF_MAX_DIMENSION and embedded as a JPEG, with page compression on.
+
+Decoding and downscaling happen in a thread pool (Pillow and poppler
+release the GIL while working). PDF pages are rasterized with PyMuPDF,
+falling back to poppler's ``pdftoppm``; if neither is available a
+placeholder page points to the original. Document bytes come through the
+local file cache, so remote storages work too.
+
+The result is cached in ``RTORecord.review_pdf`` under a name fingerprinting
+the documents and cover fields; it is rebuilt when any of them change, and
+core.signals deletes it as soon as a document field changes.
+"""
+import glob
+import hashlib
+import io
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+from .derivatives import PDF_RENDER_TIMEOUT, PreviewUnavailable, _flatten
+from .file_cache import file_cache
+from .storage import document_storage
+
+MARGIN = 36
+CAPTION_HEIGHT = 24
+
+
+def fingerprint(record, documents):
+    """Hash of everything the review PDF shows."""
+    parts = [record.name, record.contact_no, record.record_type, record.status]
+    parts += [f"{document.kind}:{document.storage_key}" for document in documents]
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()[:16]
+
+
+def _jpeg(img):
+    img.thumbnail((settings.REVIEW_PDF_MAX_DIMENSION,) * 2, Image.LANCZOS)
+    out = io.BytesIO()
+    _flatten(img).save(out, 'JPEG', quality=settings.REVIEW_PDF_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def image_pages(path):
+    """An image document as one downscaled JPEG."""
+    with Image.open(path) as img:
+        if img.format == 'JPEG':
+            img.draft('RGB', (settings.REVIEW_PDF_MAX_DIMENSION,) * 2)
+        return [_jpeg(ImageOps.exif_transpose(img))]
+
+
+def pdf_pages(path):
+    """Every page (up to REVIEW_PDF_MAX_PAGES) of a PDF document as downscaled JPEGs."""
+    dpi = settings.REVIEW_PDF_DPI
+    last = settings.REVIEW_PDF_MAX_PAGES
+    try:
+        import pymupdf
+    except ImportError:
+        pymupdf = None
+    if pymupdf is not None:
+        pages = []
+        with pymupdf.open(path) as doc:
+            for page in list(doc)[:last]:
+                pixmap = page.get_pixmap(dpi=dpi, alpha=False)
+                pages.append(_jpeg(Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)))
+        return pages
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            subprocess.run(
+                ['pdftoppm', '-r', str(dpi), '-l', str(last), '-png', path, os.path.join(tmp, 'page')],
+                check=True, capture_output=True, timeout=PDF_RENDER_TIMEOUT * last,
+            )
+            pages = []
+            for rendered in sorted(glob.glob(os.path.join(tmp, 'page*.png'))):
+                with Image.open(rendered) as img:
+                    pages.append(_jpeg(img))
+            return pages
+    except FileNotFoundError:
+        raise PreviewUnavailable("Install PyMuPDF or poppler-utils to include PDF pages")
+
+
+def _render(document):
+    path = file_cache().local_path(document_storage(), document.storage_key, document.sha256 or None)
+    if document.is_pdf or document.storage_key.lower().endswith('.pdf'):
+        return pdf_pages(path)
+    return image_pages(path)
+
+
+def _cover(pdf, record, documents):
+    width, height = A4
+    pdf.setFont("Helvetica-Bold", 20)
+    pdf.drawString(MARGIN, height - 80, "Record Review")
+    pdf.setFont("Helvetica", 12)
+    rows = [
+        ("Name", record.name),
+        ("Contact", record.contact_no),
+        ("Type", record.get_record_type_display()),
+        ("Status", record.get_status_display()),
+        ("Record ID", str(record.id)),
+        ("Submitted", record.created_at.strftime('%Y-%m-%d %H:%M') if record.created_at else ''),
+    ]
+    y = height - 120
+    for label, value in rows:
+        pdf.setFont("Helvetica-Bold", 12)
+        pdf.drawString(MARGIN, y, f"{label}:")
+        pdf.setFont("Helvetica", 12)
+        pdf.drawString(MARGIN + 90, y, value)
+        y -= 22
+    y -= 12
+    pdf.setFont("Helvetica-Bold", 14)
+    pdf.drawString(MARGIN, y, "Documents")
+    pdf.setFont("Helvetica", 12)
+    for document in documents:
+        y -= 20
+        pdf.drawString(MARGIN + 10, y, f"• {document.get_kind_display()}")
+    pdf.setFont("Helvetica-Oblique", 9)
+    pdf.drawString(MARGIN, 30, f"Generated {timezone.localtime():%Y-%m-%d %H:%M}")
+    pdf.showPage()
+
+
+def _image_page(pdf, jpeg, caption):
+    width, height = A4
+    reader = ImageReader(io.BytesIO(jpeg))
+    img_width, img_height = reader.getSize()
+    box_width, box_height = width - 2 * MARGIN, height - 2 * MARGIN - CAPTION_HEIGHT
+    scale = min(box_width / img_width, box_height / img_height, 1.0)
+    draw_width, draw_height = img_width * scale, img_height * scale
+    pdf.setFont("Helvetica-Bold", 11)
+    pdf.drawString(MARGIN, height - MARGIN - 12, caption)
+    pdf.drawImage(
+        reader, (width - draw_width) / 2, height - MARGIN - CAPTION_HEIGHT - draw_height,
+        width=draw_width, height=draw_height,
+    )
+    pdf.showPage()
+
+
+def _placeholder_page(pdf, caption, reason):
+    width, height = A4
+    pdf.setFont("Helvetica-Bold", 11)
+    pdf.drawString(MARGIN, height - MARGIN - 12, caption)
+    pdf.setFont("Helvetica", 11)
+    pdf.drawString(MARGIN, height / 2, f"Not included: {reason}")
+    pdf.drawString(MARGIN, height / 2 - 18, "Open the original document from the record page.")
+    pdf.showPage()
+
+
+def build_review_pdf(record, documents):
+    """Render the review PDF of ``record`` and return its bytes."""
+    local = [document for document in documents if not document.is_external]
+    with ThreadPoolExecutor(max_workers=settings.REVIEW_PDF_WORKERS) as pool:
+        futures = [pool.submit(_render, document) for document in local]
+
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4, pageCompression=1)
+    pdf.setTitle(f"Review - {record.name}")
+    _cover(pdf, record, documents)
+    for document, future in zip(local, futures):
+        label = document.get_kind_display()
+        try:
+            pages = future.result()
+        except PreviewUnavailable as e:
+            _placeholder_page(pdf, label, str(e))
+            continue
+        except Exception as e:
+            print(f"❌ Review PDF page failed for {record.id} {document.kind}: {e}")
+            _placeholder_page(pdf, label, "the file could not be read")
+            continue
+        for number, jpeg in enumerate(pages, 1):
+            caption = f"{label} (page {number} of {len(pages)})" if len(pages) > 1 else label
+            _image_page(pdf, jpeg, caption)
+    for document in documents:
+        if document.is_external:
+            _placeholder_page(pdf, document.get_kind_display(), f"hosted externally at {document.storage_key}")
+    pdf.save()
+    return buffer.getvalue()
+
+
+def review_pdf(record):
+    """The record's review PDF (a FieldFile), built now unless the cached one is current."""
+    documents = list(record.documents.all())
+    expected = f"review_{record.id}_{fingerprint(record, documents)}"
+    current = record.review_pdf.name or ''
+    if current and os.path.basename(current).startswith(expected) and record.review_pdf.storage.exists(current):
+        return record.review_pdf
+
+    content = build_review_pdf(record, documents)
+    discard_review_pdf(record)
+    record.review_pdf.save(f"{expected}.pdf", ContentFile(content), save=False)
+    type(record).objects.filter(pk=record.pk).update(review_pdf=record.review_pdf.name)
+    print(f"📄 Built review PDF for {record.id} ({len(content)} bytes)")
+    return record.review_pdf
+
+
+def discard_review_pdf(record):
+    """Delete the cached review PDF of a record."""
+    if record.review_pdf:
+        record.review_pdf.delete(save=False)
+        type(record).objects.filter(pk=record.pk).update(review_pdf='')
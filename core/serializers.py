@@ -1,6 +1,40 @@
 from rest_framework import serializers
-from .models import RTORecord, Order, PrintOrder
+from .models import RTORecord, RecordDocument, DocumentMatch, Order, PrintOrder
 from authentication.models import User
+from .signed_urls import record_signed_urls
+
+class RecordDocumentSerializer(serializers.ModelSerializer):
+    """Read-only serializer for a record's documents."""
+    
+    url = serializers.ReadOnlyField()
+    
+    class Meta:
+        model = RecordDocument
+        fields = ['id', 'kind', 'position', 'url', 'download_url', 'sha256', 'size', 'mime_type', 'derivatives']
+        read_only_fields = fields
+
+class MatchedDocumentSerializer(serializers.ModelSerializer):
+    """A document as shown to officers reviewing near-duplicates."""
+    
+    url = serializers.ReadOnlyField()
+    record_name = serializers.CharField(source='record.name', read_only=True)
+    owner = serializers.EmailField(source='record.owner.email', read_only=True)
+    
+    class Meta:
+        model = RecordDocument
+        fields = ['id', 'record', 'record_name', 'owner', 'kind', 'url', 'sha256']
+        read_only_fields = fields
+
+class DocumentMatchSerializer(serializers.ModelSerializer):
+    """Read-only serializer for near-duplicate document matches."""
+    
+    document = MatchedDocumentSerializer(read_only=True)
+    matched_document = MatchedDocumentSerializer(read_only=True)
+    
+    class Meta:
+        model = DocumentMatch
+        fields = ['id', 'document', 'matched_document', 'distance', 'reviewed', 'created_at']
+        read_only_fields = fields
 
 class RTORecordSerializer(serializers.ModelSerializer):
     """Serializer for RTO Record with file upload handling."""
@@ -8,6 +42,7 @@ class RTORecordSerializer(serializers.ModelSerializer):
     document_count = serializers.SerializerMethodField()
     has_documents = serializers.SerializerMethodField()
     qr_code_url = serializers.SerializerMethodField()
+    documents = RecordDocumentSerializer(many=True, read_only=True)
     
     class Meta:
         model = RTORecord
@@ -15,10 +50,23 @@ class RTORecordSerializer(serializers.ModelSerializer):
             'id', 'name', 'contact_no', 'address', 'record_type', 'status',
             'rc_photo', 'insurance_doc', 'pu_check_doc', 'driving_license_doc',
             'qr_code_image', 'created_at', 'updated_at', 'document_count',
-            'has_documents', 'qr_code_url'
+            'has_documents', 'qr_code_url', 'documents'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at', 'qr_code_image']
     
+    def to_representation(self, instance):
+        """Replace document file and URL fields with signed, expiring URLs."""
+        data = super().to_representation(instance)
+        signed = record_signed_urls(instance)
+        kinds = {document.kind: document.id for document in instance.documents.all()}
+        for field in RTORecord.DOCUMENT_FIELDS:
+            if data.get(field) and kinds.get(field) in signed:
+                data[field] = signed[kinds[field]][0]
+        for document in data.get('documents', []):
+            if document['id'] in signed:
+                document['url'], document['download_url'] = signed[document['id']]
+        return data
+    
     def get_document_count(self, obj):
         return obj.get_document_count()
     
@@ -57,3 +105,17 @@ class PaymentSerializer(serializers.Serializer):
     delivery_address = serializers.CharField(max_length=500, required=False)
     delivery_phone = serializers.CharField(max_length=20, required=False)
     delivery_pincode = serializers.CharField(max_length=10, required=False)
+
+class DirectUploadSerializer(serializers.Serializer):
+    """Serializer for presigned direct upload requests."""
+    record_id = serializers.UUIDField()
+    field = serializers.ChoiceField(choices=RTORecord.DOCUMENT_FIELDS)
+    filename = serializers.CharField(max_length=255)
+    content_type = serializers.CharField(max_length=100)
+    size = serializers.IntegerField(min_value=1)
+    sha256 = serializers.RegexField(r'^[0-9a-fA-F]{64}$')
+    method = serializers.ChoiceField(choices=['post', 'put'], default='post')
+
+class DirectUploadCompleteSerializer(serializers.Serializer):
+    """Serializer for completing a presigned direct upload."""
+    token = serializers.CharField()
@@ -0,0 +1,136 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .derivatives import schedule_record_derivatives
+from .review_pdf import discard_review_pdf
+from .models import Order, OrderRollup, RecordDocument, RTORecord, StorageUsage, StoredBlob
+
+ROLLUP_FIELDS = OrderRollup.SOURCE_FIELDS
+
+
+
+@receiver(pre_save, sender=Order)
+def remember_order_state(sender, instance, raw=False, **kwargs):
+    """Stash the stored rollup key of an order before it is overwritten."""
+    if raw:
+        return
+    instance._rollup_previous = None
+    if instance.pk:
+        instance._rollup_previous = (
+            Order.objects.filter(pk=instance.pk).values(*ROLLUP_FIELDS).first()
+        )
+
+
+@receiver(post_save, sender=Order)
+def update_order_rollups(sender, instance, raw=False, **kwargs):
+    """Keep OrderRollup in step with order status transitions."""
+    if raw:
+        return
+    OrderRollup.record_transition(getattr(instance, '_rollup_previous', None), instance)
+    instance._rollup_previous = None
+
+
+@receiver(post_delete, sender=Order)
+def remove_order_from_rollups(sender, instance, **kwargs):
+    """Take a deleted order out of its rollup row."""
+    previous = {field: getattr(instance, field) for field in ROLLUP_FIELDS}
+    OrderRollup.record_transition(previous, None)
+
+
+def _document_fields(record):
+    return {field: getattr(record, field).name or None for field in RTORecord.DOCUMENT_FIELDS}
+
+
+def _document_names(fields):
+    return Counter(name for name in fields.values() if name)
+
+
+@receiver(pre_save, sender=RTORecord)
+def remember_document_names(sender, instance, raw=False, **kwargs):
+    """Stash the stored document names of a record before it is overwritten."""
+    if raw:
+        return
+    instance._stored_documents = {}
+    if not instance._state.adding:
+        row = RTORecord.objects.filter(pk=instance.pk).values(*RTORecord.DOCUMENT_FIELDS).first()
+        if row:
+            instance._stored_documents = {field: name or None for field, name in row.items()}
+
+
+@receiver(post_save, sender=RTORecord)
+def update_document_rows(sender, instance, raw=False, **kwargs):
+    """Sync RecordDocument rows and blob references with the document columns changed by this save."""
+    if raw:
+        return
+    before = getattr(instance, '_stored_documents', {})
+    after = _document_fields(instance)
+    changed = [field for field in RTORecord.DOCUMENT_FIELDS if before.get(field) != after[field]]
+    for field in changed:
+        RecordDocument.sync_field(instance, field)
+
+    previous, current = _document_names(before), _document_names(after)
+    sizes = dict(RecordDocument.objects.filter(record=instance).values_list('storage_key', 'size'))
+    for name, count in (current - previous).items():
+        for _ in range(count):
+            StoredBlob.acquire(name, sizes.get(name) or 0)
+    for name, count in (previous - current).items():
+        for _ in range(count):
+            StoredBlob.release(name)
+    for name in previous & current:
+        # Re-uploaded the file the record already had: it holds a reference already
+        StoredBlob.unreserve(name)
+    if changed:
+        discard_review_pdf(instance)
+        record_id = instance.pk
+        transaction.on_commit(lambda: schedule_record_derivatives(record_id))
+    instance._stored_documents = after
+
+
+@receiver(post_delete, sender=RTORecord)
+def release_blob_references(sender, instance, **kwargs):
+    """Release a deleted record's documents."""
+    for name, count in _document_names(_document_fields(instance)).items():
+        for _ in range(count):
+            StoredBlob.release(name)
+
+
+def _counted(document):
+    """(bytes, files) a document adds to its owner's storage usage."""
+    if document is None or document.is_external:
+        return 0, 0
+    return document.size or 0, 1
+
+
+@receiver(pre_save, sender=RecordDocument)
+def remember_document_size(sender, instance, raw=False, **kwargs):
+    """Stash what a document row counted towards storage usage before it is overwritten."""
+    instance._stored_usage = (0, 0)
+    if raw or instance._state.adding:
+        return
+    stored = RecordDocument.objects.filter(pk=instance.pk).only('storage_key', 'size').first()
+    instance._stored_usage = _counted(stored)
+
+
+@receiver(post_save, sender=RecordDocument)
+def update_storage_usage(sender, instance, raw=False, **kwargs):
+    """Apply the change in a document's size to its owner's counters."""
+    if raw:
+        return
+    size, files = _counted(instance)
+    stored_size, stored_files = getattr(instance, '_stored_usage', (0, 0))
+    if (size, files) != (stored_size, stored_files):
+        StorageUsage.adjust(instance.record.owner_id, size - stored_size, files - stored_files)
+    instance._stored_usage = (size, files)
+
+
+@receiver(post_delete, sender=RecordDocument)
+def release_storage_usage(sender, instance, **kwargs):
+    """Take a deleted document out of its owner's counters."""
+    size, files = _counted(instance)
+    if files:
+        owner_id = RTORecord.objects.filter(pk=instance.record_id).values_list('owner_id', flat=True).first()
+        if owner_id:
+            StorageUsage.adjust(owner_id, -size, -files)
@@ -0,0 +1,189 @@
+"""
+Signed, expiring delivery URLs for record documents.
+
+Galleries and API responses hand out document URLs instead of public media
+paths. ``signed_urls`` signs every document of a record in one go and keeps
+the result in the shared cache (SIGNED_URL_CACHE_ALIAS, seen by every
+worker) until SIGNED_URL_REFRESH_MARGIN before the signatures expire, so
+repeated views of a record (and list pages via one ``get_many``) cost a
+cache read instead of re-signing each URL:
+
+- documents in an S3 bucket get presigned GET URLs (one inline, one with an
+  attachment Content-Disposition), using the process-wide boto3 client;
+- documents on the local filesystem get a Django-signed token for
+  ``signed_document_view``, which serves the file (or one of its rendered
+  variants) to whoever holds an unexpired token;
+- external (Cloudinary) URLs are public assets and are passed through.
+
+The cache key fingerprints the documents' storage keys, so replacing a
+document simply misses the cache.
+
+Published (Netlify) galleries live for as long as their printed QR code, so
+they can't embed expiring URLs. They link to ``gallery_url`` instead: a
+stable, absolute app URL (SIGNED_URL_BASE, else the publishing request's
+host) carrying a non-expiring signed document id, which
+``gallery_document_view`` redirects to a freshly signed URL of the document
+or one of its variants.
+"""
+import hashlib
+import os
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from .storage import document_storage, local_path, storage_key
+
+SIGNING_SALT = 'core.signed_urls'
+GALLERY_SALT = 'core.signed_urls.gallery'
+CACHE_PREFIX = 'signed_urls:'
+
+
+def _cache():
+    return caches[settings.SIGNED_URL_CACHE_ALIAS]
+
+
+def _cache_key(record, documents, ttl):
+    fingerprint = hashlib.sha1(
+        '\n'.join(f"{document.id}:{document.storage_key}" for document in documents).encode()
+    ).hexdigest()
+    return f"{CACHE_PREFIX}{record.pk}:{ttl}:{fingerprint}"
+
+
+def _filename(document):
+    return f"{document.kind}{os.path.splitext(document.storage_key)[1]}"
+
+
+def _key_digest(name):
+    """Short hash of a storage name, so tokens die with replaced files without revealing the name."""
+    return hashlib.sha256(name.encode()).hexdigest()[:16]
+
+
+def _sign_local(document, ttl, variant=''):
+    grant = [document.id, _key_digest(document.storage_key), int(time.time()) + ttl]
+    token = signing.dumps(grant + [variant] if variant else grant, salt=SIGNING_SALT)
+    url = settings.SIGNED_URL_BASE.rstrip('/') + reverse('core:signed_document', args=[token])
+    return url, f"{url}?{urlencode({'download': 1})}"
+
+
+def _sign_s3(document, ttl, name=None):
+    from .direct_uploads import s3_client
+    params = {
+        'Bucket': settings.AWS_STORAGE_BUCKET_NAME,
+        'Key': storage_key(document_storage(), name or document.storage_key),
+    }
+    client = s3_client()
+    url = client.generate_presigned_url('get_object', Params=params, ExpiresIn=ttl)
+    params['ResponseContentDisposition'] = f'attachment; filename="{_filename(document)}"'
+    return url, client.generate_presigned_url('get_object', Params=params, ExpiresIn=ttl)
+
+
+def variant_name(document, variant):
+    """Storage name of a rendered variant ("<width>.<format>") of a document, or None if it has none such."""
+    from .derivatives import FORMATS, derivative_dir
+    entry = document.derivatives or {}
+    width, _, extension = variant.partition('.')
+    if entry.get('source') != document.storage_key or extension not in dict(FORMATS):
+        return None
+    if not any(str(v['width']) == width for v in entry.get('variants', [])):
+        return None
+    return f"{derivative_dir(document.storage_key)}/{width}.{extension}"
+
+
+def sign_document(document, ttl):
+    """(url, download_url) for one document, valid for ``ttl`` seconds."""
+    if document.is_external:
+        url = document.storage_key
+        return url, url if '?' in url else f"{url}?fl_attachment"
+    if local_path(document_storage(), document.storage_key) is not None:
+        return _sign_local(document, ttl)
+    return _sign_s3(document, ttl)
+
+
+def signed_urls(records, ttl=None):
+    """{record_id: {document_id: (url, download_url)}} for ``records`` (prefetch their documents)."""
+    ttl = ttl or settings.SIGNED_URL_TTL
+    keyed = {}
+    for record in records:
+        documents = list(record.documents.all())
+        keyed[_cache_key(record, documents, ttl)] = (record, documents)
+    cached = _cache().get_many(list(keyed))
+    fresh = {}
+    result = {}
+    for key, (record, documents) in keyed.items():
+        urls = cached.get(key)
+        if urls is None:
+            urls = fresh[key] = {document.id: sign_document(document, ttl) for document in documents}
+        result[record.pk] = urls
+    if fresh:
+        _cache().set_many(fresh, timeout=ttl - min(settings.SIGNED_URL_REFRESH_MARGIN, ttl // 2))
+    return result
+
+
+def record_signed_urls(record, ttl=None):
+    """{document_id: (url, download_url)} for one record."""
+    return signed_urls([record], ttl)[record.pk]
+
+
+def verify_token(token):
+    """(RecordDocument, variant) an unexpired token grants, or (None, '') if it has been replaced or deleted.
+
+    ``variant`` is empty for the document itself. Raises signing.BadSignature
+    (or SignatureExpired) for invalid tokens.
+    """
+    from .models import RecordDocument
+    document_id, digest, expires, *variant = signing.loads(token, salt=SIGNING_SALT)
+    if expires < time.time():
+        raise signing.SignatureExpired("Signed URL has expired")
+    document = RecordDocument.objects.filter(pk=document_id).first()
+    if document is None or _key_digest(document.storage_key) != digest:
+        return None, ''
+    return document, ''.join(variant)
+
+
+def is_absolute_base(base):
+    parts = urlsplit(base)
+    return parts.scheme in ('http', 'https') and bool(parts.netloc)
+
+
+def gallery_base(request=None):
+    """Absolute app URL published galleries link back to: SIGNED_URL_BASE, else the publishing request's host."""
+    base = settings.SIGNED_URL_BASE.rstrip('/')
+    if is_absolute_base(base):
+        return base
+    if request is not None:
+        return request.build_absolute_uri('/').rstrip('/')
+    raise ImproperlyConfigured(
+        "SIGNED_URL_BASE must be the app's absolute URL (e.g. https://app.example.com) to publish galleries"
+    )
+
+
+def gallery_url(document, base, **params):
+    """Stable link under ``base`` to a document for a published gallery (``download=1`` or ``variant='640.webp'``)."""
+    token = signing.dumps(document.id, salt=GALLERY_SALT)
+    url = base + reverse('core:gallery_document', args=[token])
+    return f"{url}?{urlencode(params)}" if params else url
+
+
+def gallery_document(token):
+    """The RecordDocument a gallery link points at, or None once it has been deleted.
+
+    Raises signing.BadSignature for invalid tokens.
+    """
+    from .models import RecordDocument
+    return RecordDocument.objects.filter(pk=signing.loads(token, salt=GALLERY_SALT)).first()
+
+
+def sign_variant(document, variant, ttl):
+    """Signed URL of a rendered variant ("<width>.<format>") of a stored document, or None if it has none such."""
+    name = variant_name(document, variant)
+    if name is None:
+        return None
+    if local_path(document_storage(), name) is not None:
+        return _sign_local(document, ttl, variant)[0]
+    return _sign_s3(document, ttl, name)[0]
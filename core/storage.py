@@ -0,0 +1,113 @@
+"""
+Content-addressed storage for record documents.
+
+Files are stored once under ``cas/<aa>/<bb>/<sha256><ext>`` no matter how
+many records (or owners) upload them. The hash comes from the upload
+handler when available and is computed by streaming the file otherwise; an
+upload whose content is already stored skips the write entirely, after
+reserving a reference so the file can't be deleted before the record is
+saved. References are counted in StoredBlob by core.signals and the file is
+removed when the last RTORecord referencing it lets go.
+
+Documents live on the local filesystem by default, or in an S3-compatible
+bucket with ``DOCUMENT_STORAGE_BACKEND = 's3'`` (required for presigned
+direct uploads, see core.direct_uploads).
+"""
+import hashlib
+import os
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+CAS_PREFIX = 'cas/'
+
+
+def content_hash(content):
+    """SHA-256 of an uploaded file, reusing the upload handler's digest if present."""
+    digest = getattr(content, 'sha256', None)
+    if digest:
+        return digest
+    sha256 = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        sha256.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return sha256.hexdigest()
+
+
+def cas_name(digest, ext):
+    return f"{CAS_PREFIX}{digest[:2]}/{digest[2:4]}/{digest}{ext.lower()}"
+
+
+def digest_from_name(name):
+    """Return the SHA-256 a content-addressed name was stored under, or None for other names."""
+    if not name or not name.startswith(CAS_PREFIX):
+        return None
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+class ContentAddressedMixin:
+    """Storage mixin that names files by content hash and never stores content twice."""
+
+    def _save(self, name, content):
+        from .models import StoredBlob
+        _, ext = os.path.splitext(name)
+        target = cas_name(content_hash(content), ext)
+        StoredBlob.reserve(target)
+        if self.exists(target):
+            return target
+        saved = super()._save(target, content)
+        if saved != target:
+            # A concurrent upload of the same content won the race; keep its copy
+            self.delete(saved)
+        return target
+
+    def save_exact(self, name, content):
+        """Write ``content`` under ``name`` as given (no content addressing), replacing any existing file."""
+        if self.exists(name):
+            self.delete(name)
+        return super()._save(name, content)
+
+
+class ContentAddressedStorage(ContentAddressedMixin, FileSystemStorage):
+    """Content-addressed documents on the local filesystem (MEDIA_ROOT)."""
+
+
+def s3_content_addressed_storage():
+    """Content-addressed documents in the S3-compatible bucket configured by the AWS_* settings."""
+    from storages.backends.s3 import S3Storage
+
+    class S3ContentAddressedStorage(ContentAddressedMixin, S3Storage):
+        pass
+
+    return S3ContentAddressedStorage()
+
+
+def storage_key(storage, name):
+    """Bucket key of a stored name (S3 storages prefix names with their location)."""
+    location = getattr(storage, 'location', '').strip('/')
+    return f"{location}/{name}" if location else name
+
+
+def local_path(storage, name):
+    """Filesystem path of a stored file, or None when the storage is remote."""
+    try:
+        return storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+_document_storage = None
+
+
+def document_storage():
+    """Storage used by RTORecord document fields (DOCUMENT_STORAGE_BACKEND: 'local' or 's3')."""
+    global _document_storage
+    if _document_storage is None:
+        if settings.DOCUMENT_STORAGE_BACKEND == 's3':
+            _document_storage = s3_content_addressed_storage()
+        else:
+            _document_storage = ContentAddressedStorage()
+    return _document_storage
@@ -0,0 +1,42 @@
+from django import template
+from django.utils.html import format_html
+
+from ..derivatives import document_sources
+
+register = template.Library()
+
+
+@register.simple_tag(name='document_sources')
+def document_sources_tag(record, field):
+    """URLs, srcsets and PDF details of a document, for use with ``as``."""
+    return document_sources(record, field)
+
+
+@register.simple_tag
+def document_srcset(record, field, fmt='webp'):
+    """srcset of a record's image document in 'webp' or 'jpeg', or '' before variants exist."""
+    return document_sources(record, field)[f'{fmt}_srcset']
+
+
+@register.simple_tag
+def document_picture(record, field, sizes='100vw', css_class='', style='', alt=''):
+    """<picture> for an image document or PDF preview: WebP variants, JPEG fallback, original if none rendered yet.
+
+    Cloudinary documents get an <img> whose srcset lets Cloudinary pick the format.
+    """
+    sources = document_sources(record, field)
+    if sources['srcset']:
+        return format_html(
+            '<img src="{}" srcset="{}" sizes="{}" class="{}" style="{}" alt="{}" loading="lazy">',
+            sources['src'], sources['srcset'], sizes, css_class, style, alt,
+        )
+    if not sources['webp_srcset']:
+        return format_html(
+            '<img src="{}" class="{}" style="{}" alt="{}" loading="lazy">',
+            sources['url'], css_class, style, alt,
+        )
+    return format_html(
+        '<picture><source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" class="{}" style="{}" alt="{}" loading="lazy"></picture>',
+        sources['webp_srcset'], sizes, sources['src'], sources['jpeg_srcset'], sizes, css_class, style, alt,
+    )
@@ -0,0 +1,147 @@
+"""
+Streaming upload handling for record documents.
+
+Views that take record documents call ``stream_document_uploads`` to put
+HashingUploadHandler in front of Django's memory/temporary-file handlers;
+other uploads (admin, image lookups) keep the defaults. Each uploaded file
+is streamed chunk by chunk into a temporary file under
+UPLOAD_STAGING_DIR (inside MEDIA_ROOT, so FileSystemStorage can move it
+into place with a rename instead of copying), hashed with SHA-256 on the
+fly, type-checked from the magic bytes of its first chunk and cut off as
+soon as it exceeds its field's size limit. Peak memory is one chunk per
+request regardless of upload size.
+
+Rejected files are skipped and the reason is recorded on
+``request.upload_errors``; views attach those to their form or serializer
+with ``upload_errors()``. Files that fit their field's limits but not the
+owner's storage quota (core.quotas) are reported by ``add_upload_errors``.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopFutureHandlers
+from django.template.defaultfilters import filesizeformat
+
+# Leading bytes of the file types we accept
+MAGIC_NUMBERS = {
+    'jpeg': [b'\xff\xd8\xff'],
+    'png': [b'\x89PNG\r\n\x1a\n'],
+    'pdf': [b'%PDF-'],
+}
+
+# Upload fields that only take images; everything else takes documents
+IMAGE_FIELDS = {'rc_photo', 'photo'}
+
+
+def sniff_type(head):
+    """Return 'jpeg', 'png' or 'pdf' from a file's first bytes, or None."""
+    for kind, signatures in MAGIC_NUMBERS.items():
+        if any(head.startswith(signature) for signature in signatures):
+            return kind
+    return None
+
+
+def field_rules(field_name):
+    """Return (max_size, allowed_types) for an upload field."""
+    if field_name in IMAGE_FIELDS:
+        return settings.MAX_IMAGE_SIZE, {'jpeg', 'png'}
+    return settings.MAX_DOCUMENT_SIZE, {'jpeg', 'png', 'pdf'}
+
+
+def upload_errors(request):
+    """Errors recorded by HashingUploadHandler for this request, keyed by field name."""
+    return getattr(request, 'upload_errors', {})
+
+
+def add_upload_errors(request, form):
+    """Attach rejected-upload and storage quota errors to a bound form. Returns True if there were any."""
+    from .quotas import quota_errors
+    errors = upload_errors(request) or quota_errors(request.user, request.FILES, form.instance)
+    for field, message in errors.items():
+        form.add_error(field if field in form.fields else None, message)
+    return bool(errors)
+
+
+def stream_document_uploads(request):
+    """Handle this request's file uploads with HashingUploadHandler.
+
+    Must run before anything reads request.POST or request.FILES, including
+    CsrfViewMiddleware: Django views doing this are csrf_exempt and apply
+    csrf_protect to their body instead.
+    """
+    request.upload_handlers.insert(0, HashingUploadHandler(request))
+
+
+class StagedUploadedFile(TemporaryUploadedFile):
+    """A TemporaryUploadedFile created in UPLOAD_STAGING_DIR."""
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        _, ext = os.path.splitext(name)
+        file = tempfile.NamedTemporaryFile(suffix=".upload" + ext, dir=settings.UPLOAD_STAGING_DIR)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """Stream uploads to disk while hashing, sniffing and size-checking them."""
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if hasattr(self, 'file'):
+            # The previous file is complete and owned by request.FILES now
+            del self.file
+        self.max_size, self.allowed_types = field_rules(field_name)
+        self.sha256 = hashlib.sha256()
+        self.sniffed_type = None
+        self.received = 0
+
+        if self.content_length and self.content_length > self.max_size:
+            self.reject(f"File too large (limit {filesizeformat(self.max_size)}).")
+
+        os.makedirs(settings.UPLOAD_STAGING_DIR, exist_ok=True)
+        self.file = StagedUploadedFile(
+            self.file_name, self.content_type, 0, self.charset, self.content_type_extra
+        )
+        # The default handlers behind this one would only open files of their own
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start == 0:
+            self.sniffed_type = sniff_type(raw_data[:16])
+            if self.sniffed_type not in self.allowed_types:
+                allowed = ', '.join(sorted(self.allowed_types)).upper()
+                self.reject(f"Unsupported file type. Allowed: {allowed}.")
+
+        self.received += len(raw_data)
+        if self.received > self.max_size:
+            self.reject(f"File too large (limit {filesizeformat(self.max_size)}).")
+
+        self.sha256.update(raw_data)
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.sha256 = self.sha256.hexdigest()
+        self.file.sniffed_type = self.sniffed_type
+        return self.file
+
+    def reject(self, message):
+        """Record why this file was refused and skip the rest of its bytes."""
+        if self.request is not None:
+            if not hasattr(self.request, 'upload_errors'):
+                self.request.upload_errors = {}
+            self.request.upload_errors[self.field_name] = message
+        raise SkipFile(message)
+
+    def upload_interrupted(self):
+        if hasattr(self, 'file'):
+            temp_location = self.file.temporary_file_path()
+            try:
+                self.file.close()
+                os.remove(temp_location)
+            except FileNotFoundError:
+                pass
@@ -13,6 +13,11 @@ urlpatterns = [
     path('records/create/<str:record_type>/', views.create_record_view, name='create_record'),
     path('records/<uuid:record_id>/', views.record_detail_view, name='record_detail'),
     path('records/<uuid:record_id>/edit/', views.edit_record_view, name='edit_record'),
+    path('records/<uuid:record_id>/review.pdf', views.record_review_pdf_view, name='record_review_pdf'),
+    path('records/<uuid:record_id>/documents/zip/', views.record_bundle_view, name='record_bundle'),
+    path('records/<uuid:record_id>/documents/<int:document_id>/', views.document_download_view, name='document_download'),
+    path('documents/signed/<str:token>/', views.signed_document_view, name='signed_document'),
+    path('documents/gallery/<str:token>/', views.gallery_document_view, name='gallery_document'),
 
     # QR Code functionality
     path('records/<uuid:record_id>/generate-qr/', views.generate_qr_view, name='generate_qr'),
@@ -29,6 +34,7 @@ urlpatterns = [
     path('orders/<str:order_id>/', views.order_detail_view, name='order_detail'),
     path('orders/<str:order_id>/success/', views.order_success_view, name='order_success'),
     path('orders/<str:order_id>/cancel/', views.order_cancel_view, name='order_cancel'),
+    path('orders/<str:order_id>/events/', views.order_events_view, name='order_events'),
 
     # Document verification (for QR scanning)
     path('verify-record/<uuid:record_id>/', views.verify_record_view, name='verify_record'),
@@ -1,4 +1,3 @@
-import razorpay
 import hmac
 import hashlib
 import json
@@ -9,15 +8,29 @@ from io import BytesIO
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse, HttpResponse
-from django.views.decorators.csrf import csrf_exempt
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, Http404
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.conf import settings
 from django.urls import reverse
 from django.views.decorators.http import require_POST
+from django.core import signing
 from django.core.files import File
 from django.template.loader import render_to_string
-
-from .models import RTORecord, Order
+from django.template.defaultfilters import filesizeformat
+
+from payments.routing import router as payment_router, GatewayUnavailable
+from . import events
+from .idempotency import idempotent
+from .uploads import add_upload_errors, stream_document_uploads
+from .bundles import bundle_response, record_folder
+from .derivatives import sources_for
+from .media import serve_file
+from .offload import save_files, server_timing
+from .review_pdf import review_pdf
+from .signed_urls import gallery_base, gallery_document, gallery_url, sign_document, sign_variant, variant_name, verify_token
+from .storage import document_storage
+from .events import publish_order_event, stream_order_events
+from .models import RTORecord, RecordDocument, Order
 from .forms import RTORecordForm, SchoolRecordForm, OrderForm
 
 
@@ -34,7 +47,7 @@ def home_view(request):
 
 @login_required
 def dashboard_view(request):
-    user_records_qs = RTORecord.objects.filter(owner=request.user).order_by("-created_at")
+    user_records_qs = RTORecord.objects.filter(owner=request.user).prefetch_related('documents').order_by("-created_at")
     user_orders_qs = Order.objects.filter(user=request.user).order_by("-created_at")
     
     user_records = user_records_qs[:10]
@@ -56,6 +69,7 @@ def dashboard_view(request):
 
 @csrf_exempt
 @login_required
+@idempotent
 def ajax_create_record(request):
     if request.method != "POST":
         return JsonResponse({"error": "Invalid method"}, status=405)
@@ -74,48 +88,34 @@ def ajax_create_record(request):
     if not all([name, contact_no, address, record_type]) or not cloudinary_urls:
         return JsonResponse({"error": "Missing required fields"}, status=400)
 
-    # Create record with Cloudinary URLs
+    # Create record with its Cloudinary URLs as documents
+    if record_type == "rto":
+        record_type = RTORecord.RecordType.RC
     record = RTORecord.objects.create(
         owner=request.user,
         record_type=record_type,
         name=name,
         contact_no=contact_no,
         address=address,
+        cloudinary_urls=list(cloudinary_urls),
     )
-    
-    # Store Cloudinary URLs in the record based on type
-    urls = list(cloudinary_urls)
-    if record_type == "rto":
-        if len(urls) > 0: record.rc_photo = urls[0]
-        if len(urls) > 1: record.insurance_doc = urls[1]
-        if len(urls) > 2: record.pu_check_doc = urls[2]
-        if len(urls) > 3: record.driving_license_doc = urls[3]
-    elif record_type == "school":
-        if len(urls) > 0: record.marks_card = urls[0]
-        if len(urls) > 1: record.photo = urls[1]
-        if len(urls) > 2: record.convocation = urls[2]
-        if len(urls) > 3: record.migration = urls[3]
-    
-    record.save()
+    RecordDocument.attach_urls(record, record.cloudinary_urls)
 
-    # Create Razorpay order for ₹2
-    client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
+    # Create gateway order for ₹2
     amount_paise = 200  # ₹2 in paise
-    
-    razorpay_order = client.order.create({
-        'amount': amount_paise,
-        'currency': 'INR',
-        'payment_capture': 1,
-    })
+    try:
+        provider, gateway_order = create_gateway_order(request, record, 'qr_download', amount_paise, 'QR Code Download')
+    except GatewayUnavailable as e:
+        return JsonResponse({'error': str(e)}, status=503)
 
     order = Order.objects.create(
         user=request.user,
         rto_record=record,
-        order_id=razorpay_order['id'],
+        order_id=gateway_order['id'],
         order_type='qr_download',
         amount=2.00,
         payment_status=Order.Status.PENDING,
-        payment_provider='razorpay',
+        payment_provider=provider,
     )
 
     payment_url = reverse('core:payment', kwargs={'record_id': record.id, 'order_type': 'qr_download'})
@@ -123,20 +123,33 @@ def ajax_create_record(request):
 
 
 # core/views.py (relevant portion)
+@csrf_exempt
 @login_required
 def create_record_view(request, record_type):
+    # The upload handler must be in place before CsrfViewMiddleware reads request.POST
+    stream_document_uploads(request)
+    return _create_record_view(request, record_type)
+
+
+@csrf_protect
+def _create_record_view(request, record_type):
     # Use the same form for all record types
     form_class = RTORecordForm
     
     if request.method == 'POST':
         form = form_class(request.POST, request.FILES)
+        add_upload_errors(request, form)
         if form.is_valid():
             record = form.save(commit=False)
             record.owner = request.user
             record.record_type = record_type  # 'rc', 'school', or 'other'
+            timings = save_files(record)
             record.save()
             messages.success(request, f"{record.get_record_type_display()} created successfully. Proceed to payment.")
-            return redirect('core:payment', record_id=record.id, order_type='qr_download')
+            response = redirect('core:payment', record_id=record.id, order_type='qr_download')
+            if timings:
+                response['Server-Timing'] = server_timing(timings)
+            return response
         else:
             messages.error(request, "Please correct the errors below.")
     else:
@@ -147,8 +160,15 @@ def create_record_view(request, record_type):
 
 
 
+@csrf_exempt
 @login_required
 def edit_record_view(request, record_id):
+    stream_document_uploads(request)
+    return _edit_record_view(request, record_id)
+
+
+@csrf_protect
+def _edit_record_view(request, record_id):
     record = get_object_or_404(RTORecord, id=record_id, owner=request.user)
     if record.record_type == 'school':
         form_class = SchoolRecordForm
@@ -157,10 +177,17 @@ def edit_record_view(request, record_id):
 
     if request.method == 'POST':
         form = form_class(request.POST, request.FILES, instance=record)
+        add_upload_errors(request, form)
         if form.is_valid():
-            form.save()
+            record = form.save(commit=False)
+            timings = save_files(record)
+            record.save()
+            form.save_m2m()
             messages.success(request, "Record updated successfully.")
-            return redirect('core:record_detail', record_id=record.id)
+            response = redirect('core:record_detail', record_id=record.id)
+            if timings:
+                response['Server-Timing'] = server_timing(timings)
+            return response
     else:
         form = form_class(instance=record)
 
@@ -169,11 +196,85 @@ def edit_record_view(request, record_id):
 
 @login_required
 def record_detail_view(request, record_id):
-    record = get_object_or_404(RTORecord, id=record_id, owner=request.user)
+    record = get_object_or_404(RTORecord.objects.prefetch_related('documents'), id=record_id, owner=request.user)
     orders = Order.objects.filter(rto_record=record)
     return render(request, 'record_detail.html', {'record': record, 'orders': orders})
 
 
+@login_required
+def document_download_view(request, record_id, document_id):
+    """Serve one of the owner's record documents (sendfile offload, or Range/ETag-aware streaming)."""
+    document = get_object_or_404(
+        RecordDocument.objects.select_related('record'),
+        id=document_id, record_id=record_id, record__owner=request.user,
+    )
+    if document.is_external:
+        return redirect(document.storage_key)
+    ext = os.path.splitext(document.storage_key)[1]
+    return serve_file(
+        request, document_storage(), document.storage_key,
+        filename=f"{document.kind}{ext}", content_type=document.mime_type or None,
+    )
+
+
+def signed_document_view(request, token):
+    """Serve a document (or a rendered variant) to whoever holds an unexpired signed URL (see core.signed_urls)."""
+    try:
+        document, variant = verify_token(token)
+    except signing.SignatureExpired:
+        return HttpResponse("This link has expired.", status=410)
+    except signing.BadSignature:
+        raise Http404("Invalid link")
+    if document is None or document.is_external:
+        raise Http404("Document not found")
+    if variant:
+        name = variant_name(document, variant)
+        if name is None:
+            raise Http404("Preview not found")
+        return serve_file(request, document_storage(), name, filename=f"{document.kind}-{variant}")
+    ext = os.path.splitext(document.storage_key)[1]
+    return serve_file(
+        request, document_storage(), document.storage_key, filename=f"{document.kind}{ext}",
+        content_type=document.mime_type or None, attachment=request.GET.get('download') == '1',
+    )
+
+
+def gallery_document_view(request, token):
+    """Stable link from a published gallery: redirect to a freshly signed URL of the document or a variant."""
+    try:
+        document = gallery_document(token)
+    except signing.BadSignature:
+        raise Http404("Invalid link")
+    if document is None:
+        raise Http404("Document not found")
+    if request.GET.get('variant'):
+        url = sign_variant(document, request.GET['variant'], settings.SIGNED_URL_TTL)
+        if url is None:
+            raise Http404("Preview not found")
+        return redirect(url)
+    url, download_url = sign_document(document, settings.SIGNED_URL_TTL)
+    return redirect(download_url if request.GET.get('download') == '1' else url)
+
+
+@login_required
+def record_bundle_view(request, record_id):
+    """Download all of a record's documents as one streamed ZIP."""
+    record = get_object_or_404(RTORecord, id=record_id, owner=request.user)
+    return bundle_response([record], f"{record_folder(record)}.zip")
+
+
+@login_required
+def record_review_pdf_view(request, record_id):
+    """One PDF with a cover page and every document of the record, for reviewers."""
+    records = RTORecord.objects.prefetch_related('documents')
+    if request.user.is_staff:
+        record = get_object_or_404(records, id=record_id)
+    else:
+        record = get_object_or_404(records, id=record_id, owner=request.user)
+    pdf = review_pdf(record)
+    return serve_file(request, pdf.storage, pdf.name, filename=f"{record_folder(record)}_review.pdf")
+
+
 @login_required
 def payment_view(request, record_id, order_type):
     record = get_object_or_404(RTORecord, id=record_id, owner=request.user)
@@ -189,28 +290,31 @@ def payment_view(request, record_id, order_type):
     payment_info = pricing[order_type]
     amount = payment_info['amount']
 
-    client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
-    razorpay_order = client.order.create(dict(
-        amount=amount,
-        currency=payment_info['currency'],
-        payment_capture=1,
-    ))
+    try:
+        provider, gateway_order = create_gateway_order(
+            request, record, order_type, amount, payment_info['description'], currency=payment_info['currency']
+        )
+    except GatewayUnavailable:
+        messages.error(request, "Payments are temporarily unavailable. Please try again shortly.")
+        return redirect('core:dashboard')
 
     order = Order.objects.create(
         user=request.user,
         rto_record=record,
-        order_id=razorpay_order['id'],
+        order_id=gateway_order['id'],
         order_type=order_type,
         amount=amount / 100.0,
         payment_status=Order.Status.PENDING,
-        payment_provider='razorpay',
+        payment_provider=provider,
     )
 
     context = {
         'record': record,
         'order': order,
-        'razorpay_order': json.dumps(razorpay_order),
-        'razorpay_key': settings.RAZORPAY_KEY_ID,
+        'payment_provider': provider,
+        'checkout_url': gateway_order.get('checkout_url', ''),
+        'razorpay_order': json.dumps(gateway_order['raw']),
+        'razorpay_key': gateway_order['key'],
         'payment_info': payment_info,
         'order_type': order_type,
         'amount_in_rupees': amount / 100.0,
@@ -219,71 +323,56 @@ def payment_view(request, record_id, order_type):
     return render(request, 'core/payment.html', context)
 
 
+def create_gateway_order(request, record, order_type, amount_paise, description, currency='INR'):
+    """Create an order on the healthiest payment gateway. Returns (provider, gateway_order)."""
+    success_url = request.build_absolute_uri(
+        reverse('core:order_success', kwargs={'order_id': 'CHECKOUT_SESSION_ID'})
+    ).replace('CHECKOUT_SESSION_ID', '{CHECKOUT_SESSION_ID}')
+    return payment_router.create_order(
+        amount_paise,
+        currency,
+        receipt=f'{order_type}_{record.id}',
+        notes={'user_id': request.user.id, 'record_id': str(record.id), 'order_type': order_type},
+        description=description,
+        success_url=success_url,
+        cancel_url=request.build_absolute_uri(reverse('core:record_detail', kwargs={'record_id': record.id})),
+    )
+
+
+# Gallery cards are one column on phones and at most ~400px wide on desktop
+GALLERY_IMAGE_SIZES = "(min-width: 700px) 400px, 100vw"
+
+
 def get_cloudinary_urls(record):
-    """Extract all Cloudinary URLs from a record"""
-    urls = []
-    
-    print(f"🔍 DEBUG: Checking record {record.id} of type '{record.record_type}'")
-    
-    if record.record_type == "rto":
-        print("📋 Checking RTO documents:")
-        if record.rc_photo: 
-            urls.append(record.rc_photo)
-            print(f"✅ RC Photo: {record.rc_photo}")
-        else:
-            print("❌ RC Photo: EMPTY")
-            
-        if record.insurance_doc: 
-            urls.append(record.insurance_doc)
-            print(f"✅ Insurance Doc: {record.insurance_doc}")
-        else:
-            print("❌ Insurance Doc: EMPTY")
-            
-        if record.pu_check_doc: 
-            urls.append(record.pu_check_doc)
-            print(f"✅ PU Check Doc: {record.pu_check_doc}")
-        else:
-            print("❌ PU Check Doc: EMPTY")
-            
-        if record.driving_license_doc: 
-            urls.append(record.driving_license_doc)
-            print(f"✅ Driving License Doc: {record.driving_license_doc}")
-        else:
-            print("❌ Driving License Doc: EMPTY")
-            
-    elif record.record_type == "school":
-        print("🎓 Checking School documents:")
-        if record.marks_card: 
-            urls.append(record.marks_card)
-            print(f"✅ Marks Card: {record.marks_card}")
-        else:
-            print("❌ Marks Card: EMPTY")
-            
-        if record.photo: 
-            urls.append(record.photo)
-            print(f"✅ Photo: {record.photo}")
-        else:
-            print("❌ Photo: EMPTY")
-            
-        if record.convocation: 
-            urls.append(record.convocation)
-            print(f"✅ Convocation: {record.convocation}")
-        else:
-            print("❌ Convocation: EMPTY")
-            
-        if record.migration: 
-            urls.append(record.migration)
-            print(f"✅ Migration: {record.migration}")
-        else:
-            print("❌ Migration: EMPTY")
-    
-    print(f"📊 TOTAL DOCUMENTS FOUND: {len(urls)}")
+    """URLs of all documents attached to a record, in display order."""
+    urls = [document.url for document in record.documents.all()]
+    print(f"📊 TOTAL DOCUMENTS FOUND for {record.id}: {len(urls)}")
     return urls
 
 
-def generate_static_html(record):
+def gallery_documents(record, request=None):
+    """Gallery entries for a record's documents, with srcset variants and PDF previews (Cloudinary
+    transformations for hosted ones). Stored documents link to stable app URLs that redirect to fresh signed ones."""
+    documents = []
+    base = None
+    for document in record.documents.all():
+        if document.is_external:
+            documents.append(sources_for(document))
+            continue
+        base = base or gallery_base(request)
+        documents.append(sources_for(
+            document,
+            signed=(gallery_url(document, base), gallery_url(document, base, download=1)),
+            variant_url=lambda width, key, document=document: gallery_url(document, base, variant=f"{width}.{key}"),
+        ))
+    return documents
+
+
+def generate_static_html(record, request=None):
     """Generate static HTML file for the record in deploy_site folder"""
     cloudinary_urls = get_cloudinary_urls(record)
+    # The published page is static and outlives any signed URL, so it links back to the app
+    documents = gallery_documents(record, request)
     
     print(f"🔍 DEBUG: Creating HTML for record {record.id}")
     print(f"📋 Found {len(cloudinary_urls)} documents")
@@ -291,6 +380,8 @@ def generate_static_html(record):
     context = {
         'record': record,
         'cloudinary_urls': cloudinary_urls,
+        'documents': documents,
+        'image_sizes': GALLERY_IMAGE_SIZES,
     }
     
     # Generate HTML content using your existing template
@@ -298,7 +389,7 @@ def generate_static_html(record):
         html_content = render_to_string('document_gallery.html', context)
     except Exception as e:
         print(f"❌ Template error: {e}")
-        html_content = generate_inline_html(record, cloudinary_urls)
+        html_content = generate_inline_html(record, documents)
     
     # Create folder structure for Netlify (using deploy_site now)
     folder_path = f'deploy_site/record_{record.id}'
@@ -311,16 +402,39 @@ def generate_static_html(record):
     print(f"✅ Generated HTML file: {folder_path}/index.html")
 
 
-def generate_inline_html(record, cloudinary_urls):
+def generate_inline_html(record, documents):
     """Generate HTML content inline if template is not available"""
     docs_html = ""
-    for i, url in enumerate(cloudinary_urls):
-        download_url = f"{url}?fl_attachment"
+    for i, doc in enumerate(documents):
+        url = doc['url']
+        download_url = doc['download_url']
+        if doc['webp_srcset']:
+            image_html = f"""<picture>
+                <source type="image/webp" srcset="{doc['webp_srcset']}" sizes="{GALLERY_IMAGE_SIZES}">
+                <img src="{doc['src']}" srcset="{doc['jpeg_srcset']}" sizes="{GALLERY_IMAGE_SIZES}" alt="Document {i+1}" class="doc-image" loading="lazy">
+            </picture>"""
+        elif doc['srcset']:
+            image_html = f"""<img src="{doc['src']}" srcset="{doc['srcset']}" sizes="{GALLERY_IMAGE_SIZES}" alt="Document {i+1}" class="doc-image" loading="lazy">"""
+        elif doc['is_pdf']:
+            image_html = '<div class="doc-image doc-pdf">📄 PDF</div>'
+        else:
+            image_html = f'<img src="{url}" alt="Document {i+1}" class="doc-image" loading="lazy">'
+        meta_html = ""
+        if doc['is_pdf']:
+            # Only the preview is loaded; the full PDF is fetched when the card is opened
+            image_html = f'<a href="{url}" target="_blank">{image_html}</a>'
+            details = ["PDF"]
+            if doc['pages']:
+                details.append(f"{doc['pages']} page{'s' if doc['pages'] != 1 else ''}")
+            if doc['size']:
+                details.append(filesizeformat(doc['size']))
+            meta_html = f'<p class="doc-meta">{" · ".join(details)}</p>'
         docs_html += f"""
         <div class="doc-card">
-            <img src="{url}" alt="Document {i+1}" class="doc-image" loading="lazy">
+            {image_html}
             <div class="doc-info">
                 <h3>Document {i+1}</h3>
+                {meta_html}
                 <div class="btn-group">
                     <a href="{url}" class="btn btn-view" target="_blank">👁️ View</a>
                     <a href="{download_url}" class="btn btn-download" target="_blank">⬇️ Download</a>
@@ -344,6 +458,9 @@ def generate_inline_html(record, cloudinary_urls):
         .gallery {{ display: grid; grid-template-columns: repeat(auto-fit, minmax(300px, 1fr)); gap: 25px; margin-bottom: 40px; }}
         .doc-card {{ background: white; border-radius: 15px; overflow: hidden; box-shadow: 0 8px 25px rgba(0,0,0,0.15); transition: transform 0.3s ease; }}
         .doc-card:hover {{ transform: translateY(-5px); }}
+        picture {{ display: block; }}
+        .doc-pdf {{ display: flex; align-items: center; justify-content: center; background: #f7f7f7; color: #c53030; font-size: 2em; }}
+        .doc-meta {{ margin: -5px 0 15px 0; color: #666; font-size: 0.9em; }}
         .doc-image {{ width: 100%; height: 250px; object-fit: cover; border-bottom: 1px solid #eee; }}
         .doc-info {{ padding: 20px; text-align: center; }}
         .doc-info h3 {{ margin: 0 0 15px 0; color: #333; font-size: 1.2em; }}
@@ -431,8 +548,38 @@ def generate_qr_code_for_record(record, url):
     record.save()
 
 
+def fulfill_paid_order(order, request=None):
+    """Publish the record's gallery and QR code once its order is paid."""
+    record = order.rto_record
+    
+    # Generate static HTML file; the payment is already captured, so a failure here must not fail the request
+    try:
+        generate_static_html(record, request)
+    except Exception as e:
+        print(f"❌ Gallery generation failed for record {record.id}: {e}")
+    
+    # Auto-commit and push to GitHub
+    auto_deploy_to_github(record)
+    
+    # Generate QR code with Netlify URL (FIXED: Using consistent domain)
+    netlify_url = f"https://spiffy-croquembouche-98a629.netlify.app/record_{record.id}/"
+    record.gallery_html_url = netlify_url
+    publish_order_event(order, events.GALLERY_PUBLISHED, gallery_url=netlify_url)
+    
+    generate_qr_code_for_record(record, netlify_url)
+    record.save()
+    publish_order_event(order, events.QR_READY, qr_code_url=record.qr_code_image.url)
+    
+    # The QR PDF is rendered on request, so it is available as soon as the QR exists
+    publish_order_event(
+        order, events.PDF_READY,
+        pdf_url=reverse('records-download-qr-pdf', kwargs={'pk': record.id}),
+    )
+
+
 @csrf_exempt
 @login_required
+@idempotent
 def verify_payment(request):
     if request.method != 'POST':
         return JsonResponse({'error': 'Invalid request'}, status=400)
@@ -457,27 +604,17 @@ def verify_payment(request):
     if generated_signature != razorpay_signature:
         order.payment_status = Order.Status.FAILED
         order.save()
+        publish_order_event(order, events.FAILED, reason='signature')
         return JsonResponse({'error': 'Signature verification failed'}, status=400)
 
     # Payment successful
     order.payment_status = Order.Status.COMPLETED
     order.payment_provider_payment_id = razorpay_payment_id
     order.save()
+    publish_order_event(order, events.PAID)
     
     record = order.rto_record
-    
-    # Generate static HTML file
-    generate_static_html(record)
-    
-    # Auto-commit and push to GitHub
-    auto_deploy_to_github(record)
-    
-    # Generate QR code with Netlify URL (FIXED: Using consistent domain)
-    netlify_url = f"https://spiffy-croquembouche-98a629.netlify.app/record_{record.id}/"
-    generate_qr_code_for_record(record, netlify_url)
-    
-    record.gallery_html_url = netlify_url
-    record.save()
+    fulfill_paid_order(order, request)
     
     redirect_url = reverse('core:qr_success', kwargs={'record_id': record.id})
     return JsonResponse({'success': True, 'redirect_url': redirect_url})
@@ -500,7 +637,7 @@ def generate_qr_view(request, record_id):
     
     try:
         # Generate static HTML
-        generate_static_html(record)
+        generate_static_html(record, request)
         
         # Generate QR code (FIXED: Using consistent domain)
         netlify_url = f"https://spiffy-croquembouche-98a629.netlify.app/record_{record.id}/"
@@ -558,6 +695,27 @@ def order_success_view(request, order_id):
     return render(request, 'order_success.html', {'order': order})
 
 
+async def order_events_view(request, order_id):
+    """Stream an order's payment and fulfillment status as server-sent events."""
+    user = await request.auser()
+    if not user.is_authenticated:
+        return HttpResponse(status=401)
+    order = await Order.objects.select_related('rto_record').filter(order_id=order_id, user=user).afirst()
+    if order is None:
+        raise Http404("Order not found")
+    
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        last_event_id = 0
+    
+    return StreamingHttpResponse(
+        stream_order_events(order, last_event_id),
+        content_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
 @login_required
 def order_cancel_view(request, order_id):
     order = get_object_or_404(Order, order_id=order_id, user=request.user)
@@ -1,4 +1,6 @@
 # Gunicorn configuration file for production
+# Sync WSGI workers serve the app; order event streams (/orders/<order_id>/events/)
+# are routed to the ASGI process configured in gunicorn.events.conf.py
 import multiprocessing
 
 # Server socket
@@ -0,0 +1,36 @@
+# Gunicorn configuration for the order event streams (/orders/<order_id>/events/)
+# The reverse proxy sends that location here and everything else to the sync
+# workers of gunicorn.conf.py; rto_project.asgi answers 404 for any other route.
+import multiprocessing
+
+# Application
+wsgi_app = "rto_project.asgi:application"
+
+# Server socket
+bind = "0.0.0.0:8001"
+backlog = 2048
+
+# Worker processes: each one holds thousands of waiting streams on its event loop
+workers = multiprocessing.cpu_count()
+worker_class = "uvicorn_worker.UvicornWorker"
+# Seconds a worker may go without heartbeating the arbiter. The event loop keeps heartbeating
+# while streams are open, so this doesn't cut off long-lived requests.
+timeout = 30
+# Let open event streams finish (clients reconnect with Last-Event-ID) on restart
+graceful_timeout = 30
+keepalive = 2
+
+# Load application code before the worker processes are forked
+preload_app = True
+
+# Logging
+accesslog = "-"
+errorlog = "-"
+loglevel = "info"
+
+# Process naming
+proc_name = 'rto_project_events'
+
+# Server mechanics
+daemon = False
+pidfile = "/tmp/gunicorn_events.pid"
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Order, PrintOrder
+from payments.refunds import BatchRefundProcessor
+
+
+class Command(BaseCommand):
+    help = "Refund completed orders concurrently. Safe to re-run after an interruption."
+
+    def add_arguments(self, parser):
+        parser.add_argument('order_ids', nargs='*', help='Order IDs to refund')
+        parser.add_argument('--cancelled-print-orders', action='store_true',
+                            help='Refund every order whose print order is cancelled')
+        parser.add_argument('--reason', default='', help='Refund reason stored on each transaction')
+        parser.add_argument('--max-in-flight', type=int, help='Concurrent gateway calls')
+        parser.add_argument('--rate', type=float, help='Gateway calls per second')
+        parser.add_argument('--dry-run', action='store_true', help='List the orders that would be refunded and write nothing')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.none()
+        if options['order_ids']:
+            orders = Order.objects.filter(order_id__in=options['order_ids'])
+        if options['cancelled_print_orders']:
+            cancelled = PrintOrder.objects.filter(status=PrintOrder.Status.CANCELLED).values('order_id')
+            orders = orders | Order.objects.filter(pk__in=cancelled)
+        orders = orders.filter(payment_status__in=[Order.Status.COMPLETED, Order.Status.REFUNDED])
+
+        if not orders.exists():
+            raise CommandError("No refundable orders selected")
+
+        if options['dry_run']:
+            pending = orders.exclude(payment_status=Order.Status.REFUNDED)
+            for order in pending:
+                self.stdout.write(f"{order.order_id}  {order.payment_provider}  ₹{order.total_amount}")
+            self.stdout.write(f"Would refund {pending.count()} orders (dry run, nothing written)")
+            return
+
+        processor = BatchRefundProcessor(
+            max_in_flight=options['max_in_flight'],
+            rate_per_second=options['rate'],
+            reason=options['reason'],
+        )
+        stats = processor.run(orders)
+        self.stdout.write(self.style.SUCCESS(
+            "Refunded {refunded}, recovered {recovered}, failed {failed}, skipped {skipped}".format(**stats)
+        ))
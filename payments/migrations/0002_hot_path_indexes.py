@@ -0,0 +1,29 @@
+# Generated by Django 5.0.7 on 2026-10-18 23:17
+
+from django.db import migrations, models
+
+from core.migration_operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('payments', '0001_initial'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='paymenttransaction',
+            index=models.Index(fields=['order', '-created_at'], name='txn_order_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='paymenttransaction',
+            index=models.Index(fields=['provider_payment_id'], name='txn_provider_payment_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='webhookevent',
+            index=models.Index(fields=['processed', 'received_at'], name='webhook_processed_idx'),
+        ),
+    ]
@@ -82,6 +82,11 @@ class PaymentTransaction(models.Model):
         verbose_name = 'Payment Transaction'
         verbose_name_plural = 'Payment Transactions'
         ordering = ['-created_at']
+        indexes = [
+            # An order's transactions, newest first (refunds, admin)
+            models.Index(fields=['order', '-created_at'], name='txn_order_created_idx'),
+            models.Index(fields=['provider_payment_id'], name='txn_provider_payment_idx'),
+        ]
     
     def __str__(self):
         return f"Transaction {self.transaction_id} - {self.gateway.provider} - ₹{self.amount}"
@@ -138,6 +143,10 @@ class WebhookEvent(models.Model):
         db_table = 'webhook_event'
         verbose_name = 'Webhook Event'
         verbose_name_plural = 'Webhook Events'
+        indexes = [
+            # Unprocessed events, oldest first
+            models.Index(fields=['processed', 'received_at'], name='webhook_processed_idx'),
+        ]
         ordering = ['-received_at']
     
     def __str__(self):
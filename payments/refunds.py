@@ -0,0 +1,358 @@
+"""
+Batch refund engine.
+
+Refunds are issued concurrently (bounded in-flight count and a token-bucket
+rate limit) while all database writes happen on the calling thread in
+batches. Progress is recorded on PaymentTransaction so an interrupted run
+can be resumed: rows left in ``processing`` for longer than
+REFUND_CLAIM_TIMEOUT are looked up on the gateway by their receipt before
+being retried, so a refund is never issued twice.
+
+Transactions are claimed under a lock on their order and with an update
+guarded by the state they were read in, so concurrent runs (the admin
+action and ``refund_orders``) never refund the same payment twice.
+
+A partially refunded transaction (the provider refunded less than asked, or
+a refund was issued elsewhere) keeps its order completed and can be claimed
+again for the remaining amount, under a receipt of its own.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import Order, OrderRollup
+from .models import PaymentGateway, PaymentTransaction
+
+logger = logging.getLogger(__name__)
+
+
+class RefundError(Exception):
+    """Raised by a refund gateway when the provider rejects a refund."""
+
+
+class RazorpayRefundGateway:
+    """Issue refunds through the Razorpay payments API."""
+    provider = PaymentGateway.Provider.RAZORPAY
+
+    def __init__(self, client=None):
+        if client is None:
+            import razorpay
+            client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
+        self.client = client
+
+    def refund(self, payment_id, amount_paise, receipt):
+        try:
+            return self.client.payment.refund(payment_id, {'amount': amount_paise, 'receipt': receipt})
+        except Exception as e:
+            raise RefundError(str(e)) from e
+
+    def find_refund(self, payment_id, receipt):
+        try:
+            refunds = self.client.payment.fetch_multiple_refund(payment_id, {'count': 100})
+        except Exception as e:
+            raise RefundError(str(e)) from e
+        for refund in refunds.get('items', []):
+            if refund.get('receipt') == receipt:
+                return refund
+        return None
+
+
+class FakeRefundGateway:
+    """In-memory gateway for tests.
+
+    ``fail_payment_ids`` are rejected with RefundError; ``latency`` seconds are
+    slept per call so concurrency and rate limits can be observed; refunds
+    above ``max_amount_paise`` are only partly processed.
+    """
+    provider = PaymentGateway.Provider.RAZORPAY
+
+    def __init__(self, latency=0, fail_payment_ids=(), max_amount_paise=None):
+        self.latency = latency
+        self.fail_payment_ids = set(fail_payment_ids)
+        self.max_amount_paise = max_amount_paise
+        self.refunds = {}
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def refund(self, payment_id, amount_paise, receipt):
+        with self._lock:
+            self.calls.append((payment_id, amount_paise, receipt, time.monotonic()))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if payment_id in self.fail_payment_ids:
+                raise RefundError(f"Refund rejected for {payment_id}")
+            with self._lock:
+                refund = self.refunds.setdefault(receipt, {
+                    'id': f'rfnd_fake_{len(self.refunds) + 1}',
+                    'payment_id': payment_id,
+                    'amount': min(amount_paise, self.max_amount_paise or amount_paise),
+                    'receipt': receipt,
+                    'status': 'processed',
+                })
+            return refund
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def find_refund(self, payment_id, receipt):
+        return self.refunds.get(receipt)
+
+
+class RateLimiter:
+    """Thread-safe token bucket allowing ``rate`` calls per second."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def get_refund_gateway(provider):
+    """Return the refund gateway for a payment provider."""
+    if provider == PaymentGateway.Provider.RAZORPAY:
+        return RazorpayRefundGateway()
+    raise RefundError(f"Refunds are not supported for provider '{provider}'")
+
+
+class BatchRefundProcessor:
+    """Refund a set of orders concurrently and record progress on their transactions."""
+
+    def __init__(self, gateway=None, max_in_flight=None, rate_per_second=None,
+                 write_batch_size=None, reason=''):
+        self.gateway = gateway
+        self.max_in_flight = max_in_flight or settings.REFUND_MAX_IN_FLIGHT
+        self.rate_limiter = RateLimiter(rate_per_second or settings.REFUND_RATE_LIMIT_PER_SECOND)
+        self.write_batch_size = write_batch_size or settings.REFUND_WRITE_BATCH_SIZE
+        self.reason = reason
+        self.stats = {'refunded': 0, 'recovered': 0, 'failed': 0, 'skipped': 0}
+
+    def run(self, orders):
+        """Refund every completed order in ``orders`` (a queryset or iterable) and return counters."""
+        if hasattr(orders, 'values_list'):
+            order_ids = list(orders.values_list('pk', flat=True))
+        else:
+            order_ids = [getattr(order, 'pk', order) for order in orders]
+        for start in range(0, len(order_ids), self.write_batch_size):
+            self._run_batch(order_ids[start:start + self.write_batch_size])
+        logger.info("Batch refund finished: %s", self.stats)
+        return dict(self.stats)
+
+    def _run_batch(self, order_ids):
+        transactions = self._claim(order_ids)
+        if not transactions:
+            return
+
+        gateways = {}
+        results = []
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            futures = {}
+            for txn in transactions:
+                provider = txn.gateway.provider
+                if provider not in gateways:
+                    gateways[provider] = self.gateway or get_refund_gateway(provider)
+                futures[pool.submit(self._refund_one, gateways[provider], txn)] = txn
+            for future in as_completed(futures):
+                results.append((futures[future], future.result()))
+
+        self._record(results)
+
+    def _claim(self, order_ids):
+        """Mark refundable transactions as in flight before any gateway call.
+
+        Orders held by another run are skipped, and each transaction is only
+        claimed if it is still in the state it was read in.
+        """
+        now = timezone.now()
+        stale = now - timedelta(seconds=settings.REFUND_CLAIM_TIMEOUT)
+        claimed = []
+        with transaction.atomic():
+            orders = (
+                Order.objects.select_for_update(skip_locked=True)
+                .filter(pk__in=order_ids)
+                .prefetch_related('transactions__gateway')
+            )
+            candidates = []
+            to_create = []
+            for order in orders:
+                if order.payment_status == Order.Status.REFUNDED:
+                    self.stats['skipped'] += 1
+                    continue
+                txn = self._transaction_for(order, to_create, stale)
+                if txn is None:
+                    self.stats['skipped'] += 1
+                    continue
+                candidates.append(txn)
+
+            if to_create:
+                PaymentTransaction.objects.bulk_create(to_create)
+            for txn in candidates:
+                guard = {'pk': txn.pk, 'status': txn.status, 'updated_at': txn.updated_at}
+                # A transaction still in flight was claimed by an interrupted run
+                txn.resumed = txn.status == PaymentTransaction.Status.PROCESSING
+                if not txn.resumed:
+                    state = {
+                        'state': 'requested',
+                        'receipt': self._receipt(txn),
+                        # Restored if the gateway rejects the refund
+                        'previous_status': txn.status,
+                    }
+                    txn.status = PaymentTransaction.Status.PROCESSING
+                    txn.provider_response = {**txn.provider_response, 'refund': state}
+                txn.refund_reason = txn.refund_reason or self.reason
+                txn.updated_at = now
+                won = PaymentTransaction.objects.filter(**guard).update(
+                    status=txn.status,
+                    provider_response=txn.provider_response,
+                    refund_reason=txn.refund_reason,
+                    updated_at=now,
+                )
+                if won == 1:
+                    claimed.append(txn)
+                else:
+                    self.stats['skipped'] += 1
+        return claimed
+
+    def _transaction_for(self, order, to_create, stale):
+        """Find the payment transaction to refund for an order, creating one from the order if needed.
+
+        Returns None if there is nothing to refund, or another run is refunding it.
+        """
+        refundable = (PaymentTransaction.Status.SUCCESS, PaymentTransaction.Status.PARTIALLY_REFUNDED)
+        for txn in order.transactions.all():
+            if txn.status in refundable and txn.refund_amount < txn.amount:
+                return txn
+            if txn.status == PaymentTransaction.Status.REFUNDED:
+                return None
+            if (txn.status == PaymentTransaction.Status.PROCESSING
+                    and txn.provider_response.get('refund', {}).get('state') == 'requested'):
+                return txn if txn.updated_at < stale else None
+
+        if order.payment_status != Order.Status.COMPLETED or not order.payment_provider_payment_id:
+            return None
+
+        gateway, _ = PaymentGateway.objects.get_or_create(provider=order.payment_provider)
+        txn = PaymentTransaction(
+            order=order,
+            gateway=gateway,
+            amount=order.total_amount,
+            status=PaymentTransaction.Status.SUCCESS,
+            provider_transaction_id=order.order_id,
+            provider_payment_id=order.payment_provider_payment_id,
+            completed_at=order.completed_at,
+        )
+        txn.transaction_id = txn.generate_transaction_id()
+        to_create.append(txn)
+        return txn
+
+    @staticmethod
+    def _receipt(txn):
+        """Gateway receipt of the next refund; refunds of a remainder are told apart by the amount already refunded."""
+        refunded_paise = int(txn.refund_amount * 100)
+        return f'refund_{txn.transaction_id}_{refunded_paise}' if refunded_paise else f'refund_{txn.transaction_id}'
+
+    def _refund_one(self, gateway, txn):
+        """Issue (or recover) one refund. Runs on a worker thread; no DB access."""
+        receipt = txn.provider_response['refund']['receipt']
+        amount_paise = int((txn.amount - txn.refund_amount) * 100)
+        try:
+            if txn.resumed:
+                existing = gateway.find_refund(txn.provider_payment_id, receipt)
+                if existing:
+                    return 'recovered', existing
+            self.rate_limiter.acquire()
+            return 'refunded', gateway.refund(txn.provider_payment_id, amount_paise, receipt)
+        except RefundError as e:
+            return 'failed', str(e)
+
+    def _record(self, results):
+        """Write gateway outcomes back in one batch."""
+        now = timezone.now()
+        refunded_orders = []
+        for txn, (outcome, payload) in results:
+            self.stats[outcome] += 1
+            state = dict(txn.provider_response.get('refund', {}))
+            if outcome == 'failed':
+                txn.status = state.pop('previous_status', PaymentTransaction.Status.SUCCESS)
+                txn.failure_reason = payload
+                state['state'] = 'failed'
+            else:
+                refunded = Decimal(payload.get('amount', 0)) / 100 if payload.get('amount') else txn.amount - txn.refund_amount
+                txn.refund_amount += refunded
+                txn.status = (
+                    PaymentTransaction.Status.REFUNDED if txn.refund_amount >= txn.amount
+                    else PaymentTransaction.Status.PARTIALLY_REFUNDED
+                )
+                state.pop('previous_status', None)
+                state.update(state='processed', refund_id=payload.get('id'), processed_at=now.isoformat())
+                if txn.status == PaymentTransaction.Status.REFUNDED:
+                    refunded_orders.append(txn.order_id)
+            txn.provider_response = {**txn.provider_response, 'refund': state}
+            txn.updated_at = now
+
+        with transaction.atomic():
+            PaymentTransaction.objects.bulk_update(
+                [txn for txn, _ in results],
+                ['status', 'refund_amount', 'failure_reason', 'provider_response', 'updated_at'],
+            )
+            if refunded_orders:
+                orders = Order.objects.filter(pk__in=refunded_orders).exclude(payment_status=Order.Status.REFUNDED)
+                previous = list(orders.values(*OrderRollup.SOURCE_FIELDS))
+                orders.update(payment_status=Order.Status.REFUNDED, updated_at=now)
+                OrderRollup.record_status_change(previous, Order.Status.REFUNDED)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def _run_queued(order_ids, reason):
+    from django.db import connection
+    try:
+        stats = BatchRefundProcessor(reason=reason).run(order_ids)
+        logger.info("Queued refund of %d orders finished: %s", len(order_ids), stats)
+    except Exception:
+        logger.exception("Queued refund of %d orders failed", len(order_ids))
+    finally:
+        connection.close()
+
+
+def queue_refunds(order_ids, reason=''):
+    """Refund orders on a background thread once the current transaction commits.
+
+    Queued batches run one at a time, so they share the gateway rate limit.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = ThreadPoolExecutor(max_workers=1, thread_name_prefix='refunds')
+    order_ids = list(order_ids)
+    transaction.on_commit(lambda: _queue.submit(_run_queued, order_ids, reason))
+    return len(order_ids)
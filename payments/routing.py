@@ -0,0 +1,247 @@
+"""
+Latency-aware routing of new payment orders across configured gateways.
+
+PaymentGateway rows are cached per process and reloaded only when the config
+version in the shared cache (bumped by payments.signals on every gateway
+change) moves. Each provider's recent latency and error rate is tracked in a
+rolling window, and new orders go to the healthiest eligible gateway, falling
+back to the next one when a call fails. Providers failing more often than
+PAYMENT_ROUTING_ERROR_THRESHOLD are only tried after the healthy ones.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import PaymentGateway
+
+logger = logging.getLogger(__name__)
+
+CONFIG_VERSION_KEY = 'payments:gateway_config_version'
+
+
+class GatewayUnavailable(Exception):
+    """Raised when no eligible gateway could create the order."""
+
+
+def shared_cache():
+    return caches[settings.PAYMENT_ROUTING_CACHE_ALIAS]
+
+
+def bump_config_version():
+    """Invalidate every process's cached gateway configs."""
+    cache = shared_cache()
+    try:
+        try:
+            cache.incr(CONFIG_VERSION_KEY)
+        except ValueError:
+            cache.set(CONFIG_VERSION_KEY, 1, timeout=None)
+    except Exception as e:
+        # Processes reload configs on every decision while the shared cache is unreachable
+        logger.warning("Could not bump gateway config version: %s", e)
+
+
+class GatewayConfigCache:
+    """In-process cache of gateway configs with version-based invalidation."""
+
+    def __init__(self):
+        self._configs = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _current_version(self):
+        try:
+            return shared_cache().get(CONFIG_VERSION_KEY, 0)
+        except Exception as e:
+            # Without the shared version we can't tell whether configs changed: reload them
+            logger.warning("Gateway config version unavailable, reloading configs: %s", e)
+            return object()
+
+    def get(self):
+        version = self._current_version()
+        if self._configs is not None and version == self._version:
+            return self._configs
+        with self._lock:
+            if self._configs is None or version != self._version:
+                self._configs = list(
+                    PaymentGateway.objects
+                    .values('provider', 'is_active', 'is_test_mode', 'supported_currencies', 'fee_percentage')
+                )
+                self._version = version
+        return self._configs
+
+
+class ProviderHealth:
+    """Rolling window of call latencies and outcomes for one provider."""
+
+    def __init__(self, window_seconds, max_samples=200):
+        self.window_seconds = window_seconds
+        self.samples = deque(maxlen=max_samples)
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self._lock:
+            self.samples.append((time.monotonic(), latency, ok))
+
+    def snapshot(self):
+        cutoff = time.monotonic() - self.window_seconds
+        with self._lock:
+            while self.samples and self.samples[0][0] < cutoff:
+                self.samples.popleft()
+            samples = list(self.samples)
+        if not samples:
+            return {'samples': 0, 'avg_latency': None, 'error_rate': 0.0}
+        return {
+            'samples': len(samples),
+            'avg_latency': sum(s[1] for s in samples) / len(samples),
+            'error_rate': sum(1 for s in samples if not s[2]) / len(samples),
+        }
+
+
+class RazorpayOrderClient:
+    provider = PaymentGateway.Provider.RAZORPAY
+
+    def is_configured(self):
+        return bool(settings.RAZORPAY_KEY_ID and settings.RAZORPAY_KEY_SECRET)
+
+    def create_order(self, amount_paise, currency, receipt='', notes=None, **kwargs):
+        import razorpay
+        client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET))
+        data = {'amount': amount_paise, 'currency': currency, 'payment_capture': 1}
+        if receipt:
+            data['receipt'] = receipt[:40]
+        if notes:
+            data['notes'] = notes
+        razorpay_order = client.order.create(data)
+        return {
+            'id': razorpay_order['id'],
+            'amount': razorpay_order['amount'],
+            'currency': razorpay_order['currency'],
+            'key': settings.RAZORPAY_KEY_ID,
+            'raw': razorpay_order,
+        }
+
+
+class StripeOrderClient:
+    provider = PaymentGateway.Provider.STRIPE
+
+    def is_configured(self):
+        return bool(settings.STRIPE_SECRET_KEY)
+
+    def create_order(self, amount_paise, currency, receipt='', notes=None, description='',
+                     success_url='', cancel_url='', **kwargs):
+        import stripe
+        session = stripe.checkout.Session.create(
+            api_key=settings.STRIPE_SECRET_KEY,
+            mode='payment',
+            line_items=[{
+                'price_data': {
+                    'currency': currency.lower(),
+                    'unit_amount': amount_paise,
+                    'product_data': {'name': description or 'RTO Record Management'},
+                },
+                'quantity': 1,
+            }],
+            client_reference_id=receipt or None,
+            metadata={key: str(value) for key, value in (notes or {}).items()},
+            success_url=success_url,
+            cancel_url=cancel_url,
+        )
+        return {
+            'id': session['id'],
+            'amount': amount_paise,
+            'currency': currency,
+            'key': settings.STRIPE_PUBLISHABLE_KEY,
+            'checkout_url': session['url'],
+            'raw': {'id': session['id'], 'url': session['url']},
+        }
+
+
+class GatewayRouter:
+    """Route order creation to the healthiest eligible payment gateway."""
+
+    def __init__(self, clients=None, window_seconds=None, min_samples=None, default_latency=None,
+                 error_penalty=None, error_threshold=None):
+        self.clients = {client.provider: client for client in (clients or [RazorpayOrderClient(), StripeOrderClient()])}
+        self.window_seconds = window_seconds or settings.PAYMENT_ROUTING_WINDOW_SECONDS
+        self.min_samples = min_samples or settings.PAYMENT_ROUTING_MIN_SAMPLES
+        self.default_latency = default_latency or settings.PAYMENT_ROUTING_DEFAULT_LATENCY
+        self.error_penalty = settings.PAYMENT_ROUTING_ERROR_PENALTY if error_penalty is None else error_penalty
+        self.error_threshold = settings.PAYMENT_ROUTING_ERROR_THRESHOLD if error_threshold is None else error_threshold
+        self.configs = GatewayConfigCache()
+        self.health = {}
+        self._lock = threading.Lock()
+
+    def health_for(self, provider):
+        with self._lock:
+            if provider not in self.health:
+                self.health[provider] = ProviderHealth(self.window_seconds)
+            return self.health[provider]
+
+    def eligible(self, currency='INR'):
+        """Active, configured gateways supporting currency.
+
+        Falls back to Razorpay only when no PaymentGateway has been set up at all,
+        so deactivating every gateway really stops new orders.
+        """
+        configs = self.configs.get()
+        if not configs and PaymentGateway.Provider.RAZORPAY in self.clients:
+            return [{'provider': PaymentGateway.Provider.RAZORPAY, 'fee_percentage': 0}]
+        return [
+            config for config in configs
+            if config['is_active']
+            and config['provider'] in self.clients
+            and self.clients[config['provider']].is_configured()
+            and (not config['supported_currencies'] or currency in config['supported_currencies'])
+        ]
+
+    def score(self, provider):
+        """Lower is better: (failing, average latency plus a penalty for the recent error rate).
+
+        A provider with enough samples and an error rate above the threshold
+        sorts after every healthy one however fast it fails.
+        """
+        stats = self.health_for(provider).snapshot()
+        if stats['samples'] < self.min_samples:
+            latency = stats['avg_latency'] if stats['avg_latency'] is not None else self.default_latency
+            latency = min(latency, self.default_latency)
+        else:
+            latency = stats['avg_latency']
+        failing = stats['samples'] >= self.min_samples and stats['error_rate'] > self.error_threshold
+        return failing, latency + stats['error_rate'] * self.error_penalty
+
+    def rank(self, currency='INR'):
+        configs = self.eligible(currency)
+        return [
+            config['provider'] for config in
+            sorted(configs, key=lambda c: (self.score(c['provider']), c['fee_percentage']))
+        ]
+
+    def create_order(self, amount_paise, currency='INR', **kwargs):
+        """Create a gateway order on the best provider, failing over in rank order.
+
+        Returns ``(provider, order)`` where ``order`` has at least ``id``,
+        ``amount``, ``currency`` and ``key``.
+        """
+        errors = []
+        for provider in self.rank(currency):
+            started = time.monotonic()
+            try:
+                order = self.clients[provider].create_order(amount_paise, currency, **kwargs)
+            except Exception as e:
+                self.health_for(provider).record(time.monotonic() - started, ok=False)
+                logger.warning("Gateway %s failed to create order: %s", provider, e)
+                errors.append(f"{provider}: {e}")
+                continue
+            self.health_for(provider).record(time.monotonic() - started, ok=True)
+            return provider, order
+        raise GatewayUnavailable("; ".join(errors) or "No payment gateway is available")
+
+    def stats(self):
+        return {provider: self.health_for(provider).snapshot() for provider in self.clients}
+
+
+router = GatewayRouter()
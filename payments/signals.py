@@ -0,0 +1,12 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import PaymentGateway
+from .routing import bump_config_version
+
+
+@receiver(post_save, sender=PaymentGateway)
+@receiver(post_delete, sender=PaymentGateway)
+def invalidate_gateway_configs(sender, **kwargs):
+    """Make every process reload gateway configs on its next routing decision."""
+    bump_config_version()
@@ -1,3 +1,265 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from core.models import Order, OrderRollup, RTORecord
+from .models import PaymentGateway, PaymentTransaction, WebhookEvent
+from .refunds import BatchRefundProcessor, FakeRefundGateway
+from .routing import GatewayRouter, GatewayUnavailable
+
+User = get_user_model()
+
+
+class BatchRefundTests(TestCase):
+    """BatchRefundProcessor against the in-memory gateway."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='buyer', email='buyer@example.com', password='x')
+        record = RTORecord.objects.create(
+            owner=cls.user, name='Owner', contact_no='9999999999', address='Somewhere',
+            record_type=RTORecord.RecordType.RC,
+        )
+        PaymentGateway.objects.create(provider=PaymentGateway.Provider.RAZORPAY)
+        cls.orders = [
+            Order.objects.create(
+                user=cls.user, rto_record=record, order_type=Order.OrderType.PVC_CARD, amount=Decimal('100.00'),
+                payment_provider='razorpay', payment_provider_payment_id=f"pay_{i}",
+                payment_status=Order.Status.COMPLETED,
+            )
+            for i in range(10)
+        ]
+
+    def processor(self, gateway, **kwargs):
+        kwargs.setdefault('rate_per_second', 1000)
+        return BatchRefundProcessor(gateway=gateway, **kwargs)
+
+    def statuses(self):
+        return {order.payment_provider_payment_id: order.payment_status for order in Order.objects.all()}
+
+    def test_refunds_respect_concurrency_cap(self):
+        gateway = FakeRefundGateway(latency=0.05)
+        stats = self.processor(gateway, max_in_flight=3).run(Order.objects.all())
+
+        self.assertEqual(stats['refunded'], 10)
+        self.assertEqual(len(gateway.calls), 10)
+        self.assertEqual(gateway.max_in_flight, 3)
+        self.assertEqual(set(self.statuses().values()), {Order.Status.REFUNDED})
+        self.assertFalse(PaymentTransaction.objects.exclude(status=PaymentTransaction.Status.REFUNDED).exists())
+
+    def test_partial_failure_leaves_failed_orders_refundable(self):
+        gateway = FakeRefundGateway(fail_payment_ids={'pay_2', 'pay_7'})
+        stats = self.processor(gateway).run(Order.objects.all())
+
+        self.assertEqual((stats['refunded'], stats['failed']), (8, 2))
+        statuses = self.statuses()
+        self.assertEqual(statuses.pop('pay_2'), Order.Status.COMPLETED)
+        self.assertEqual(statuses.pop('pay_7'), Order.Status.COMPLETED)
+        self.assertEqual(set(statuses.values()), {Order.Status.REFUNDED})
+        failed = PaymentTransaction.objects.filter(provider_payment_id__in=['pay_2', 'pay_7'])
+        self.assertTrue(all(txn.status == PaymentTransaction.Status.SUCCESS and txn.failure_reason for txn in failed))
+
+        # A second run only retries the failures
+        gateway.fail_payment_ids.clear()
+        stats = self.processor(gateway).run(Order.objects.all())
+        self.assertEqual((stats['refunded'], stats['skipped']), (2, 8))
+        self.assertEqual(len(gateway.refunds), 10)
+
+    def test_rollups_move_to_refunded(self):
+        gateway = FakeRefundGateway()
+        self.processor(gateway).run(Order.objects.filter(pk__in=[order.pk for order in self.orders[:4]]))
+
+        rollups = {row.status: row for row in OrderRollup.objects.filter(order_count__gt=0)}
+        self.assertEqual(rollups[Order.Status.COMPLETED].order_count, 6)
+        self.assertEqual(rollups[Order.Status.COMPLETED].total_amount, Decimal('600.00'))
+        self.assertEqual(rollups[Order.Status.REFUNDED].order_count, 4)
+        self.assertEqual(rollups[Order.Status.REFUNDED].total_amount, Decimal('400.00'))
+
+    def test_claimed_transactions_are_not_refunded_twice(self):
+        first = self.processor(FakeRefundGateway())
+        claimed = first._claim([order.pk for order in self.orders])
+        self.assertEqual(len(claimed), 10)
+
+        # A concurrent run sees every refund in flight and leaves them alone
+        gateway = FakeRefundGateway()
+        stats = self.processor(gateway).run(Order.objects.all())
+        self.assertEqual(stats['skipped'], 10)
+        self.assertEqual(gateway.calls, [])
+
+    def test_stale_claim_is_resumed(self):
+        gateway = FakeRefundGateway()
+        first = self.processor(gateway)
+        txn = first._claim([self.orders[0].pk])[0]
+        gateway.refund(txn.provider_payment_id, 10000, txn.provider_response['refund']['receipt'])
+        PaymentTransaction.objects.filter(pk=txn.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        stats = self.processor(gateway).run([self.orders[0]])
+        self.assertEqual((stats['recovered'], stats['refunded']), (1, 0))
+        self.assertEqual(len(gateway.calls), 1)
+        self.assertEqual(Order.objects.get(pk=self.orders[0].pk).payment_status, Order.Status.REFUNDED)
+
+    def test_partially_refunded_transaction_is_refunded_in_full_later(self):
+        order = self.orders[0]
+        stats = self.processor(FakeRefundGateway(max_amount_paise=3000)).run([order])
+
+        self.assertEqual(stats['refunded'], 1)
+        txn = PaymentTransaction.objects.get(order=order)
+        self.assertEqual((txn.status, txn.refund_amount), (PaymentTransaction.Status.PARTIALLY_REFUNDED, Decimal('30')))
+        self.assertEqual(Order.objects.get(pk=order.pk).payment_status, Order.Status.COMPLETED)
+
+        # The remainder fails once, leaving the transaction partially refunded
+        self.processor(FakeRefundGateway(fail_payment_ids={'pay_0'})).run([order])
+        txn.refresh_from_db()
+        self.assertEqual((txn.status, txn.refund_amount), (PaymentTransaction.Status.PARTIALLY_REFUNDED, Decimal('30')))
+
+        gateway = FakeRefundGateway()
+        self.processor(gateway).run([order])
+        [(payment_id, amount_paise, receipt, _)] = gateway.calls
+        self.assertEqual((payment_id, amount_paise, receipt), ('pay_0', 7000, f"refund_{txn.transaction_id}_3000"))
+        txn.refresh_from_db()
+        self.assertEqual((txn.status, txn.refund_amount), (PaymentTransaction.Status.REFUNDED, Decimal('100')))
+        self.assertEqual(Order.objects.get(pk=order.pk).payment_status, Order.Status.REFUNDED)
+
+        # Nothing is left to refund
+        gateway = FakeRefundGateway()
+        self.assertEqual(self.processor(gateway).run([order])['skipped'], 1)
+        self.assertEqual(gateway.calls, [])
+
+    def test_dry_run_writes_nothing(self):
+        out = StringIO()
+        call_command('refund_orders', *[order.order_id for order in self.orders], '--dry-run', stdout=out)
+
+        self.assertIn("Would refund 10 orders", out.getvalue())
+        self.assertFalse(PaymentTransaction.objects.exists())
+        self.assertEqual(set(self.statuses().values()), {Order.Status.COMPLETED})
+
+
+class FakeOrderClient:
+    def __init__(self, provider, fail=False):
+        self.provider = provider
+        self.fail = fail
+        self.calls = 0
+
+    def is_configured(self):
+        return True
+
+    def create_order(self, amount_paise, currency, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError(f"{self.provider} is down")
+        return {'id': f"{self.provider}_{self.calls}", 'amount': amount_paise, 'currency': currency, 'key': 'k'}
+
+
+class GatewayRouterTests(TestCase):
+    """Routing of new orders across gateways."""
+
+    def router(self, razorpay_fails=False):
+        self.razorpay = FakeOrderClient(PaymentGateway.Provider.RAZORPAY, fail=razorpay_fails)
+        self.stripe = FakeOrderClient(PaymentGateway.Provider.STRIPE)
+        return GatewayRouter(clients=[self.razorpay, self.stripe], min_samples=3)
+
+    def test_fast_failing_gateway_is_tried_after_healthy_one(self):
+        PaymentGateway.objects.create(provider=PaymentGateway.Provider.RAZORPAY, fee_percentage=1)
+        PaymentGateway.objects.create(provider=PaymentGateway.Provider.STRIPE, fee_percentage=3)
+        router = self.router(razorpay_fails=True)
+
+        providers = [router.create_order(10000)[0] for _ in range(10)]
+
+        self.assertEqual(set(providers), {PaymentGateway.Provider.STRIPE})
+        # Cheaper, so tried first once; its failure outweighs failing fast
+        self.assertEqual(self.razorpay.calls, 1)
+
+    def test_gateway_above_error_threshold_sorts_last(self):
+        PaymentGateway.objects.create(provider=PaymentGateway.Provider.RAZORPAY)
+        PaymentGateway.objects.create(provider=PaymentGateway.Provider.STRIPE)
+        router = self.router()
+        for _ in range(3):
+            router.health_for(PaymentGateway.Provider.RAZORPAY).record(0.001, ok=False)
+        router.health_for(PaymentGateway.Provider.STRIPE).record(30.0, ok=True)
+
+        self.assertTrue(router.score(PaymentGateway.Provider.RAZORPAY)[0])
+        self.assertEqual(router.rank(), [PaymentGateway.Provider.STRIPE, PaymentGateway.Provider.RAZORPAY])
+
+    def test_inactive_gateways_are_not_used(self):
+        PaymentGateway.objects.create(provider=PaymentGateway.Provider.RAZORPAY, is_active=False)
+        with self.assertRaises(GatewayUnavailable):
+            self.router().create_order(10000)
+        self.assertEqual(self.razorpay.calls, 0)
+
+    def test_falls_back_to_razorpay_without_gateway_rows(self):
+        self.assertEqual(self.router().create_order(10000)[0], PaymentGateway.Provider.RAZORPAY)
+
+    def test_gateway_changes_invalidate_cached_configs(self):
+        router = self.router()
+        gateway = PaymentGateway.objects.create(provider=PaymentGateway.Provider.RAZORPAY)
+        self.assertEqual(router.rank(), [PaymentGateway.Provider.RAZORPAY])
+        gateway.is_active = False
+        gateway.save()
+        self.assertEqual(router.rank(), [])
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class StripeWebhookTests(TestCase):
+    """checkout.session.completed deliveries, including Stripe's retries."""
+
+    @classmethod
+    def setUpTestData(cls):
+        user = User.objects.create_user(username='buyer', email='buyer@example.com', password='x')
+        record = RTORecord.objects.create(
+            owner=user, name='Owner', contact_no='9999999999', address='Somewhere',
+            record_type=RTORecord.RecordType.RC,
+        )
+        cls.order = Order.objects.create(
+            user=user, rto_record=record, order_type=Order.OrderType.PVC_CARD, amount=Decimal('100.00'),
+            order_id='cs_test_1', payment_provider='stripe',
+        )
+
+    def deliver(self, event_id='evt_1'):
+        payload = json.dumps({
+            'id': event_id, 'object': 'event', 'type': 'checkout.session.completed',
+            'data': {'object': {'id': self.order.order_id, 'payment_intent': 'pi_1'}},
+        })
+        timestamp = int(time.time())
+        signature = hmac.new(b'whsec_test', f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            reverse('payments:stripe_webhook'), payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}",
+        )
+
+    def test_duplicate_delivery_fulfils_once(self):
+        with mock.patch('core.views.fulfill_paid_order') as fulfill:
+            self.assertEqual(self.deliver().status_code, 200)
+            self.assertEqual(self.deliver().status_code, 200)
+
+        self.assertEqual(fulfill.call_count, 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, Order.Status.COMPLETED)
+        self.assertTrue(WebhookEvent.objects.get(event_id='evt_1').processed)
+
+    def test_retry_after_failed_fulfilment_is_processed(self):
+        with mock.patch('core.views.fulfill_paid_order', side_effect=RuntimeError('deploy failed')):
+            with self.assertRaises(RuntimeError), self.assertLogs('django.request', 'ERROR'):
+                self.deliver()
+
+        self.assertFalse(WebhookEvent.objects.filter(event_id='evt_1').exists())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, Order.Status.PENDING)
+
+        with mock.patch('core.views.fulfill_paid_order') as fulfill:
+            self.assertEqual(self.deliver().status_code, 200)
+
+        fulfill.assert_called_once()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, Order.Status.COMPLETED)
+        self.assertTrue(WebhookEvent.objects.get(event_id='evt_1').processed)
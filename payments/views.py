@@ -1,6 +1,13 @@
+import json
+
 from django.shortcuts import render
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.conf import settings
+from django.db import transaction
+
+from .models import WebhookEvent
 
 def create_order_view(request, record_id):
     """Create order view placeholder."""
@@ -24,6 +31,54 @@ def razorpay_webhook(request):
     return HttpResponse("OK")
 
 @csrf_exempt
+@require_POST
 def stripe_webhook(request):
-    """Stripe webhook handler placeholder."""
+    """Complete Stripe Checkout orders created by the gateway router."""
+    import stripe
+    from core.models import Order
+    from core.events import publish_order_event, PAID
+    from core.views import fulfill_paid_order
+
+    try:
+        event = stripe.Webhook.construct_event(
+            request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''), settings.STRIPE_WEBHOOK_SECRET
+        )
+    except (ValueError, stripe.SignatureVerificationError):
+        return HttpResponse("Invalid signature", status=400)
+
+    if event['type'] != 'checkout.session.completed':
+        return HttpResponse("OK")
+
+    session = event['data']['object'].to_dict()  # StripeObject no longer supports dict.get()
+
+    # Record and fulfil in one transaction: if fulfilment raises, the event row rolls back with it and
+    # Stripe's retry is processed afresh instead of being ACKed as a duplicate.
+    with transaction.atomic():
+        webhook_event, _ = WebhookEvent.objects.select_for_update().get_or_create(
+            event_id=event['id'],
+            defaults={
+                'provider': 'stripe',
+                'event_type': WebhookEvent.EventType.PAYMENT_SUCCESS,
+                'raw_data': json.loads(request.body),
+            },
+        )
+        if webhook_event.processed:
+            return HttpResponse("OK")  # Already handled
+
+        try:
+            order = Order.objects.select_for_update().select_related('rto_record').get(
+                order_id=session['id'], payment_provider='stripe'
+            )
+        except Order.DoesNotExist:
+            webhook_event.mark_processed({'error': 'order not found'})
+            return HttpResponse("OK")
+
+        if order.payment_status != Order.Status.COMPLETED:
+            order.payment_status = Order.Status.COMPLETED
+            order.payment_provider_payment_id = session.get('payment_intent') or ''
+            order.save()
+            publish_order_event(order, PAID)
+            fulfill_paid_order(order, request)
+
+        webhook_event.mark_processed({'order_id': order.order_id})
     return HttpResponse("OK")
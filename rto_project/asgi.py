@@ -3,6 +3,13 @@ ASGI config for rto_project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Only the server-sent event streams (``/orders/<order_id>/events/``) are
+served over ASGI, by the uvicorn workers of gunicorn.events.conf.py, so
+waiting clients sit on the event loop instead of each holding a sync worker.
+Every other route answers 404 here: Django's ASGI handler reads a whole
+request body before the view runs, which would defeat the streaming upload
+handlers, so uploads and pages stay on the WSGI workers.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
@@ -10,7 +17,23 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
+from django.urls import Resolver404, resolve
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rto_project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+ASGI_ROUTES = {'core:order_events'}
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        try:
+            match = resolve(scope['path'])
+        except Resolver404:
+            match = None
+        if match is None or match.view_name not in ASGI_ROUTES:
+            await send({'type': 'http.response.start', 'status': 404, 'headers': [(b'content-type', b'text/plain')]})
+            await send({'type': 'http.response.body', 'body': b'Not found'})
+            return
+    await django_application(scope, receive, send)
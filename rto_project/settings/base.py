@@ -84,6 +84,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'rto_project.wsgi.application'
+ASGI_APPLICATION = 'rto_project.asgi.application'
 
 # Database
 DATABASES = {
@@ -169,8 +170,76 @@ REST_FRAMEWORK = {
 }
 
 # File upload settings
+# Record document uploads are streamed to disk, hashed and size/type-checked chunk by chunk
+# (core.uploads.stream_document_uploads); other uploads keep Django's default handlers
+UPLOAD_STAGING_DIR = MEDIA_ROOT / 'tmp_uploads'  # same filesystem as MEDIA_ROOT, so saving is a rename
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
-DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
+DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB (non-file form data only)
+UPLOAD_OFFLOAD_WORKERS = config('UPLOAD_OFFLOAD_WORKERS', default=4, cast=int)  # form files written to storage concurrently (core.offload)
+
+# Resumable (tus) uploads through /api/uploads/
+RESUMABLE_UPLOAD_EXPIRY_HOURS = 24  # Unfinished uploads are purged after this
+RESUMABLE_UPLOAD_READ_SIZE = 64 * 1024  # Bytes read from the request body at a time
+RESUMABLE_UPLOAD_LOCK_TTL = 300  # Upper bound on one PATCH (including completing the upload) holding an upload
+RESUMABLE_UPLOAD_CACHE_ALIAS = 'shared'  # the per-upload lock must be seen by every worker
+
+# Document storage: 'local' (MEDIA_ROOT) or 's3' (S3-compatible bucket, needed for direct uploads)
+DOCUMENT_STORAGE_BACKEND = config('DOCUMENT_STORAGE_BACKEND', default='local')
+AWS_STORAGE_BUCKET_NAME = config('AWS_STORAGE_BUCKET_NAME', default='')
+AWS_S3_REGION_NAME = config('AWS_S3_REGION_NAME', default=None)
+AWS_S3_ENDPOINT_URL = config('AWS_S3_ENDPOINT_URL', default=None)  # MinIO, moto server, ...
+AWS_ACCESS_KEY_ID = config('AWS_ACCESS_KEY_ID', default=None)
+AWS_SECRET_ACCESS_KEY = config('AWS_SECRET_ACCESS_KEY', default=None)
+
+# Presigned direct-to-bucket uploads through /api/direct-uploads/
+DIRECT_UPLOAD_PREFIX = 'direct_uploads/'
+DIRECT_UPLOAD_EXPIRY_SECONDS = 300  # Lifetime of the presigned URL
+DIRECT_UPLOAD_COMPLETE_WINDOW = 3600  # How long the completion token stays valid
+
+# Owner-checked document downloads (core.media): '' streams through Django with Range/ETag support,
+# 'nginx' hands off with X-Accel-Redirect to PROTECTED_MEDIA_INTERNAL_URL, 'xsendfile' with X-Sendfile
+PROTECTED_MEDIA_SENDFILE = config('PROTECTED_MEDIA_SENDFILE', default='')
+PROTECTED_MEDIA_INTERNAL_URL = '/protected-media/'  # nginx 'internal' location aliased to MEDIA_ROOT
+
+# Signed, expiring document URLs in galleries and API responses (core.signed_urls), cached until shortly before expiry
+SIGNED_URL_TTL = config('SIGNED_URL_TTL', default=60 * 60, cast=int)  # seconds
+SIGNED_URL_REFRESH_MARGIN = 5 * 60  # cached URLs are re-signed this long before they expire
+SIGNED_URL_CACHE_ALIAS = 'shared'  # signed once per record, reused by every worker
+SIGNED_URL_BASE = config('SIGNED_URL_BASE', default='')  # absolute app URL (e.g. https://app.example.com) published galleries link back to (core.W001)
+
+# Near-duplicate image documents across owners (core.duplicates); must stay below 4
+DOCUMENT_DUPLICATE_MAX_DISTANCE = 3  # differing bits of the 64-bit dHash
+
+# Consolidated per-record review PDF (core.review_pdf)
+REVIEW_PDF_MAX_DIMENSION = 1600  # px, longest side of each embedded image/page
+REVIEW_PDF_QUALITY = 70  # JPEG quality of embedded images
+REVIEW_PDF_DPI = 110  # rasterization of PDF document pages
+REVIEW_PDF_MAX_PAGES = 20  # per PDF document
+REVIEW_PDF_WORKERS = config('REVIEW_PDF_WORKERS', default=4, cast=int)
+
+# Orphaned media garbage collection (manage.py collect_orphan_media)
+MEDIA_GC_GRACE_HOURS = 24  # files younger than this are never collected (uploads in flight)
+MEDIA_GC_QUARANTINE_PREFIX = 'gc_quarantine/'  # --quarantine moves orphans under here instead of deleting
+
+# Per-owner storage quotas for record documents by user role (core.quotas); None is unlimited.
+# StorageUsage.quota_bytes overrides these per user.
+STORAGE_QUOTA_BYTES = {
+    'customer': config('CUSTOMER_STORAGE_QUOTA_BYTES', default=200 * 1024 * 1024, cast=int),
+    'school': config('SCHOOL_STORAGE_QUOTA_BYTES', default=5 * 1024 * 1024 * 1024, cast=int),
+    'rto_officer': None,
+    'admin': None,
+}
+
+# Health checks of external (Cloudinary) document URLs (manage.py check_document_links)
+LINK_CHECK_CONCURRENCY = config('LINK_CHECK_CONCURRENCY', default=50, cast=int)  # requests in flight overall
+LINK_CHECK_PER_HOST_CONNECTIONS = 8  # keep-alive connections per host
+LINK_CHECK_PER_HOST_RATE = 20  # requests per second per host; 0 disables pacing
+LINK_CHECK_TIMEOUT = 10  # seconds per request
+LINK_CHECK_INTERVAL_HOURS = 24  # documents checked more recently are skipped
+
+# Local read-through cache of remote documents/QR images used by PDFs, previews and bundles (see core.file_cache)
+DOCUMENT_CACHE_DIR = config('DOCUMENT_CACHE_DIR', default=str(BASE_DIR / 'cache' / 'documents'))
+DOCUMENT_CACHE_MAX_BYTES = config('DOCUMENT_CACHE_MAX_BYTES', default=512 * 1024 * 1024, cast=int)
 
 # Email settings (for production use)
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'  # Development
@@ -184,6 +253,23 @@ DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default='noreply@rtomanagement
 # Payment Gateway Settings
 RAZORPAY_KEY_ID = config('RAZORPAY_KEY_ID', default='your_razorpay_key_id')
 RAZORPAY_KEY_SECRET = config('RAZORPAY_KEY_SECRET', default='your_razorpay_key_secret')
+STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY', default='')
+STRIPE_PUBLISHABLE_KEY = config('STRIPE_PUBLISHABLE_KEY', default='')
+STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET', default='')
+
+# Gateway routing (rolling health window per provider)
+PAYMENT_ROUTING_WINDOW_SECONDS = 300
+PAYMENT_ROUTING_MIN_SAMPLES = 5
+PAYMENT_ROUTING_DEFAULT_LATENCY = 1.0  # seconds assumed for providers without enough samples
+PAYMENT_ROUTING_ERROR_PENALTY = 5.0  # seconds added to a provider's latency at a 100% error rate
+PAYMENT_ROUTING_ERROR_THRESHOLD = 0.5  # error rate above which a provider is only tried after healthy ones
+PAYMENT_ROUTING_CACHE_ALIAS = 'shared'  # holds the gateway config version
+
+# Batch refunds
+REFUND_MAX_IN_FLIGHT = config('REFUND_MAX_IN_FLIGHT', default=8, cast=int)
+REFUND_RATE_LIMIT_PER_SECOND = config('REFUND_RATE_LIMIT_PER_SECOND', default=5, cast=float)
+REFUND_WRITE_BATCH_SIZE = config('REFUND_WRITE_BATCH_SIZE', default=50, cast=int)
+REFUND_CLAIM_TIMEOUT = 10 * 60  # seconds before a refund left in flight is treated as interrupted and resumed
 
 
 # Security settings for production
@@ -242,13 +328,35 @@ LOGGING = {
 }
 
 # Cache settings (for production performance)
+# 'shared' is seen by every worker process: state that must agree across workers goes there
+REDIS_URL = config('REDIS_URL', default='redis://localhost:6379/1')
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         'LOCATION': 'unique-snowflake',
-    }
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+    },
 }
 
+# Order status events (server-sent events)
+ORDER_EVENTS_BACKEND = config('ORDER_EVENTS_BACKEND', default='redis')  # memory (single process only), cache or redis
+ORDER_EVENTS_REDIS_URL = config('ORDER_EVENTS_REDIS_URL', default=REDIS_URL)
+ORDER_EVENTS_TTL = 60 * 60  # seconds an order's event history is kept
+ORDER_EVENTS_POLL_INTERVAL = 1.0  # cache backend only
+ORDER_EVENTS_MAX_CHANNELS = 1000  # memory backend only: orders whose history is kept
+ORDER_EVENTS_HEARTBEAT_SECONDS = 15
+ORDER_EVENTS_MAX_STREAM_SECONDS = 10 * 60
+ORDER_EVENTS_RETRY_MS = 3000
+
+# Idempotency-Key replay for mutating endpoints (the cache must be shared by every worker)
+IDEMPOTENCY_CACHE_ALIAS = 'shared'
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60  # how long a stored response is replayed
+IDEMPOTENCY_LOCK_TTL = 60  # upper bound on how long the first request holds the key
+IDEMPOTENCY_LOCK_WAIT = 5  # seconds a concurrent retry waits for the first response
+
 # RTO Project specific settings
 RTO_PROJECT_NAME = 'RTO Record Management System'
 RTO_PROJECT_VERSION = '1.0.0'
@@ -260,6 +368,14 @@ ALLOWED_DOCUMENT_EXTENSIONS = ['pdf', 'jpg', 'jpeg', 'png']
 MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5MB
 MAX_DOCUMENT_SIZE = 10 * 1024 * 1024  # 10MB
 
+# Resized WebP/JPEG variants of uploaded images, used for srcset in galleries
+DOCUMENT_DERIVATIVE_WIDTHS = [320, 640, 1024]
+DOCUMENT_DERIVATIVE_QUALITY = 80
+DOCUMENT_PREVIEW_WIDTHS = [320, 640]  # page-1 previews of PDF documents (PyMuPDF)
+DOCUMENT_DERIVATIVE_WORKERS = config('DOCUMENT_DERIVATIVE_WORKERS', default=2, cast=int)  # 0 renders inline
+# Widths of the f_auto/q_auto transformation URLs in srcsets of Cloudinary-hosted documents (core.cloudinary_urls)
+CLOUDINARY_SRCSET_WIDTHS = [160, 320, 640, 1024, 1600]
+
 # QR Code settings
 QR_CODE_VERSION = 1
 QR_CODE_ERROR_CORRECTION = 'L'  # Low error correction
@@ -268,4 +384,6 @@ QR_CODE_BORDER = 4
 
 # Order settings
 ORDER_VALIDITY_DAYS = 30
+ORDER_SWEEP_CHUNK_SIZE = 500  # Orders expired per transaction by expire_pending_orders
+ORDER_SWEEP_CACHE_ALIAS = 'shared'  # last-run counters must be readable from web workers
 DEFAULT_SHIPPING_COST = 0  # Free shipping
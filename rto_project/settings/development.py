@@ -5,6 +5,14 @@ DEBUG = True
 # Development-specific settings
 CORS_ALLOW_ALL_ORIGINS = True
 
+# runserver is a single process, so the shared cache needn't be Redis
+CACHES['shared'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'shared',
+}
+ORDER_EVENTS_BACKEND = config('ORDER_EVENTS_BACKEND', default='memory')
+SIGNED_URL_BASE = config('SIGNED_URL_BASE', default='http://localhost:8000')
+
 # Email backend for development
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 # Razorpay API credentials (use your actual keys here)